@@ -0,0 +1,443 @@
+#!/usr/bin/env python2
+##
+## Offline benchmark of vk-chat.py
+##
+## The script is loaded with stand-ins for the weechat and vkontakte modules, and run by a minimal event loop against a local
+## long polling server that replays a stream of messages. No request is made to VK.
+##
+## Usage: python2 bench/bench.py [scenario...] [options], see --help
+##
+
+import os
+import re
+import sys
+import imp
+import gc
+import json
+import time
+import types
+import random
+import select
+import shutil
+import socket
+import urlparse
+import argparse
+import resource
+import tempfile
+import collections
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(os.path.dirname(BENCH_DIR), "vk-chat.py")
+
+## The stand-ins shadow the real modules
+sys.path.insert(0, BENCH_DIR)
+
+import weechat
+import vkontakte
+import fakevk
+
+Scenario = collections.namedtuple("Scenario", "name description mode friends strangers events batches batch_size interval_ms failed_every "
+                                              "close_every accounts")
+
+SCENARIOS = collections.OrderedDict((scenario.name, scenario) for scenario in [
+    Scenario("burst", "bursts of messages from a few friends", "fd", 50, 0, False, 20, 50, 250, 0, 0, 1),
+    Scenario("friends", "steady stream from thousands of friends, some senders unknown", "fd", 5000, .1, False, 200, 5, 20, 0, 0, 1),
+    Scenario("events", "messages along with typing, presence, read and deletion events", "fd", 500, 0, True, 50, 20, 100, 0, 0, 1),
+    Scenario("failed", "the server asks for a new key every 5 requests", "fd", 100, 0, False, 50, 10, 100, 5, 0, 1),
+    Scenario("close", "the server drops the connection every 4 requests", "fd", 100, 0, False, 50, 10, 100, 0, 4, 1),
+    Scenario("timer", "updates polled by CallbackVkFetchUpdates", "timer", 100, 0, False, 3, 100, 1000, 0, 0, 1),
+    Scenario("accounts", "several accounts, each with its own long polling server", "fd", 100, 0, False, 50, 10, 100, 0, 0, 8),
+    Scenario("render", "messages handed straight to BufferManager", None, 5000, 0, False, 50, 200, 0, 0, 0, 1),
+    Scenario("startup", "loading the script until it polls, without then with the friends cached", None, 5000, 0, False, 0, 0, 0, 0, 0, 1),
+])
+
+REGEX_MESSAGE = re.compile(r"\tbench message (\d+)$")
+
+class Profile(object):
+    """Time spent in the callbacks of the script, per callback"""
+
+    def __init__(self):
+        self.calls = collections.defaultdict(int)
+        self.elapsed = collections.defaultdict(float)
+
+    def Run(self, module, callback_name, *args):
+        start = time.time()
+        result = getattr(module, callback_name)(*args)
+        self.calls[callback_name] += 1
+        self.elapsed[callback_name] += time.time() - start
+
+        return result
+
+class EventLoop(object):
+    """Services the hooks the script registered, the way WeeChat would"""
+
+    def __init__(self, module, api, api_latency_ms):
+        self.module = module
+        self.api = api
+        self.api_latency = api_latency_ms / 1000.0
+        self.profile = Profile()
+
+    def _run_processes(self, now):
+        for pointer, hook in weechat.state.hooks.items():
+            if hook.type != "process" or now - hook.created < self.api_latency or not pointer in weechat.state.hooks:
+                continue
+
+            del weechat.state.hooks[pointer]
+
+            method = hook.command.rsplit("/", 1)[1]
+            params = dict((k, v.decode("utf-8")) for k, v in urlparse.parse_qsl(hook.options.get("postfields", "")))
+            out = json.dumps(self.api.Call(method, params))
+            self.profile.Run(self.module, hook.callback_name, hook.data, hook.command, 0, out, "")
+
+    def _run_connects(self):
+        """Connect the sockets the script asked for, the servers are local"""
+
+        for pointer, hook in weechat.state.hooks.items():
+            if hook.type != "connect" or not pointer in weechat.state.hooks:
+                continue
+
+            del weechat.state.hooks[pointer]
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect((hook.address, hook.port))
+            except socket.error as e:
+                sock.close()
+                self.profile.Run(self.module, hook.callback_name, hook.data, weechat.WEECHAT_HOOK_CONNECT_CONNECTION_REFUSED, 0, -1,
+                                 str(e), "")
+                continue
+
+            ## Like WeeChat, the descriptor is handed over to the script, which owns it from then on
+            fd = os.dup(sock.fileno())
+            sock.close()
+
+            self.profile.Run(self.module, hook.callback_name, hook.data, weechat.WEECHAT_HOOK_CONNECT_OK, 0, fd, "",
+                             socket.gethostbyname(hook.address))
+
+    def _run_timers(self, now):
+        for pointer, hook in sorted(weechat.state.hooks.items(), key=lambda item: getattr(item[1], "next_call", 0)):
+            if hook.type != "timer" or hook.next_call > now or not pointer in weechat.state.hooks:
+                continue
+
+            hook.calls += 1
+            if hook.max_calls and hook.calls >= hook.max_calls:
+                del weechat.state.hooks[pointer]
+            else:
+                hook.next_call = now + hook.interval / 1000.0
+
+            remaining = hook.max_calls - hook.calls if hook.max_calls else -1
+            self.profile.Run(self.module, hook.callback_name, hook.data, str(remaining))
+
+    def _run_fds(self, timeout):
+        fds = [ (pointer, hook) for pointer, hook in weechat.state.hooks.items() if hook.type == "fd" ]
+        read_list = [ hook.fd for _, hook in fds if hook.read ]
+        write_list = [ hook.fd for _, hook in fds if hook.write ]
+
+        if not read_list and not write_list:
+            time.sleep(timeout)
+            return
+
+        readable, writable, _ = select.select(read_list, write_list, [], timeout)
+        for pointer, hook in fds:
+            if pointer in weechat.state.hooks and (hook.fd in readable or hook.fd in writable):
+                self.profile.Run(self.module, hook.callback_name, hook.data, hook.fd)
+
+    def _timeout(self, now):
+        timeout = .05
+        for hook in weechat.state.hooks.values():
+            if hook.type == "timer":
+                timeout = min(timeout, hook.next_call - now)
+            elif hook.type == "process":
+                timeout = min(timeout, hook.created + self.api_latency - now)
+
+        return max(timeout, 0)
+
+    def RunOnce(self):
+        now = time.time()
+        self._run_timers(now)
+        self._run_processes(now)
+        self._run_connects()
+        self._run_fds(self._timeout(time.time()))
+
+    def Run(self, until, timeout):
+        deadline = time.time() + timeout
+        while not until() and time.time() < deadline:
+            self.RunOnce()
+
+def _deep_size(obj, seen=None):
+    """Approximate amount of memory held by an object and everything it references, code and modules excluded"""
+
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen or isinstance(obj, (types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+                                           types.ClassType, type)):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(_deep_size(item, seen) for item in obj)
+
+    if hasattr(obj, "__dict__"):
+        size += _deep_size(obj.__dict__, seen)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += _deep_size(getattr(obj, slot), seen)
+
+    return size
+
+def _percentile(values, percentile):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+def _rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _make_batches(scenario, seed, warmup=0, first_id=0):
+    rng = random.Random(seed)
+    batches = []
+    message_id = first_id
+
+    for i in xrange(scenario.batches):
+        messages = []
+        events = []
+        for _ in xrange(scenario.batch_size):
+            message_id += 1
+            if rng.random() < scenario.strangers:
+                uid = scenario.friends + rng.randint(1, 1000)
+            else:
+                uid = rng.randint(1, scenario.friends)
+            messages.append((message_id, uid, u"bench message {0}".format(message_id)))
+
+            ## Other events sent by the server: the sender is typing, goes online, then their previous message is read or deleted
+            if scenario.events:
+                events.extend([ [61, uid, 1], [8, -uid, 7], [6, uid, message_id - 1], [2, message_id - 1, 128, uid] ][:rng.randint(1, 4)])
+
+        batches.append(fakevk.Batch(warmup + i * scenario.interval_ms / 1000.0, messages, events))
+
+    return batches
+
+def _load_script(data_dir, config):
+    weechat.reset(data_dir, config)
+    sys.modules.pop("vk_chat", None)
+
+    return imp.load_source("vk_chat", SCRIPT_PATH)
+
+def _report_profile(profile, top=8):
+    print("  time spent in callbacks:")
+    for name in sorted(profile.elapsed, key=profile.elapsed.get, reverse=True)[:top]:
+        print("    {0:<32} {1:>7} calls {2:>10.1f} ms {3:>8.3f} ms/call".format(name, profile.calls[name], profile.elapsed[name] * 1000,
+                                                                           profile.elapsed[name] * 1000 / profile.calls[name]))
+
+def _report_memory(module, rss_before):
+    accounts = module.plugin.GetAccounts()
+
+    ## The components of an account reference it, it's only accounted for once in the total
+    print("  memory: peak RSS +{0} KB, UpdatesPoller {1} B, BufferManager {2} B, Plugin {3} B ({4} accounts)".format(
+            _rss_kb() - rss_before, sum(_deep_size(account.updates_poller, set([id(account)])) for account in accounts),
+            sum(_deep_size(account.buffer_manager, set([id(account)])) for account in accounts), _deep_size(module.plugin), len(accounts)))
+
+def RunStream(scenario, options):
+    """Stream the messages of a scenario through the long polling server, and measure how long they took to be displayed"""
+
+    config = {
+        "vk-token": "bench",
+        "longpoll-mode": scenario.mode,
+        "max-requests-per-second": str(options.rate),
+        "max-lines-per-tick": str(options.max_lines_per_tick),
+        "trace": options.trace,
+    }
+
+    ## Every account has its own server and friends, the first one is the account of the vk-token option
+    servers, apis = [], {}
+    ## Server and time every message is due at
+    due = {}
+    for i in xrange(scenario.accounts):
+        ## The first batch is sent once the script had the time to connect, polling with a timer takes two ticks of 5s
+        batches = _make_batches(scenario, options.seed + i, 11 if scenario.mode == "timer" else 1, i * scenario.batches * scenario.batch_size)
+        server = fakevk.LongPollServer(batches, scenario.failed_every, scenario.close_every)
+        servers.append(server)
+        due.update((message[0], (server, batch.due)) for batch in batches for message in batch.messages)
+
+        token = "bench-{0}".format(i) if i else "bench"
+        apis[token] = fakevk.FakeApi(server, scenario.friends)
+        if i:
+            config["vk-token.account{0}".format(i)] = token
+    config["accounts"] = ",".join("account{0}".format(i) for i in xrange(1, scenario.accounts))
+
+    api = fakevk.FakeAccounts(apis)
+    vkontakte.api = api
+
+    data_dir = tempfile.mkdtemp(prefix="vk-chat-bench-")
+    rss_before = _rss_kb()
+    try:
+        module = _load_script(data_dir, config)
+        loop = EventLoop(module, api, options.api_latency)
+
+        for server in servers:
+            server.Start()
+        module.main()
+
+        ## The updates the server skipped after a failure are never displayed, the stream ends a while after the last batch
+        drain = 16 if scenario.mode == "timer" else 5
+        end = max(server.start for server in servers) + batches[-1].due + drain
+        ## Time at which every message was first displayed
+        displayed = {}
+        lines_seen = [0]
+
+        def done():
+            for line in weechat.state.lines[lines_seen[0]:]:
+                match = REGEX_MESSAGE.search(line[3])
+                if match and not int(match.group(1)) in displayed:
+                    displayed[int(match.group(1))] = line[0]
+            lines_seen[0] = len(weechat.state.lines)
+
+            return len(displayed) >= len(due) or time.time() > end
+
+        loop.Run(done, batches[-1].due + drain + 30)
+
+        latencies = sorted((shown - (due[message_id][0].start + due[message_id][1])) * 1000 for message_id, shown in displayed.iteritems())
+        updates = dict(module.metrics.GetCounters()).get("longpoll.updates", 0)
+        processing = sum(loop.profile.elapsed.get(name, 0) for name in ("CallbackVkLongPollFd", "CallbackVkFetchUpdates"))
+        duration = batches[-1].due - batches[0].due or 1
+
+        print("{0}: {1}".format(scenario.name, scenario.description))
+        print("  {0} messages from {1} friends in {2} batches every {3} ms, {4} mode, {5} account(s)".format(len(due), scenario.friends,
+                len(batches), scenario.interval_ms, scenario.mode, scenario.accounts))
+        print("  server: {0} requests, {1} connections, {2} failures, {3} connections dropped".format(
+                sum(server.requests for server in servers), sum(server.connections for server in servers),
+                sum(server.failures for server in servers), sum(server.closes for server in servers)))
+        print("  delivered {0}/{1} messages, delivery latency (ms): p50 {2:.1f}, p95 {3:.1f}, p99 {4:.1f}, max {5:.1f}".format(
+                len(latencies), len(due), _percentile(latencies, 50), _percentile(latencies, 95), _percentile(latencies, 99),
+                latencies[-1] if latencies else 0))
+        print("  updates: {0} received, {1:.0f}/s processed, {2:.0f}/s delivered".format(updates, updates / processing if processing else 0,
+                                                                                    len(latencies) / duration))
+        _report_profile(loop.profile)
+        _report_memory(module, rss_before)
+
+        module.CallbackPluginUnloaded()
+    finally:
+        for server in servers:
+            server.Stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def RunRender(scenario, options):
+    """Hand batches of messages straight to the BufferManager, and measure how long they took to be displayed"""
+
+    batches = _make_batches(scenario, options.seed)
+    api = fakevk.FakeApi(None, scenario.friends)
+    vkontakte.api = api
+
+    data_dir = tempfile.mkdtemp(prefix="vk-chat-bench-")
+    rss_before = _rss_kb()
+    try:
+        module = _load_script(data_dir, {
+                                "vk-token": "bench",
+                                "history-lines": "50",
+                            })
+        module.plugin.UpdateAccounts()
+        account = module.plugin.GetAccounts()[0]
+        account.GetFriends().Update(api.friends)
+
+        elapsed = []
+        now = int(time.time())
+        for batch in batches:
+            messages = [ {"id": message_id, "user_id": uid, "date": now, "body": body} for message_id, uid, body in batch.messages ]
+
+            gc.collect()
+            start = time.time()
+            account.buffer_manager.DisplayMessagesSortedUid(module._sort_messages(messages))
+            elapsed.append((time.time() - start) * 1000)
+
+        total = sum(elapsed) / 1000
+        messages_count = scenario.batches * scenario.batch_size
+        elapsed.sort()
+
+        print("{0}: {1}".format(scenario.name, scenario.description))
+        print("  {0} messages from {1} friends in {2} batches".format(messages_count, scenario.friends, len(batches)))
+        print("  batch display time (ms): p50 {0:.1f}, p95 {1:.1f}, max {2:.1f}".format(_percentile(elapsed, 50), _percentile(elapsed, 95),
+                                                                                      elapsed[-1]))
+        print("  {0:.0f} messages/s, {1} lines printed, {2} buffers".format(messages_count / total if total else 0, len(weechat.state.lines),
+                                                                           len(weechat.state.buffers)))
+        _report_memory(module, rss_before)
+
+        module.CallbackPluginUnloaded()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def RunStartup(scenario, options):
+    """Load the script twice with the same data directory, and measure how long it took to start polling each time"""
+
+    server = fakevk.LongPollServer([])
+    api = fakevk.FakeApi(server, scenario.friends)
+    vkontakte.api = api
+
+    data_dir = tempfile.mkdtemp(prefix="vk-chat-bench-")
+    print("{0}: {1}".format(scenario.name, scenario.description))
+    try:
+        server.Start()
+
+        for cache in ("cold", "warm"):
+            module = _load_script(data_dir, {
+                                    "vk-token": "bench",
+                                    "max-requests-per-second": str(options.rate),
+                                })
+            loop = EventLoop(module, api, options.api_latency)
+            api.calls.clear()
+
+            start = time.time()
+            module.main()
+            account = module.plugin.GetAccounts()[0]
+            loop.Run(lambda: account.startup.IsPolling() and account.updates_poller.IsConnected(), 30)
+            elapsed = (time.time() - start) * 1000
+
+            print("  {0} cache: polling after {1:.0f} ms, {2} API requests ({3} calls), {4} friends".format(cache, elapsed,
+                    loop.profile.calls["CallbackVkApiResponse"], sum(count for method, count in api.calls.iteritems() if method != "execute"),
+                    len(account.GetFriends())))
+
+            module.CallbackPluginUnloaded()
+    finally:
+        server.Stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of vk-chat.py",
+                                     epilog="scenarios: " + ", ".join(u"{0} ({1})".format(s.name, s.description) for s in SCENARIOS.values()))
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help="scenarios to run, all of them by default")
+    parser.add_argument("--friends", type=int, help="amount of friends")
+    parser.add_argument("--strangers", type=float, help="fraction of messages sent by users who aren't friends")
+    parser.add_argument("--batches", type=int, help="amount of batches of updates")
+    parser.add_argument("--batch-size", type=int, help="amount of messages per batch")
+    parser.add_argument("--interval-ms", type=int, help="delay between two batches")
+    parser.add_argument("--failed-every", type=int, help="answer every Nth request with a failure")
+    parser.add_argument("--close-every", type=int, help="drop the connection on every Nth request")
+    parser.add_argument("--mode", choices=("fd", "timer"), help="long polling mode")
+    parser.add_argument("--accounts", type=int, help="amount of accounts")
+    parser.add_argument("--api-latency", type=int, default=50, help="delay before API calls are answered, in ms (default: 50)")
+    parser.add_argument("--rate", type=float, default=3, help="max-requests-per-second option of the script (default: 3)")
+    parser.add_argument("--max-lines-per-tick", type=int, default=0, help="max-lines-per-tick option of the script (default: 0)")
+    parser.add_argument("--trace", choices=("off", "on", "buffer", "file"), default="off", help="trace option of the script (default: off)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generator of messages")
+    options = parser.parse_args()
+
+    for name in options.scenarios:
+        if not name in SCENARIOS:
+            parser.error("unknown scenario: {0}".format(name))
+
+        overrides = dict((field, getattr(options, field)) for field in Scenario._fields if getattr(options, field, None) is not None)
+        scenario = SCENARIOS[name]._replace(**overrides)
+
+        if scenario.mode:
+            RunStream(scenario, options)
+        elif scenario.name == "startup":
+            RunStartup(scenario, options)
+        else:
+            RunRender(scenario, options)
+        print("")
+
+if __name__ == "__main__":
+    main()
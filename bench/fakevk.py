@@ -0,0 +1,373 @@
+##
+## Local stand-ins for the VK API and its long polling server
+##
+## The long polling server replays a stream of batches of updates, each one due at a given time after the server was started.
+## Batches that are due when a request arrives are sent at once, otherwise the request is held until the next one is.
+##
+## The replay stand-ins answer with the long polling responses and API results of a capture recorded by the script instead.
+##
+
+import json
+import time
+import collections
+import socket
+import threading
+
+## Flags of the messages sent by the server: unread, from a friend
+MESSAGE_FLAGS = 1
+## pts of the first event
+PTS_BASE = 1000
+
+class Batch(object):
+    def __init__(self, due, messages, events=()):
+        ## Seconds after the start of the server
+        self.due = due
+        ## List of (message_id, uid, body) tuples
+        self.messages = messages
+        ## Updates other than new messages, sent after them
+        self.events = events
+
+class LongPollServer(object):
+    """Replays batches of new messages, breaking the connection or answering with a failure every now and then"""
+
+    def __init__(self, batches, failed_every=0, close_every=0, wait=25):
+        super(LongPollServer, self).__init__()
+
+        self.batches = batches
+        self.failed_every = failed_every
+        self.close_every = close_every
+        self.wait = wait
+        self.start = None
+        self.requests = 0
+        self.connections = 0
+        self.failures = 0
+        self.closes = 0
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._clients = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(16)
+        self.address = "127.0.0.1:{0}".format(self._sock.getsockname()[1])
+
+    def Start(self):
+        self.start = time.time()
+
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def Stop(self):
+        self._stopped = True
+        self._sock.close()
+
+        for client in self._clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def GetCurrentTs(self):
+        """Timestamp of the next batch to be generated, the ones already due are skipped"""
+
+        now = time.time() - self.start if self.start else 0
+        return sum(1 for batch in self.batches if batch.due <= now)
+
+    def GetCurrentPts(self):
+        return PTS_BASE + sum(len(batch.messages) + len(batch.events) for batch in self.batches[:self.GetCurrentTs()])
+
+    def GetHistory(self, pts):
+        """Events that happened since the given pts, in the format of messages.getLongPollHistory"""
+
+        updates = [ update for batch in self.batches[:self.GetCurrentTs()] for update in self._batch_updates(batch) ][pts - PTS_BASE:]
+
+        return {
+            "history": [ update[:4] if update[0] == 4 else update for update in updates ],
+            "messages": {
+                "count": sum(1 for update in updates if update[0] == 4),
+                "items": [ {
+                            "id": update[1],
+                            "user_id": update[3],
+                            "date": update[4],
+                            "out": 0,
+                            "read_state": 0,
+                            "title": update[5],
+                            "body": update[6],
+                        } for update in updates if update[0] == 4 ],
+            },
+            "new_pts": pts + len(updates),
+        }
+
+    def IsFinished(self):
+        return self.GetCurrentTs() >= len(self.batches)
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                client, _ = self._sock.accept()
+            except socket.error:
+                return
+
+            self.connections += 1
+            self._clients.append(client)
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _read_request(self, client, data):
+        while not "\r\n\r\n" in data:
+            chunk = client.recv(4096)
+            if not chunk:
+                return None, data
+            data += chunk
+
+        request, data = data.split("\r\n\r\n", 1)
+        path = request.split(" ", 2)[1]
+        query = dict(arg.split("=", 1) for arg in path.partition("?")[2].split("&") if "=" in arg)
+
+        return query, data
+
+    def _next_action(self):
+        with self._lock:
+            self.requests += 1
+            if self.close_every and self.requests % self.close_every == 0:
+                self.closes += 1
+                return "close"
+            elif self.failed_every and self.requests % self.failed_every == 0:
+                self.failures += 1
+                return "failed"
+        return "updates"
+
+    def _batch_updates(self, batch):
+        updates = [ [4, message_id, MESSAGE_FLAGS, uid, int(self.start + batch.due), u" ... ", body, {}] for message_id, uid, body in batch.messages ]
+
+        return updates + list(batch.events)
+
+    def _updates(self, ts):
+        """Hold the request until batches following the given timestamp are due, return the next timestamp and their updates"""
+
+        hold_until = time.time() + self.wait
+        while not self._stopped and time.time() < hold_until and self.GetCurrentTs() <= ts:
+            time.sleep(.001)
+
+        current_ts = max(ts, self.GetCurrentTs())
+        updates = []
+        for batch in self.batches[ts:current_ts]:
+            updates.extend(self._batch_updates(batch))
+
+        return current_ts, updates
+
+    def _answer(self, query):
+        """Return the body of the answer to a request, None to drop the connection"""
+
+        action = self._next_action()
+        if action == "close":
+            return None
+        elif action == "failed":
+            return json.dumps({"failed": 2})
+
+        ts, updates = self._updates(int(query.get("ts", 0)))
+        result = {"ts": ts, "updates": updates}
+        if int(query.get("mode", 0)) & 32:
+            result["pts"] = PTS_BASE + sum(len(batch.messages) + len(batch.events) for batch in self.batches[:ts])
+
+        return json.dumps(result)
+
+    def _serve(self, client):
+        data = ""
+
+        try:
+            while not self._stopped:
+                query, data = self._read_request(client, data)
+                if query is None:
+                    break
+
+                body = self._answer(query)
+                if body is None:
+                    break
+
+                client.sendall("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {0}\r\n\r\n{1}".format(len(body), body))
+        except socket.error:
+            pass
+        finally:
+            client.close()
+
+class FakeApi(object):
+    """Answers the API calls made by the script with a fixed list of friends"""
+
+    def __init__(self, longpoll_server, friends_count):
+        super(FakeApi, self).__init__()
+
+        self.longpoll_server = longpoll_server
+        self.friends = [ {
+                            "id": uid,
+                            "first_name": u"First{0}".format(uid),
+                            "last_name": u"Last{0}".format(uid),
+                            "nickname": u"",
+                        } for uid in xrange(1, friends_count + 1) ]
+        self.calls = {}
+        self._next_message_id = 10 ** 9
+
+    def _execute(self, code):
+        """Run the calls of a VKScript "return [API.method({...}),...];" program"""
+
+        decoder = json.JSONDecoder()
+        results = []
+        position = code.find("API.")
+
+        while position >= 0:
+            start = code.index("(", position)
+            params, end = decoder.raw_decode(code, start + 1)
+            results.append(self.Call(code[position + 4:start], params)["response"])
+            position = code.find("API.", end)
+
+        return results
+
+    def _users(self, user_ids):
+        return [ {
+                    "id": uid,
+                    "first_name": u"First{0}".format(uid),
+                    "last_name": u"Last{0}".format(uid),
+                    "nickname": u"",
+                } for uid in (int(uid) for uid in unicode(user_ids).split(",") if uid) ]
+
+    def Call(self, method, params):
+        """Return the object the API would answer a call with"""
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "execute":
+            response = self._execute(params["code"])
+        elif method == "friends.get":
+            response = {"count": len(self.friends), "items": self.friends}
+        elif method == "users.get":
+            response = self._users(params.get("user_ids", ""))
+        elif method == "messages.getLongPollServer":
+            response = {"server": u"{0}/im".format(self.longpoll_server.address), "key": u"bench", "ts": self.longpoll_server.GetCurrentTs()}
+            if int(params.get("need_pts", 0)):
+                response["pts"] = self.longpoll_server.GetCurrentPts()
+        elif method == "messages.getLongPollHistory":
+            response = self.longpoll_server.GetHistory(int(params["pts"]))
+        elif method == "messages.send":
+            self._next_message_id += 1
+            response = self._next_message_id
+        elif method in ("messages.markAsRead",):
+            response = 1
+        else:
+            response = {"count": 0, "items": []}
+
+        return {"response": response}
+
+class FakeAccounts(object):
+    """Routes the API calls to the fake API of the account whose token they were made with"""
+
+    def __init__(self, apis):
+        super(FakeAccounts, self).__init__()
+
+        ## Fake APIs by token
+        self.apis = apis
+
+    def Call(self, method, params):
+        return self.apis[params.get("access_token")].Call(method, params)
+
+class ReplayLongPollServer(LongPollServer):
+    """Answers every request with the next long polling response of a capture, once it's due"""
+
+    def __init__(self, responses, wait=25):
+        super(ReplayLongPollServer, self).__init__([], wait=wait)
+
+        ## List of (due, response) tuples
+        self.responses = responses
+        self._next = 0
+
+    def IsFinished(self):
+        return self._next >= len(self.responses)
+
+    def _answer(self, query):
+        with self._lock:
+            self.requests += 1
+            index = self._next
+            if index < len(self.responses):
+                self._next += 1
+
+        if index >= len(self.responses):
+            ## Once the capture is over, the requests are held like an idle server would
+            hold_until = time.time() + self.wait
+            while not self._stopped and time.time() < hold_until:
+                time.sleep(.01)
+            return None if self._stopped else json.dumps({"ts": query.get("ts", 0), "updates": []})
+
+        due, response = self.responses[index]
+        while not self._stopped and time.time() < self.start + due:
+            time.sleep(.001)
+
+        return None if self._stopped else json.dumps(response)
+
+class ReplayApi(object):
+    """Answers the API calls with the results of a capture, in the order they were recorded for every method"""
+
+    def __init__(self, longpoll_server, results):
+        super(ReplayApi, self).__init__()
+
+        self.longpoll_server = longpoll_server
+        ## Queues of (response, error) tuples by method
+        self.results = collections.defaultdict(collections.deque)
+        for method, response, error in results:
+            self.results[method].append((response, error))
+        self.calls = {}
+        ## Calls made by the script that weren't recorded
+        self.misses = 0
+        self._next_message_id = 10 ** 9
+
+    def _execute(self, code):
+        decoder = json.JSONDecoder()
+        responses, errors = [], []
+        position = code.find("API.")
+
+        while position >= 0:
+            start = code.index("(", position)
+            params, end = decoder.raw_decode(code, start + 1)
+            result = self.Call(code[position + 4:start], params)
+            if "error" in result:
+                responses.append(False)
+                errors.append(result["error"])
+            else:
+                responses.append(result["response"])
+            position = code.find("API.", end)
+
+        result = {"response": responses}
+        if errors:
+            result["execute_errors"] = errors
+
+        return result
+
+    def Call(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "execute":
+            return self._execute(params["code"])
+
+        if self.results[method]:
+            response, error = self.results[method].popleft()
+            if error:
+                return {"error": {"error_code": error[0], "error_msg": error[1]}}
+
+            ## The script connects to the local server instead of the one it was given
+            if method == "messages.getLongPollServer":
+                response = dict(response, server=u"{0}/im".format(self.longpoll_server.address))
+
+            return {"response": response}
+
+        self.misses += 1
+        if method == "messages.getLongPollServer":
+            return {"response": {"server": u"{0}/im".format(self.longpoll_server.address), "key": u"replay", "ts": 0}}
+        elif method == "messages.send":
+            self._next_message_id += 1
+            return {"response": self._next_message_id}
+        elif method == "messages.markAsRead":
+            return {"response": 1}
+        elif method in ("users.get", "photos.getById", "docs.getById", "messages.getChatUsers"):
+            return {"response": []}
+
+        return {"response": {"count": 0, "items": []}}
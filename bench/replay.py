@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+##
+## Offline replay of a capture recorded by vk-chat.py (record option)
+##
+## The long polling responses of every account are served again by a local server, at the pace they were received at or
+## faster, and the API calls are answered with the results that were recorded. The time the script took to handle every
+## batch of updates is reported. No request is made to VK.
+##
+## Usage: python2 bench/replay.py <capture> [options], see --help
+##
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import collections
+
+import bench
+import vkontakte
+import fakevk
+
+def LoadCapture(path, session):
+    """Return the settings of a session of a capture, and its records by account: (long polling responses, API results)
+
+    The responses are given with the time they were received at, relative to the beginning of the session"""
+
+    sessions = []
+    with open(path) as f:
+        for line in f:
+            try:
+                timestamp, account_name, kind, payload = json.loads(line)
+            except ValueError:
+                ## The last record might have been cut short
+                continue
+
+            if kind == "session":
+                sessions.append((timestamp, payload, []))
+            elif sessions:
+                sessions[-1][2].append((timestamp, account_name, kind, payload))
+
+    if not sessions:
+        raise ValueError("no session recorded in {0}".format(path))
+
+    start, settings, records = sessions[session]
+    accounts = collections.OrderedDict()
+    for timestamp, account_name, kind, payload in records:
+        responses, results = accounts.setdefault(account_name, ([], []))
+        if kind == "longpoll":
+            responses.append((timestamp - start, payload))
+        elif kind == "api":
+            results.append((payload["method"], payload["response"], payload["error"]))
+
+    return len(sessions), settings, accounts
+
+def _time_batches(module, batches):
+    """Have the time every account takes to handle a batch of updates appended to batches"""
+
+    for account in module.plugin.GetAccounts():
+        def handle(updates, handle=account.longpoll_events.Handle, name=account.name):
+            start = time.time()
+            handle(updates)
+            batches.append((start, name, len(updates), (time.time() - start) * 1000))
+
+        account.longpoll_events.Handle = handle
+
+def Replay(options):
+    sessions_count, settings, accounts = LoadCapture(options.capture, options.session)
+    speed = options.speed or float("inf")
+
+    config = {
+        "longpoll-mode": options.mode or settings.get("longpoll-mode", "fd"),
+        "max-requests-per-second": str(options.rate),
+        "max-lines-per-tick": str(options.max_lines_per_tick),
+    }
+
+    ## Every account has its own server, and the API calls made with its token are answered with its results
+    servers, apis = [], {}
+    for name, (responses, results) in accounts.iteritems():
+        server = fakevk.ReplayLongPollServer([ (due / speed, response) for due, response in responses ])
+        servers.append(server)
+
+        token = u"replay-{0}".format(name) if name else u"replay"
+        apis[token] = fakevk.ReplayApi(server, results)
+        config["vk-token.{0}".format(name.encode("utf-8")) if name else "vk-token"] = token.encode("utf-8")
+    config["accounts"] = ",".join(name.encode("utf-8") for name in accounts if name)
+
+    api = fakevk.FakeAccounts(apis)
+    vkontakte.api = api
+
+    data_dir = tempfile.mkdtemp(prefix="vk-chat-replay-")
+    try:
+        module = bench._load_script(data_dir, config)
+        loop = bench.EventLoop(module, api, options.api_latency)
+
+        for server in servers:
+            server.Start()
+        module.main()
+
+        batches = []
+        _time_batches(module, batches)
+
+        ## The script gets a few seconds to handle the last responses, polling with a timer takes up to two ticks of 5s
+        duration = max([ due for server in servers for due, _ in server.responses ] or [0])
+        drain = 11 if config["longpoll-mode"] == "timer" else 2
+        finished = []
+
+        def done():
+            if not finished and all(server.IsFinished() for server in servers):
+                finished.append(time.time())
+            return finished and time.time() > finished[0] + drain
+
+        start = time.time()
+        loop.Run(done, duration + drain + options.timeout)
+        elapsed = time.time() - start
+
+        elapsed_ms = sorted(batch[3] for batch in batches)
+        updates = sum(batch[2] for batch in batches)
+        processing = sum(elapsed_ms) / 1000
+
+        print("replay: {0} (session {1} of {2}, recorded by vk-chat {3}, {4} mode)".format(options.capture,
+                options.session % sessions_count + 1, sessions_count, settings.get("version"), config["longpoll-mode"]))
+        print("  {0} account(s), {1} long polling responses, {2} API results".format(len(accounts),
+                sum(len(responses) for responses, _ in accounts.itervalues()), sum(len(results) for _, results in accounts.itervalues())))
+        print("  {0:.1f}s of traffic replayed in {1:.1f}s, {2} responses served, {3} API calls not in the capture".format(
+                max([ due for responses, _ in accounts.itervalues() for due, _ in responses ] or [0]), elapsed,
+                sum(server._next for server in servers),
+                sum(api_.misses for api_ in apis.itervalues())))
+        print("  batches: {0} handled, {1} updates, {2:.0f} updates/s processed".format(len(batches), updates,
+                updates / processing if processing else 0))
+        print("  processing time per batch (ms): p50 {0:.2f}, p95 {1:.2f}, p99 {2:.2f}, max {3:.2f}".format(
+                bench._percentile(elapsed_ms, 50), bench._percentile(elapsed_ms, 95), bench._percentile(elapsed_ms, 99),
+                elapsed_ms[-1] if elapsed_ms else 0))
+
+        if batches and options.slowest:
+            print("  slowest batches:")
+            for batch_start, name, count, ms in sorted(batches, key=lambda batch: batch[3], reverse=True)[:options.slowest]:
+                print("    +{0:>8.3f}s {1:<12} {2:>5} updates {3:>8.2f} ms".format(batch_start - start, name or "(default)", count, ms))
+
+        bench._report_profile(loop.profile)
+
+        module.CallbackPluginUnloaded()
+    finally:
+        for server in servers:
+            server.Stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    ## The replay fails if the batches took longer to handle than allowed
+    if options.fail_above and bench._percentile(elapsed_ms, 95) > options.fail_above:
+        print("p95 processing time per batch above {0} ms".format(options.fail_above))
+        return 1
+
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline replay of a capture recorded by vk-chat.py")
+    parser.add_argument("capture", help="capture file, vk-chat.capture in the weechat data directory")
+    parser.add_argument("--session", type=int, default=-1, help="index of the session of the capture to replay (default: the last one)")
+    parser.add_argument("--speed", type=float, default=1, help="speed factor of the replay, 0 to serve the responses right away (default: 1)")
+    parser.add_argument("--mode", choices=("fd", "timer"), help="long polling mode (default: the one the capture was recorded with)")
+    parser.add_argument("--api-latency", type=int, default=0, help="delay before API calls are answered, in ms (default: 0)")
+    parser.add_argument("--rate", type=float, default=3, help="max-requests-per-second option of the script (default: 3)")
+    parser.add_argument("--max-lines-per-tick", type=int, default=0, help="max-lines-per-tick option of the script (default: 0)")
+    parser.add_argument("--slowest", type=int, default=5, help="amount of slowest batches to list (default: 5)")
+    parser.add_argument("--timeout", type=int, default=60, help="seconds allowed past the end of the capture (default: 60)")
+    parser.add_argument("--fail-above", type=float, help="exit with an error if the p95 processing time per batch exceeds this, in ms")
+    options = parser.parse_args()
+
+    if not os.path.isfile(options.capture):
+        parser.error("no such file: {0}".format(options.capture))
+
+    sys.exit(Replay(options))
+
+if __name__ == "__main__":
+    main()
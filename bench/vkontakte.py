@@ -0,0 +1,35 @@
+##
+## Stand-in for the vkontakte module, used to run vk-chat.py outside of WeeChat
+##
+## Synchronous calls are answered by the same fake API as the requests the script makes in the background.
+##
+
+class VKError(Exception):
+    pass
+
+## Object answering the calls, set by bench.py
+api = None
+
+class _Method(object):
+    def __init__(self, name, token):
+        self._name = name
+        self._token = token
+
+    def __getattr__(self, name):
+        return _Method(u"{0}.{1}".format(self._name, name), self._token)
+
+    def __call__(self, **kwargs):
+        kwargs["access_token"] = self._token
+        result = api.Call(self._name, kwargs)
+        if "error" in result:
+            raise VKError(result["error"].get("error_msg"))
+        return result["response"]
+
+class API(object):
+    def __init__(self, token=None, v=None, **kwargs):
+        if not token:
+            raise VKError("no token")
+        self._token = token
+
+    def __getattr__(self, name):
+        return _Method(name, self._token)
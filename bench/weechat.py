@@ -0,0 +1,233 @@
+##
+## Stand-in for the weechat module, used to run vk-chat.py outside of WeeChat
+##
+## Hooks are recorded and serviced by the event loop of bench.py, the callbacks they name are looked up in the
+## script module, and the lines printed are kept with the time they were displayed at.
+##
+
+import time
+
+WEECHAT_RC_OK = 0
+WEECHAT_RC_OK_EAT = 1
+WEECHAT_RC_ERROR = -1
+
+WEECHAT_HOOK_PROCESS_RUNNING = -1
+WEECHAT_HOOK_PROCESS_ERROR = -2
+
+WEECHAT_HOOK_CONNECT_OK = 0
+WEECHAT_HOOK_CONNECT_ADDRESS_NOT_FOUND = 1
+WEECHAT_HOOK_CONNECT_CONNECTION_REFUSED = 3
+
+WEECHAT_LIST_POS_SORT = "sort"
+WEECHAT_LIST_POS_BEGINNING = "beginning"
+WEECHAT_LIST_POS_END = "end"
+
+class Hook(object):
+    def __init__(self, type_, callback_name, data, **kwargs):
+        self.type = type_
+        self.callback_name = callback_name
+        self.data = data
+        self.__dict__.update(kwargs)
+
+class State(object):
+    """Everything the script did through the weechat module"""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.config = {}
+        self.hooks = {}
+        self.buffers = {}
+        ## List of (time, buffer, tags, message) tuples
+        self.lines = []
+        self.core_lines = []
+        self.unload_callback = None
+        self._next_pointer = 0
+
+    def NewPointer(self, prefix):
+        self._next_pointer += 1
+        return "0x{0}{1:x}".format(prefix, self._next_pointer)
+
+state = State(".")
+
+def reset(data_dir, config=None):
+    global state
+
+    state = State(data_dir)
+    state.config.update(config or {})
+
+    return state
+
+## Registration and output
+def register(name, author, version, license_, description, shutdown_function, charset):
+    state.unload_callback = shutdown_function
+    return 1
+
+def prnt(buffer_, message):
+    if buffer_:
+        state.lines.append((time.time(), buffer_, "", message))
+    else:
+        state.core_lines.append(message)
+
+def prnt_date_tags(buffer_, date, tags, message):
+    state.lines.append((time.time(), buffer_, tags, message))
+
+def color(name):
+    return ""
+
+def info_get(name, arguments):
+    if name in ("weechat_data_dir", "weechat_dir"):
+        return state.data_dir
+    return ""
+
+## Configuration
+def config_is_set_plugin(option):
+    return option in state.config
+
+def config_get_plugin(option):
+    return state.config.get(option, "")
+
+def config_set_plugin(option, value):
+    state.config[option] = value
+    return 1
+
+def config_set_desc_plugin(option, description):
+    pass
+
+def config_string(option):
+    return ""
+
+def config_get(option):
+    return option
+
+## Hooks
+def _hook(type_, callback_name, data, **kwargs):
+    pointer = state.NewPointer("h")
+    state.hooks[pointer] = Hook(type_, callback_name, data, **kwargs)
+    return pointer
+
+def hook_timer(interval, align_second, max_calls, callback, data):
+    return _hook("timer", callback, data, interval=interval, max_calls=max_calls, calls=0,
+                    next_call=time.time() + interval / 1000.0)
+
+def hook_fd(fd, flag_read, flag_write, flag_exception, callback, data):
+    return _hook("fd", callback, data, fd=fd, read=flag_read, write=flag_write)
+
+def hook_connect(proxy, address, port, ipv6, retry, local_hostname, callback, data):
+    return _hook("connect", callback, data, address=address, port=port)
+
+def hook_process_hashtable(command, options, timeout, callback, data):
+    return _hook("process", callback, data, command=command, options=options, created=time.time())
+
+def hook_process(command, timeout, callback, data):
+    return hook_process_hashtable(command, {}, timeout, callback, data)
+
+def hook_command(command, description, args, args_description, completion, callback, data):
+    return _hook("command", callback, data, command=command)
+
+def hook_completion(completion, description, callback, data):
+    return _hook("completion", callback, data, completion=completion)
+
+def hook_config(option, callback, data):
+    return _hook("config", callback, data, option=option)
+
+def hook_signal(signal, callback, data):
+    return _hook("signal", callback, data, signal=signal)
+
+def hook_infolist(name, description, pointer_description, args_description, callback, data):
+    return _hook("infolist", callback, data, name=name)
+
+def unhook(hook):
+    state.hooks.pop(hook, None)
+
+def hook_completion_get_string(completion, property_):
+    return ""
+
+def hook_completion_list_add(completion, word, nick_completion, where):
+    pass
+
+## Buffers
+def buffer_search(plugin, name):
+    for pointer, buffer_ in state.buffers.iteritems():
+        if buffer_["name"] == name:
+            return pointer
+    return ""
+
+def buffer_new(name, input_callback, input_data, close_callback, close_data):
+    pointer = state.NewPointer("b")
+    state.buffers[pointer] = {
+        "name": name,
+        "close_callback": close_callback,
+    }
+    return pointer
+
+def buffer_set(buffer_, property_, value):
+    if buffer_ in state.buffers:
+        state.buffers[buffer_][property_] = value
+
+def buffer_get_string(buffer_, property_):
+    if not buffer_ in state.buffers:
+        return ""
+    if property_.startswith("localvar_"):
+        return state.buffers[buffer_].get("localvar_set_" + property_[len("localvar_"):], "")
+    return state.buffers[buffer_].get(property_, "")
+
+def buffer_clear(buffer_):
+    state.lines = [ line for line in state.lines if line[1] != buffer_ ]
+
+def nicklist_remove_all(buffer_):
+    if buffer_ in state.buffers:
+        state.buffers[buffer_]["nicks"] = []
+
+def nicklist_add_nick(buffer_, group, name, color, prefix, prefix_color, visible):
+    if buffer_ in state.buffers:
+        state.buffers[buffer_].setdefault("nicks", []).append(name)
+    return name
+
+def window_get_pointer(window, property_):
+    return ""
+
+## The lines aren't exposed through hdata, looking one up always fails
+def hdata_get(name):
+    return name
+
+def hdata_get_list(hdata, name):
+    return ""
+
+def hdata_check_pointer(hdata, list_, pointer):
+    return 0
+
+def hdata_pointer(hdata, pointer, name):
+    return ""
+
+def hdata_integer(hdata, pointer, name):
+    return 0
+
+def hdata_string(hdata, pointer, name):
+    return ""
+
+def hdata_move(hdata, pointer, count):
+    return ""
+
+def hdata_update(hdata, pointer, hashtable):
+    return 0
+
+## Infolists
+def infolist_new():
+    return []
+
+def infolist_new_item(infolist):
+    infolist.append({})
+    return infolist[-1]
+
+def infolist_new_var_string(item, name, value):
+    item[name] = value
+
+def infolist_new_var_integer(item, name, value):
+    item[name] = value
+
+## Bar items
+def bar_item_new(name, build_callback, data):
+    return _hook("bar_item", build_callback, data, name=name)
+
+def bar_item_update(name):
+    pass
@@ -10,15 +10,30 @@
 ## http://vk.com/app3382328_185656651
 ##
 
+import os
 import re
 import time
 import json
+import errno
+import random
 import socket
+import urllib
+import heapq
+import bisect
+import collections
 import select
-import inspect
+import functools
+import unicodedata
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 import weechat
-import vkontakte
+
+## The vkontakte module is only needed for synchronous calls, it's imported when the first one is made
+vkontakte = None
 
 ## Class definitions and their global instance
 class Script:
@@ -29,23 +44,11 @@ class Script:
     DESCRIPTION = "Chat with your friends on Vkontakte"
 
 class Util:
-    DEBUG = False
-
-    @staticmethod
-    def GetParentFunctionName():
-        return inspect.stack()[2][3]
-
     @staticmethod
     def Log(s):
         log_str = u"{0}: {1}".format(Script.NAME, s)
         weechat.prnt("", log_str.encode("utf-8"))
 
-    @staticmethod
-    def Debug(s):
-        if Util.DEBUG:
-            log_str = u"[{0}][{1}]: {2}".format(time.ctime(), Util.GetParentFunctionName(), s)
-            Util.Log(log_str)
-
     @staticmethod
     def GetConfigOption(option_name, type_=str):
         real_option_name = "python.{0}.{1}".format(Script.NAME, option_name)
@@ -65,6 +68,261 @@ class Util:
 
         weechat.config_set_plugin(option_name, option_value)
 
+    @staticmethod
+    def GetDataPath(filename):
+        """Return the path of a file in the weechat data directory, which is created if it doesn't exist"""
+
+        data_dir = weechat.info_get("weechat_data_dir", "") or weechat.info_get("weechat_dir", "")
+        if data_dir and not os.path.isdir(data_dir):
+            try:
+                os.makedirs(data_dir)
+            except OSError as e:
+                Util.Log(u"unable to create the directory {0}: {1}".format(data_dir.decode("utf-8"), e))
+
+        return os.path.join(data_dir, filename)
+
+    @staticmethod
+    def OpenDataFile(filename):
+        """Open a file of the weechat data directory for appending, line buffered for the lines to be written as they happen
+
+        None is returned if the file couldn't be opened"""
+
+        path = Util.GetDataPath(filename)
+
+        try:
+            return open(path, "a", 1)
+        except IOError as e:
+            Util.Log(u"unable to open {0}: {1}".format(path.decode("utf-8"), e))
+
+        return None
+
+class Metrics(object):
+    """Counters and latency histograms, cheap enough to be always enabled"""
+
+    ## Upper bounds of the buckets of the histograms, in milliseconds
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, float("inf"))
+
+    def __init__(self):
+        super(Metrics, self).__init__()
+
+        self.Reset()
+
+    def Reset(self):
+        self._counters = collections.defaultdict(int)
+        ## Every histogram holds the count of every bucket, the total and maximum latencies
+        self._histograms = {}
+        self._since = time.time()
+
+    def Increment(self, name, value=1):
+        self._counters[name] += value
+
+    def Observe(self, name, latency_ms):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = [[0] * len(self.BUCKETS_MS), 0., 0.]
+
+        histogram[0][bisect.bisect_left(self.BUCKETS_MS, latency_ms)] += 1
+        histogram[1] += latency_ms
+        histogram[2] = max(histogram[2], latency_ms)
+
+    def Timed(self, name):
+        """Decorator recording the time spent in a function"""
+
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    elapsed_ms = (time.time() - start) * 1000
+                    self.Observe(name, elapsed_ms)
+                    if tracer.enabled:
+                        tracer.Event(name, ms=elapsed_ms)
+            return wrapper
+
+        return decorator
+
+    def Percentile(self, name, percentile):
+        """Return the upper bound of the bucket holding the given percentile of the latencies, capped by the maximum latency"""
+
+        buckets, _, max_latency = self._histograms[name]
+
+        rank = sum(buckets) * percentile / 100.
+        seen = 0
+        for i, count in enumerate(buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(self.BUCKETS_MS[i], max_latency)
+
+        return max_latency
+
+    def GetCounters(self):
+        return sorted(self._counters.iteritems())
+
+    def GetHistograms(self):
+        """Return the name, count, average, p50, p95, p99 and maximum latencies of every histogram"""
+
+        histograms = []
+        for name, (buckets, total, max_latency) in sorted(self._histograms.iteritems()):
+            count = sum(buckets)
+            histograms.append((name, count, total / count, self.Percentile(name, 50), self.Percentile(name, 95),
+                                self.Percentile(name, 99), max_latency))
+
+        return histograms
+
+    def GetUptime(self):
+        return time.time() - self._since
+
+metrics = Metrics()
+
+class Tracer(object):
+    """Records structured events in a bounded ring buffer, dumped on demand and optionally streamed to a buffer or a file
+
+    Call sites check the enabled attribute before building an event, tracing costs next to nothing while it's disabled"""
+
+    MODE_OFF = "off"
+    ## Events are only kept in memory
+    MODE_ON = "on"
+    MODE_BUFFER = "buffer"
+    MODE_FILE = "file"
+
+    BUFFER_NAME = "vk-chat.trace"
+    FILENAME = "vk-chat.trace.log"
+    DEFAULT_SIZE = 1000
+
+    def __init__(self):
+        super(Tracer, self).__init__()
+
+        self.enabled = False
+        self._mode = self.MODE_OFF
+        ## List of (timestamp, name, fields) tuples
+        self._events = collections.deque(maxlen=self.DEFAULT_SIZE)
+        self._buffer = None
+        self._file = None
+
+    def _close_file(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def Configure(self, mode, size):
+        if not mode in (self.MODE_OFF, self.MODE_ON, self.MODE_BUFFER, self.MODE_FILE):
+            Util.Log(u"invalid trace mode: {0}".format(mode))
+            mode = self.MODE_OFF
+
+        if size and size > 0 and size != self._events.maxlen:
+            self._events = collections.deque(self._events, maxlen=size)
+
+        if mode != self.MODE_FILE:
+            self._close_file()
+        elif not self._file:
+            self._file = Util.OpenDataFile(self.FILENAME)
+
+        if mode != self.MODE_BUFFER:
+            self._buffer = None
+        elif not self._buffer:
+            self._buffer = weechat.buffer_search("python", self.BUFFER_NAME) or weechat.buffer_new(self.BUFFER_NAME, "", "",
+                                                                                                    "CallbackTraceBufferClose", "")
+            weechat.buffer_set(self._buffer, "title", "vk-chat trace")
+
+        self._mode = mode
+        self.enabled = mode != self.MODE_OFF
+
+    @staticmethod
+    def Format(event):
+        timestamp, name, fields = event
+
+        return u"{0}.{1:03d} {2} {3}".format(time.strftime("%H:%M:%S", time.localtime(timestamp)), int(timestamp * 1000) % 1000, name,
+                                            u" ".join(u"{0}={1:.1f}".format(k, v) if isinstance(v, float) else u"{0}={1}".format(k, v)
+                                                        for k, v in sorted(fields.iteritems())))
+
+    def Event(self, name, **fields):
+        event = (time.time(), name, fields)
+        self._events.append(event)
+
+        if self._buffer:
+            weechat.prnt(self._buffer, self.Format(event).encode("utf-8"))
+        if self._file:
+            ## One JSON object per line
+            self._file.write(json.dumps(dict(fields, time=round(event[0], 6), event=name)) + "\n")
+
+    def GetEvents(self):
+        return list(self._events)
+
+    def Clear(self):
+        self._events.clear()
+
+    def OnBufferClosed(self):
+        self._buffer = None
+
+    def Stop(self):
+        self._close_file()
+        self._buffer = None
+        self.enabled = False
+
+tracer = Tracer()
+
+class Recorder(object):
+    """Appends the long polling responses and the API results, with the time they were received at, to a capture file
+
+    Every line of the file is a compact JSON array: [time, account, kind, payload]. A capture can be replayed offline by
+    bench/replay.py"""
+
+    MODE_OFF = "off"
+    MODE_ON = "on"
+
+    FILENAME = "vk-chat.capture"
+
+    KIND_SESSION = "session"
+    KIND_LONGPOLL = "longpoll"
+    KIND_API = "api"
+
+    def __init__(self):
+        super(Recorder, self).__init__()
+
+        self.enabled = False
+        self._file = None
+
+    def Configure(self, mode):
+        if not mode in (self.MODE_OFF, self.MODE_ON):
+            Util.Log(u"invalid record mode: {0}".format(mode))
+            mode = self.MODE_OFF
+
+        if mode == self.MODE_OFF:
+            self.Stop()
+            return
+
+        if self._file:
+            return
+
+        self._file = Util.OpenDataFile(self.FILENAME)
+        if not self._file:
+            return
+
+        self.enabled = True
+        ## The records that follow are replayed relative to the beginning of the session
+        self.Record(u"", self.KIND_SESSION, {
+                        "version": Script.VERSION,
+                        "longpoll-mode": Util.GetConfigOption("longpoll-mode"),
+                    })
+
+    def Record(self, account_name, kind, payload):
+        line = json.dumps([ round(time.time(), 3), account_name, kind, payload ], separators=(",", ":"), ensure_ascii=False)
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+
+        self._file.write(line + "\n")
+
+    def Stop(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+        self.enabled = False
+
+recorder = Recorder()
+
 class VkMessageFlag:
     UNREAD = 1
     OUTBOX = 2
@@ -77,339 +335,3419 @@ class VkMessageFlag:
     FIXED = 256
     MEDIA = 512
 
-class Plugin(object):
-    DEFAULT_OPTIONS = [
-        ("vk-token", ""),
-        ("max-friends-suggestions", "10"),
-    ]
+class VkEventCode:
+    FLAGS_REPLACE = 1
+    FLAGS_SET = 2
+    FLAGS_RESET = 3
+    MESSAGE_NEW = 4
+    INBOX_READ = 6
+    OUTBOX_READ = 7
+    FRIEND_ONLINE = 8
+    FRIEND_OFFLINE = 9
+    ## The members or the title of a group chat changed
+    CHAT_CHANGED = 51
+    USER_TYPING = 61
+    CHAT_TYPING = 62
+
+class VkPeer:
+    ## Group chats are designated by the peer id of this value plus their chat id
+    CHAT_BASE = 2000000000
+
+    @staticmethod
+    def IsChat(peer_id):
+        return int(peer_id) > VkPeer.CHAT_BASE
+
+    @staticmethod
+    def GetChatId(peer_id):
+        return int(peer_id) - VkPeer.CHAT_BASE
+
+    @staticmethod
+    def GetMessagePeerId(message):
+        """Return the peer id of a message returned by the API, whose user_id is the sender in group chats"""
+
+        return VkPeer.CHAT_BASE + message["chat_id"] if "chat_id" in message else message["user_id"]
+
+    @staticmethod
+    def GetParams(peer_id):
+        """Return the parameter designating a conversation in the API calls"""
+
+        if VkPeer.IsChat(peer_id):
+            return {"chat_id": VkPeer.GetChatId(peer_id)}
+
+        return {"user_id": int(peer_id)}
+
+## Records the updates of the long polling server are decoded into, LENGTH is the minimum amount of fields of an update
+class MessageEvent(object):
+    __slots__ = ("code", "id", "flags", "peer_id", "date", "title", "text", "attachments", "from_id")
+    LENGTH = 7
+
+    def __init__(self, update):
+        self.code, self.id, self.flags, self.peer_id, self.date, self.title, self.text = update[:7]
+        self.attachments = update[7] if len(update) > 7 else None
+        ## The sender of a message in a group chat is given along with the attachments
+        self.from_id = int(self.attachments["from"]) if self.attachments and "from" in self.attachments else self.peer_id
+
+class FlagsEvent(object):
+    __slots__ = ("code", "id", "flags", "peer_id")
+    LENGTH = 3
+
+    def __init__(self, update):
+        self.code, self.id, self.flags = update[:3]
+        self.peer_id = update[3] if len(update) > 3 else None
+
+class ReadEvent(object):
+    __slots__ = ("code", "peer_id", "id")
+    LENGTH = 3
+
+    def __init__(self, update):
+        ## Messages up to the given id were read
+        self.code, self.peer_id, self.id = update[:3]
+
+class ChatEvent(object):
+    __slots__ = ("code", "chat_id", "peer_id")
+    LENGTH = 2
+
+    def __init__(self, update):
+        self.code, self.chat_id = update[:2]
+        self.peer_id = VkPeer.CHAT_BASE + self.chat_id
+
+class PresenceEvent(object):
+    __slots__ = ("code", "uid")
+    LENGTH = 2
+
+    def __init__(self, update):
+        self.code = update[0]
+        ## The id of the user is negated
+        self.uid = abs(update[1])
+
+class TypingEvent(object):
+    __slots__ = ("code", "uid", "peer_id")
+    LENGTH = 2
+
+    def __init__(self, update):
+        self.code, self.uid = update[:2]
+        ## Typing in a group chat, whose id is given as the third field, is notified with another code
+        self.peer_id = VkPeer.CHAT_BASE + update[2] if self.code == VkEventCode.CHAT_TYPING and len(update) > 2 else self.uid
+
+class FriendsStore(object):
+    """Friends of the authenticated user, indexed by uid"""
+
+    FIELDS = ("first_name", "last_name", "nickname")
 
     def __init__(self):
-        super(Plugin, self).__init__()
+        super(FriendsStore, self).__init__()
 
-        self._timers = {}
-        self._authed_vk = False
-        self._vk_api = None
-        self._friends = []
+        self._by_uid = {}
+        self._uids = []
+        ## Incremented every time the contents of the store change
+        self.revision = 0
 
-    def IsAuthedVkontakte(self):
-        return self._authed_vk
+    def __len__(self):
+        return len(self._uids)
 
-    def AuthVkontakte(self, token):
-        if self._authed_vk:
-            return True
-        elif not token:
+    def __iter__(self):
+        for uid in self._uids:
+            yield self._by_uid[uid]
+
+    def __contains__(self, uid):
+        return uid in self._by_uid
+
+    def Get(self, uid):
+        return self._by_uid.get(uid)
+
+    def Update(self, friends):
+        """Refresh the store in place with the list of friends returned by the API, and return the uids that were added, changed and removed"""
+
+        added, changed = [], []
+        uids = []
+
+        for friend in friends:
+            uid = friend["id"]
+            uids.append(uid)
+
+            known_friend = self._by_uid.get(uid)
+            if known_friend is None:
+                self._by_uid[uid] = friend
+                added.append(uid)
+            elif any(known_friend.get(k) != friend.get(k) for k in self.FIELDS):
+                ## Update the existing entry so that references to it remain valid
+                known_friend.update(friend)
+                changed.append(uid)
+
+        removed = set(self._by_uid).difference(uids)
+        for uid in removed:
+            del self._by_uid[uid]
+
+        if added or changed or removed or uids != self._uids:
+            self.revision += 1
+        self._uids = uids
+
+        return added, changed, list(removed)
+
+class FriendsNameIndex(object):
+    """Case folded prefix index over the names of the friends, rebuilt when the store changes"""
+
+    def __init__(self, friends):
+        super(FriendsNameIndex, self).__init__()
+
+        self._friends = friends
+        self._revision = None
+        self._rank = {}
+        self._first_names = ([], [])
+        self._last_names = ([], [])
+
+    @staticmethod
+    def Normalize(name):
+        return unicodedata.normalize("NFKC", name or u"").strip().lower()
+
+    def _build(self, field):
+        entries = sorted((self.Normalize(friend[field]), friend["id"]) for friend in self._friends)
+
+        return [ k for k, _ in entries ], [ uid for _, uid in entries ]
+
+    def _refresh(self):
+        if self._revision == self._friends.revision:
+            return
+
+        self._rank = dict((friend["id"], i) for i, friend in enumerate(self._friends))
+        self._first_names = self._build("first_name")
+        self._last_names = self._build("last_name")
+        self._revision = self._friends.revision
+
+    def _lookup(self, names, prefix):
+        keys, uids = names
+        prefix = self.Normalize(prefix)
+
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            yield uids[i]
+            i += 1
+
+    def Match(self, first_name, last_name=u""):
+        """Return the friends whose names start with the given prefixes, in the order of the store"""
+
+        self._refresh()
+
+        uids = set(self._lookup(self._first_names, first_name))
+        if last_name:
+            uids.intersection_update(self._lookup(self._last_names, last_name))
+
+        return [ self._friends.Get(uid) for uid in sorted(uids, key=self._rank.get) ]
+
+    def CompleteFirstNames(self, prefix):
+        self._refresh()
+
+        return set(self._friends.Get(uid)["first_name"] for uid in self._lookup(self._first_names, prefix))
+
+    def CompleteLastNames(self, prefix, first_name=u""):
+        return set(friend["last_name"] for friend in self.Match(first_name, prefix))
+
+class VkApiError(object):
+    ## Errors worth retrying the request for: unknown error, too many requests per second, flood control, internal server error
+    TRANSIENT_CODES = (1, 6, 9, 10)
+
+    def __init__(self, code, message):
+        super(VkApiError, self).__init__()
+
+        ## A code of None designates an error that happened before the API could answer
+        self.code = code
+        self.message = message
+
+    def IsTransient(self):
+        return self.code is None or self.code in self.TRANSIENT_CODES
+
+    def __unicode__(self):
+        return u"{0} ({1})".format(self.message, self.code)
+
+class VkAsyncApi(object):
+    """Calls VK API methods in a process spawned by WeeChat, the result is handed to a callback"""
+
+    URL = "https://api.vk.com/method/{0}"
+    ## XXX: this plugin relies on version 5.21 of the VK API
+    VERSION = "5.21"
+    TIMEOUT_MS = 30 * 1000
+
+    def __init__(self, account):
+        super(VkAsyncApi, self).__init__()
+
+        self._account = account
+        self._token = None
+        self._next_request_id = 0
+        self._requests = {}
+
+    def SetToken(self, token):
+        self._token = token
+
+    def Call(self, method, params, callback, full_result=False):
+        """Call an API method, callback(response, error) is called once the result is known
+
+        With full_result, the whole object returned by the API is handed to the callback instead of its response"""
+
+        params = dict((k, v.encode("utf-8") if isinstance(v, unicode) else v) for k, v in params.iteritems())
+        params["access_token"] = self._token
+        params["v"] = self.VERSION
+
+        request_id = str(self._next_request_id)
+        self._next_request_id += 1
+
+        hook = weechat.hook_process_hashtable("url:{0}".format(self.URL.format(method)), {
+                                                "postfields": urllib.urlencode(params),
+                                            }, self.TIMEOUT_MS, "CallbackVkApiResponse", self._account.GetHookData(request_id))
+        if not hook:
+            callback(None, VkApiError(None, u"unable to start the request"))
             return False
 
+        self._requests[request_id] = (method, callback, full_result, [], time.time())
+
+        return True
+
+    def OnOutput(self, request_id, return_code, out, err):
+        if not request_id in self._requests:
+            return
+
+        method, callback, full_result, chunks, start = self._requests[request_id]
+        chunks.append(out)
+        metrics.Increment("http.bytes_received", len(out))
+
+        ## Long outputs are handed over in several chunks
+        if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+            return
+
+        del self._requests[request_id]
+        metrics.Observe("http.request", (time.time() - start) * 1000)
+        if return_code != 0:
+            metrics.Increment("http.errors")
+            callback(None, VkApiError(None, u"request failed: {0}".format(err.decode("utf-8", "ignore") or return_code)))
+            return
+
         try:
-            ## XXX: this plugin relies on version 5.21 of the VK API
-            self._vk_api = vkontakte.API(token=token, v="5.21")
-        except vkontakte.VKError as e:
-            Util.Log("VKError: unable to log in")
+            result = json.loads("".join(chunks))
+        except ValueError as e:
+            callback(None, VkApiError(None, u"invalid response"))
+            return
+
+        if "error" in result:
+            callback(None, VkApiError(result["error"].get("error_code"), result["error"].get("error_msg", u"")))
+        elif not "response" in result:
+            callback(None, VkApiError(None, u"invalid response"))
+        elif full_result:
+            callback(result, None)
+        else:
+            callback(result["response"], None)
+
+class VkRequestScheduler(object):
+    """Sends API requests in order of priority, without exceeding the amount of requests per second VK allows"""
+
+    PRIORITY_SEND = 0
+    PRIORITY_DISPLAY = 1
+    PRIORITY_READ = 2
+    PRIORITY_LONGPOLL = 3
+    PRIORITY_BACKGROUND = 4
+
+    ## Error code returned by the API when too many requests were made
+    ERROR_TOO_MANY_REQUESTS = 6
+    MAX_RETRIES = 5
+
+    def __init__(self, account, async_api):
+        super(VkRequestScheduler, self).__init__()
+
+        self._account = account
+        self._async_api = async_api
+        self._queue = []
+        self._next_seq = 0
+        self._rate = 3.
+        self._tokens = self._rate
+        self._last_refill = time.time()
+        self._timer = None
+
+    def SetRate(self, requests_per_second):
+        self._rate = max(float(requests_per_second), .1)
+        self._tokens = min(self._tokens, self._rate)
+
+    def _refill(self):
+        now = time.time()
+
+        self._tokens = min(self._rate, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def _push(self, request):
+        heapq.heappush(self._queue, (request[0], self._next_seq, time.time(), request))
+        self._next_seq += 1
+
+    def _on_result(self, request, response, error):
+        priority, method, params, callback, full_result, retries = request
+
+        if error and error.code == self.ERROR_TOO_MANY_REQUESTS and retries < self.MAX_RETRIES:
+            metrics.Increment("scheduler.throttled")
+            if tracer.enabled:
+                tracer.Event("scheduler.throttled", account=self._account.name, method=method, retries=retries)
+
+            ## Requests are held back until the bucket fills up again
+            self._tokens = 0.
+            self._push((priority, method, params, callback, full_result, retries + 1))
+            self._pump()
+            return
+
+        callback(response, error)
+
+    def _pump(self):
+        self._refill()
+
+        while self._queue and self._tokens >= 1.:
+            _, _, queued, request = heapq.heappop(self._queue)
+            self._tokens -= 1.
+            metrics.Observe("scheduler.wait", (time.time() - queued) * 1000)
+
+            self._async_api.Call(request[1], request[2], lambda response, error, request=request: self._on_result(request, response, error),
+                                    full_result=request[4])
+
+        if self._queue and not self._timer:
+            delay_ms = int((1. - self._tokens) / self._rate * 1000) + 1
+            self._timer = weechat.hook_timer(delay_ms, 0, 1, "CallbackVkSchedulerTimer", self._account.GetHookData())
+
+    def Call(self, method, params, callback, priority=PRIORITY_BACKGROUND, full_result=False):
+        """Queue an API call, callback(response, error) is called once the result is known"""
+
+        self._push((priority, method, params, callback, full_result, 0))
+        self._pump()
+
+        return True
+
+    def OnTimer(self):
+        self._timer = None
+        self._pump()
+
+    def Stop(self):
+        if self._timer:
+            weechat.unhook(self._timer)
+            self._timer = None
+
+class VkApiBatcher(object):
+    """Groups independent API calls made during the same iteration of the event loop in VK execute requests"""
+
+    MAX_CALLS = 25
+
+    def __init__(self, account, scheduler):
+        super(VkApiBatcher, self).__init__()
+
+        self._account = account
+        self._scheduler = scheduler
+        self._calls = []
+        self._timer = None
+
+    def _on_result(self, calls, result, error):
+        if error:
+            for _, _, callback, _ in calls:
+                callback(None, error)
+            return
+
+        responses = result.get("response") or []
+        ## Calls that failed return false, their errors are listed in the same order
+        execute_errors = iter(result.get("execute_errors", []))
+
+        for i, (method, params, callback, priority) in enumerate(calls):
+            response = responses[i] if i < len(responses) else False
+            if response is False:
+                execute_error = next(execute_errors, {})
+
+                ## Calls throttled within the batch are made again
+                if execute_error.get("error_code") == VkRequestScheduler.ERROR_TOO_MANY_REQUESTS:
+                    self.Call(method, params, callback, priority)
+                    continue
+
+                callback(None, VkApiError(execute_error.get("error_code"), execute_error.get("error_msg", u"{0} failed".format(method))))
+            else:
+                callback(response, None)
+
+    def Call(self, method, params, callback, priority=VkRequestScheduler.PRIORITY_BACKGROUND):
+        """Queue an API call, callback(response, error) is called once the batch it's part of was executed"""
+
+        self._calls.append((method, params, callback, priority))
+
+        if len(self._calls) >= self.MAX_CALLS:
+            self.Flush()
+        elif not self._timer:
+            self._timer = weechat.hook_timer(1, 0, 1, "CallbackVkApiBatch", self._account.GetHookData())
+
+        return True
+
+    def Flush(self):
+        if self._timer:
+            weechat.unhook(self._timer)
+            self._timer = None
+
+        ## The most important calls are sent in the first batches, which have the priority of their most important call
+        self._calls.sort(key=lambda call: call[3])
+
+        while self._calls:
+            calls = self._calls[:self.MAX_CALLS]
+            del self._calls[:self.MAX_CALLS]
+
+            ## A single call doesn't need to be wrapped
+            if len(calls) == 1:
+                method, params, callback, priority = calls[0]
+                self._scheduler.Call(method, params, callback, priority)
+                continue
+
+            code = u"return [{0}];".format(u",".join(u"API.{0}({1})".format(method, json.dumps(params, ensure_ascii=False))
+                                                        for method, params, _, _ in calls))
+
+            self._scheduler.Call("execute", {"code": code}, lambda result, error, calls=calls: self._on_result(calls, result, error),
+                                    priority=calls[0][3], full_result=True)
+
+    def OnTimer(self):
+        self._timer = None
+        self.Flush()
+
+class Storage(object):
+    """Local SQLite database holding the data that's worth keeping between two sessions"""
+
+    FILENAME = "vk-chat.db"
+    ## The databases of the other accounts are named after them
+    FMT_FILENAME_ACCOUNT = "vk-chat.{0}.db"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            uid INTEGER PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            nickname TEXT,
+            updated INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS friends (
+            uid INTEGER PRIMARY KEY,
+            position INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            peer_id INTEGER,
+            out INTEGER,
+            date INTEGER,
+            body TEXT,
+            from_id INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS messages_peer_id ON messages (peer_id, id);
+    """
+    ## The full-text index of the messages is kept up to date by triggers, messages are never replaced but their body can be updated
+    SCHEMA_FTS = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts4 (content="messages", body);
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (docid, body) VALUES (new.id, new.body);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete BEFORE DELETE ON messages BEGIN
+            DELETE FROM messages_fts WHERE docid = old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update_before BEFORE UPDATE ON messages BEGIN
+            DELETE FROM messages_fts WHERE docid = old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update_after AFTER UPDATE ON messages BEGIN
+            INSERT INTO messages_fts (docid, body) VALUES (new.id, new.body);
+        END;
+    """
+
+    def __init__(self, account):
+        super(Storage, self).__init__()
+
+        self._filename = self.FMT_FILENAME_ACCOUNT.format(account.name.encode("utf-8")) if account.name else self.FILENAME
+        self._db = None
+        self._has_fts = False
+        self._friends_positions = {}
+
+    def IsOpen(self):
+        return self._db is not None
+
+    def HasFullTextSearch(self):
+        return self._has_fts
+
+    def Open(self, path=None):
+        if not sqlite3:
+            Util.Log("the sqlite3 module is not available, nothing will be cached")
             return False
-        except Exception as e:
-            Util.Log("Unknown Exception: unable to log in")
+
+        if not path:
+            path = Util.GetDataPath(self._filename)
+
+        try:
+            self._db = sqlite3.connect(path)
+            self._db.executescript(self.SCHEMA)
+
+            ## The senders of the messages weren't saved by previous versions
+            if not "from_id" in [ row[1] for row in self._db.execute("PRAGMA table_info(messages)") ]:
+                self._db.execute("ALTER TABLE messages ADD COLUMN from_id INTEGER")
+        except sqlite3.Error as e:
+            Util.Log(u"unable to open the database {0}: {1}".format(path.decode("utf-8"), e))
+            self._db = None
             return False
-        else:
-            Util.Log("successfully authentified to VK")
-            self._authed_vk = True
 
-        return True
+        try:
+            self._db.executescript(self.SCHEMA_FTS)
+            self._has_fts = True
+        except sqlite3.Error as e:
+            Util.Log(u"full-text search is not supported by sqlite3: {0}".format(e))
+
+        return True
+
+    def Close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def GetState(self, key, default=None):
+        if not self._db:
+            return default
+
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row else default
+
+    def SetState(self, key, value):
+        if not self._db:
+            return
+
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, unicode(value)))
+
+    def SaveUsers(self, users):
+        if not self._db:
+            return
+
+        now = int(time.time())
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO users (uid, first_name, last_name, nickname, updated) VALUES (?, ?, ?, ?, ?)",
+                                    ((user["id"], user.get("first_name"), user.get("last_name"), user.get("nickname"), now) for user in users))
+
+    def SaveMessages(self, messages):
+        """Save messages that weren't already, and return their ids"""
+
+        if not self._db:
+            return set(message["id"] for message in messages)
+
+        new_ids = set()
+        with self._db:
+            for message in messages:
+                cursor = self._db.execute("INSERT OR IGNORE INTO messages (id, peer_id, out, date, body, from_id) VALUES (?, ?, ?, ?, ?, ?)",
+                                            (message["id"], message["peer_id"], message["out"], message["date"], message["body"],
+                                                message["from_id"]))
+                if cursor.rowcount > 0:
+                    new_ids.add(message["id"])
+
+        return new_ids
+
+    def UpdateMessageBody(self, id_, body):
+        if not self._db:
+            return
+
+        with self._db:
+            self._db.execute("UPDATE messages SET body = ? WHERE id = ?", (body, id_))
+
+    def DeleteMessages(self, ids):
+        if not self._db:
+            return
+
+        with self._db:
+            self._db.executemany("DELETE FROM messages WHERE id = ?", ((id_,) for id_ in ids))
+
+    def LoadLastMessages(self, peer_id, count):
+        """Return the last messages exchanged with a peer, oldest first"""
+
+        if not self._db:
+            return []
+
+        rows = self._db.execute("SELECT id, out, date, body, from_id FROM messages WHERE peer_id = ? ORDER BY id DESC LIMIT ?",
+                                (peer_id, count)).fetchall()
+
+        return [ {
+                    "id": id_,
+                    "peer_id": peer_id,
+                    "out": out,
+                    "date": date,
+                    "body": body,
+                    "from_id": from_id,
+                } for id_, out, date, body, from_id in reversed(rows) ]
+
+    def GetOldestMessageId(self, peer_id):
+        if not self._db:
+            return None
+
+        return self._db.execute("SELECT MIN(id) FROM messages WHERE peer_id = ?", (peer_id,)).fetchone()[0]
+
+    def SearchMessages(self, text, limit):
+        """Return the most recent messages matching a full-text query"""
+
+        if not self._db or not self._has_fts:
+            return []
+
+        rows = self._db.execute("""SELECT messages.id, messages.peer_id, messages.out, messages.date, messages.body, messages.from_id
+                                    FROM messages_fts JOIN messages ON messages.id = messages_fts.docid WHERE messages_fts MATCH ?
+                                    ORDER BY messages.id DESC LIMIT ?""", (text, limit)).fetchall()
+
+        return [ {
+                    "id": id_,
+                    "peer_id": peer_id,
+                    "out": out,
+                    "date": date,
+                    "body": body,
+                    "from_id": from_id,
+                } for id_, peer_id, out, date, body, from_id in rows ]
+
+    def LoadUser(self, uid):
+        """Return the profile of a user along with the time it was saved, or (None, 0)"""
+
+        if not self._db:
+            return None, 0
+
+        row = self._db.execute("SELECT first_name, last_name, nickname, updated FROM users WHERE uid = ?", (uid,)).fetchone()
+        if not row:
+            return None, 0
+
+        return {
+            "id": uid,
+            "first_name": row[0],
+            "last_name": row[1],
+            "nickname": row[2],
+        }, row[3]
+
+    def LoadFriends(self):
+        if not self._db:
+            return []
+
+        rows = self._db.execute("""SELECT users.uid, users.first_name, users.last_name, users.nickname FROM friends
+                                    JOIN users ON users.uid = friends.uid ORDER BY friends.position""").fetchall()
+        self._friends_positions = dict((row[0], i) for i, row in enumerate(rows))
+
+        return [ {
+                    "id": uid,
+                    "first_name": first_name,
+                    "last_name": last_name,
+                    "nickname": nickname,
+                } for uid, first_name, last_name, nickname in rows ]
+
+    def SaveFriendsChanges(self, friends, added, changed, removed):
+        """Only write the differences brought by the last refresh of the friends store"""
+
+        if not self._db:
+            return
+
+        positions = dict((friend["id"], i) for i, friend in enumerate(friends))
+        moved = [ (i, uid) for uid, i in positions.iteritems() if self._friends_positions.get(uid) != i ]
+
+        self.SaveUsers(friends.Get(uid) for uid in added + changed)
+
+        with self._db:
+            self._db.executemany("DELETE FROM friends WHERE uid = ?", ((uid,) for uid in removed))
+            self._db.executemany("INSERT OR REPLACE INTO friends (position, uid) VALUES (?, ?)", moved)
+            self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('friends_updated', ?)", (unicode(int(time.time())),))
+
+        self._friends_positions = positions
+
+class UserResolver(object):
+    """Resolves the profiles of users who aren't friends, and keeps them in a LRU cache for a limited time"""
+
+    MAX_ENTRIES = 1000
+    TTL_S = 24 * 60 * 60
+    ## Maximum amount of time to wait for profiles before giving up on them
+    WAIT_MS = 3000
+
+    def __init__(self, account):
+        super(UserResolver, self).__init__()
+
+        self._account = account
+        self._cache = collections.OrderedDict()
+        self._requested = set()
+        ## Users to look up once the request in flight returns, a single one is sent at a time
+        self._pending = set()
+        self._fetching = False
+        self._waiters = {}
+        self._next_waiter_id = 0
+
+    def _fetch(self):
+        uids = list(self._pending)
+        self._pending.clear()
+        self._fetching = True
+        self._account.FetchUsers(uids, lambda users, error: self._on_result(uids, users, error))
+
+    def _store(self, user, timestamp):
+        uid = user["id"]
+
+        self._cache.pop(uid, None)
+        self._cache[uid] = (timestamp + self.TTL_S, user)
+
+        while len(self._cache) > self.MAX_ENTRIES:
+            self._cache.popitem(last=False)
+
+    def _on_result(self, uids, users, error):
+        self._fetching = False
+        self._requested.difference_update(uids)
+
+        if error:
+            self._account.Log(u"unable to resolve users: {0}".format(unicode(error)))
+        else:
+            now = int(time.time())
+            for user in users:
+                self._store(user, now)
+                ## The buffers opened when the wait expired are named after the uid of the user
+                self._account.buffer_manager.RenameChatBuffer(user["id"], user["first_name"], user["last_name"], user.get("nickname"))
+            self._account.storage.SaveUsers(users)
+
+        if self._pending:
+            self._fetch()
+
+        ## Hand the profiles over to the callers waiting for them, even the ones that couldn't be resolved
+        for waiter_id, (waiter_uids, _, _) in self._waiters.items():
+            if not waiter_uids.intersection(self._requested):
+                self._complete(waiter_id)
+
+    def _complete(self, waiter_id):
+        uids, callback, timer = self._waiters.pop(waiter_id)
+        if timer:
+            weechat.unhook(timer)
+
+        users = {}
+        for uid in uids:
+            user = self.Get(uid)
+            if user:
+                users[uid] = user
+
+        callback(users)
+
+    def Get(self, uid):
+        entry = self._cache.get(uid)
+        if entry:
+            expiry, user = entry
+            if expiry < time.time():
+                del self._cache[uid]
+                return None
+
+            ## The least recently used entries are at the beginning of the cache, and evicted first
+            del self._cache[uid]
+            self._cache[uid] = entry
+            return user
+
+        ## Profiles resolved during a previous session are kept in the database
+        user, updated = self._account.storage.LoadUser(uid)
+        if user and updated + self.TTL_S > time.time():
+            self._store(user, updated)
+            return user
+
+        return None
+
+    def Resolve(self, uids, callback):
+        """Fetch the profiles of all the given users in a single request, callback(users) is called with the ones that could be resolved"""
+
+        uids = set(uids)
+        missing_uids = [ uid for uid in uids if not self.Get(uid) and not uid in self._requested ]
+
+        ## The users unknown while a lookup is in flight are looked up together once it returns
+        if missing_uids:
+            self._requested.update(missing_uids)
+            self._pending.update(missing_uids)
+            if not self._fetching:
+                self._fetch()
+
+        waiter_id = self._next_waiter_id
+        self._next_waiter_id += 1
+        self._waiters[waiter_id] = (uids, callback, None)
+
+        if not uids.intersection(self._requested):
+            self._complete(waiter_id)
+        else:
+            timer = weechat.hook_timer(self.WAIT_MS, 0, 1, "CallbackVkResolverTimeout", self._account.GetHookData(waiter_id))
+            self._waiters[waiter_id] = (uids, callback, timer)
+
+    def OnTimeout(self, waiter_id):
+        if waiter_id in self._waiters:
+            uids, callback, _ = self._waiters[waiter_id]
+            self._waiters[waiter_id] = (uids, callback, None)
+            self._complete(waiter_id)
+
+class ChatRosters(object):
+    """Members of the group chats, fetched once per chat and kept up to date by the chat change events
+
+    The senders of the messages are looked up in the roster of their chat, whose members are listed in the nicklist of its buffer"""
+
+    def __init__(self, account):
+        super(ChatRosters, self).__init__()
+
+        self._account = account
+        ## Nicks of the members by uid, by chat id
+        self._rosters = {}
+        self._titles = {}
+        self._requested = set()
+        self._waiters = []
+
+    @staticmethod
+    def _get_nicks(users):
+        """Return the nicks of the members by uid: their first name, followed by the initial of their last name if it's shared"""
+
+        first_names = collections.Counter(user["first_name"] for user in users)
+        nicks = collections.OrderedDict()
+
+        for user in sorted(users, key=lambda user: (user["first_name"], user["last_name"])):
+            nick = user["first_name"]
+            if first_names[nick] > 1 and user["last_name"]:
+                nick = u"{0}_{1}".format(nick, user["last_name"][0])
+            nicks[user["id"]] = nick
+
+        return nicks
+
+    def Get(self, chat_id):
+        return self._rosters.get(chat_id)
+
+    def GetNick(self, chat_id, uid):
+        roster = self._rosters.get(chat_id)
+        nick = roster.get(uid) if roster else None
+        if nick:
+            return nick
+
+        ## The member might have joined since the roster was fetched
+        user = self._account.LookupUser(uid)
+
+        return user["first_name"] if user else unicode(uid)
+
+    def GetTitle(self, chat_id):
+        return self._titles.get(chat_id) or u"chat {0}".format(chat_id)
+
+    def SetTitle(self, chat_id, title):
+        """Return True if the title of the chat changed"""
+
+        if not title or self._titles.get(chat_id) == title:
+            return False
+
+        self._titles[chat_id] = title
+
+        return True
+
+    def _fetch(self, chat_id):
+        self._requested.add(chat_id)
+        self._account.FetchChatUsers(chat_id, lambda users, error: self._on_result(chat_id, users, error))
+
+    def _on_result(self, chat_id, users, error):
+        self._requested.discard(chat_id)
+
+        if error:
+            self._account.Log(u"unable to get the members of chat {0}: {1}".format(chat_id, unicode(error)))
+        else:
+            self._rosters[chat_id] = self._get_nicks(users)
+            self._account.storage.SaveUsers(users)
+            self.UpdateNicklist(chat_id)
+
+        ## Hand over to the callers waiting for the rosters, even the ones that couldn't be fetched
+        for waiter in list(self._waiters):
+            chat_ids, callback = waiter
+            if not chat_ids.intersection(self._requested):
+                self._waiters.remove(waiter)
+                callback()
+
+    def Load(self, chat_ids, callback):
+        """Fetch the rosters of the chats that aren't known yet, callback() is called once they were all answered"""
+
+        chat_ids = set(chat_ids)
+        for chat_id in chat_ids:
+            if not chat_id in self._rosters and not chat_id in self._requested:
+                self._fetch(chat_id)
+
+        if chat_ids.intersection(self._requested):
+            self._waiters.append((chat_ids, callback))
+        else:
+            callback()
+
+    def Refresh(self, chat_id):
+        """Fetch the roster of a chat whose members changed again, the ones that weren't needed yet are left alone"""
+
+        if chat_id in self._rosters and not chat_id in self._requested:
+            self._fetch(chat_id)
+
+    def UpdateNicklist(self, chat_id):
+        buffer_ = self._account.buffer_manager.GetChatBuffer(VkPeer.CHAT_BASE + chat_id)
+        roster = self._rosters.get(chat_id)
+        if not buffer_ or roster is None:
+            return
+
+        weechat.nicklist_remove_all(buffer_)
+        for nick in roster.itervalues():
+            weechat.nicklist_add_nick(buffer_, "", nick.encode("utf-8"), "bar_fg", "", "lightgreen", 1)
+
+class Account(object):
+    """A VK account, with its own token, cache, buffers and long polling connection
+
+    The account whose token is set by the vk-token option has an empty name, the others are listed in the accounts option"""
+
+    def __init__(self, name):
+        super(Account, self).__init__()
+
+        self.name = name
+        self._authed_vk = False
+        self._token = None
+        self._vk_api = None
+        self._async_api = VkAsyncApi(self)
+        self._scheduler = VkRequestScheduler(self, self._async_api)
+        self._batcher = VkApiBatcher(self, self._scheduler)
+        self._friends = FriendsStore()
+        self._friends_index = FriendsNameIndex(self._friends)
+
+        self.storage = Storage(self)
+        self.user_resolver = UserResolver(self)
+        self.chat_rosters = ChatRosters(self)
+        self.updates_poller = UpdatesPoller(self)
+        self.buffer_manager = BufferManager(self)
+        self.send_queue = SendQueue(self)
+        self.read_receipts = ReadReceipts(self)
+        self.message_history = MessageHistory(self)
+        self.attachments = AttachmentResolver(self)
+        self.dialogs_pager = DialogsPager(self, lambda dialogs: _display_unread_dialogs(self, dialogs))
+        self.presence = Presence(self)
+        self.longpoll_events = LongPollEvents(self)
+        self.startup = Startup(self)
+
+    def GetOptionName(self, option_name):
+        """Return the name of the option of the account, the options of the other accounts are suffixed with their name"""
+
+        return "{0}.{1}".format(option_name, self.name.encode("utf-8")) if self.name else option_name
+
+    def GetToken(self):
+        return Util.GetConfigOption(self.GetOptionName("vk-token"))
+
+    def GetHookData(self, arg=""):
+        """Return the data of a hook, from which its callback finds the account back along with the given argument"""
+
+        return u"{0}:{1}".format(self.name, arg).encode("utf-8")
+
+    def Log(self, s):
+        Util.Log(u"[{0}] {1}".format(self.name, s) if self.name else s)
+
+    def Open(self):
+        """Load the data saved during the previous session, the friends are available until the list is refreshed"""
+
+        if self.storage.Open():
+            self.LoadCachedFriends()
+
+    def Stop(self):
+        self.updates_poller.Stop()
+        self.send_queue.Stop()
+        self.dialogs_pager.Stop()
+        self.presence.Stop()
+        self.buffer_manager.Stop()
+        self._scheduler.Stop()
+        ## Requests can't be run in the background anymore at this point
+        self.read_receipts.Flush(synchronous=True)
+        self.storage.Close()
+
+    def _call(self, method, params, callback, priority, batch=True):
+        """Call an API method in the background, recording how long it took"""
+
+        start = time.time()
+
+        def on_result(response, error):
+            elapsed_ms = (time.time() - start) * 1000
+            metrics.Observe(u"api.{0}".format(method), elapsed_ms)
+            if error:
+                metrics.Increment(u"api.{0}.errors".format(method))
+            if tracer.enabled:
+                tracer.Event("api.call", account=self.name, method=method, ms=elapsed_ms, error=unicode(error) if error else None)
+            if recorder.enabled:
+                recorder.Record(self.name, Recorder.KIND_API, {
+                                    "method": method,
+                                    "response": response,
+                                    "error": [ error.code, error.message ] if error else None,
+                                })
+
+            callback(response, error)
+
+        if batch:
+            return self._batcher.Call(method, params, on_result, priority)
+
+        return self._scheduler.Call(method, params, on_result, priority)
+
+    def IsAuthedVkontakte(self):
+        return self._authed_vk
+
+    def _get_vk_api(self):
+        """Return the client used to make synchronous calls, None if it's not available"""
+
+        global vkontakte
+
+        if self._vk_api or not self._authed_vk:
+            return self._vk_api
+
+        try:
+            import vkontakte
+            self._vk_api = vkontakte.API(token=self._token, v=VkAsyncApi.VERSION)
+        except ImportError as e:
+            self.Log("the vkontakte module is not available, synchronous calls can't be made")
+        except Exception as e:
+            self.Log("Unknown Exception: unable to create the VK client")
+
+        return self._vk_api
+
+    def AuthVkontakte(self, token, callback):
+        """Check the token in the background, callback(error) is called with None once authenticated"""
+
+        if self._authed_vk:
+            callback(None)
+            return True
+        elif not token:
+            return False
+
+        self._async_api.SetToken(token)
+        self._scheduler.SetRate(Util.GetConfigOption("max-requests-per-second", float) or 3)
+
+        def on_result(users, error):
+            if error:
+                self.Log(u"unable to log in: {0}".format(unicode(error)))
+            else:
+                self.Log("successfully authentified to VK")
+                self._authed_vk = True
+                self._token = token
+
+            callback(error)
+
+        ## Any call will do, the profile of the user the token belongs to is requested
+        return self._call("users.get", {}, on_result, VkRequestScheduler.PRIORITY_DISPLAY, batch=False)
+
+    def Logout(self):
+        self._authed_vk = False
+        self._token = None
+        self._vk_api = None
+        self._async_api.SetToken(None)
+
+    def GetFriends(self):
+        return self._friends
+
+    def GetFriendsIndex(self):
+        return self._friends_index
+
+    def LoadCachedFriends(self):
+        """Fill the friends store with the list saved during the previous session"""
+
+        self._friends.Update(self.storage.LoadFriends())
+
+        return len(self._friends)
+
+    def FetchFriends(self, callback=None, priority=VkRequestScheduler.PRIORITY_BACKGROUND):
+        """Refresh the friends store in the background, callback(success) is called once it's done"""
+
+        if not self._authed_vk:
+            return False
+
+        def on_result(friends, error):
+            if error:
+                self.Log(u"unable to get a list of friends: {0}".format(unicode(error)))
+            else:
+                added, changed, removed = self._friends.Update(friends["items"])
+                self.storage.SaveFriendsChanges(self._friends, added, changed, removed)
+
+                ## The buffers of the friends who were renamed are kept, under their new name
+                for uid in changed:
+                    friend = self._friends.Get(uid)
+                    self.buffer_manager.RenameChatBuffer(uid, friend["first_name"], friend["last_name"], friend.get("nickname"))
+
+            if callback:
+                callback(not error)
+
+        return self._call("friends.get", {
+                            "order": "hints",
+                            "count": 0,
+                            "offset": 0,
+                            "fields": "first_name,last_name,nickname",
+                            "name_case": "nom",
+                        }, on_result, priority)
+
+    def FetchUsers(self, uids, callback):
+        return self._call("users.get", {
+                            "user_ids": ",".join(str(uid) for uid in uids),
+                            "fields": "nickname",
+                            "name_case": "nom",
+                        }, callback, VkRequestScheduler.PRIORITY_DISPLAY)
+
+    def FetchChatUsers(self, chat_id, callback):
+        return self._call("messages.getChatUsers", {
+                            "chat_id": chat_id,
+                            "fields": "nickname",
+                            "name_case": "nom",
+                        }, callback, VkRequestScheduler.PRIORITY_DISPLAY)
+
+    def FetchPhotos(self, photos, callback):
+        return self._call("photos.getById", {
+                            "photos": ",".join(photos),
+                        }, callback, VkRequestScheduler.PRIORITY_DISPLAY)
+
+    def FetchDocs(self, docs, callback):
+        return self._call("docs.getById", {
+                            "docs": ",".join(docs),
+                        }, callback, VkRequestScheduler.PRIORITY_DISPLAY)
+
+    def FetchMessages(self, message_ids, callback):
+        return self._call("messages.getById", {
+                            "message_ids": ",".join(str(message_id) for message_id in message_ids),
+                            "preview_length": 0,
+                        }, callback, VkRequestScheduler.PRIORITY_DISPLAY)
+
+    def LookupUser(self, uid):
+        """Return the profile of a user if it's already known"""
+
+        return self._friends.Get(uid) or self.user_resolver.Get(uid)
+
+    def FetchHistory(self, peer_id, start_message_id, count, callback):
+        params = VkPeer.GetParams(peer_id)
+        params.update({
+            "count": count,
+            "offset": 0,
+        })
+        if start_message_id:
+            params["start_message_id"] = start_message_id
+
+        return self._call("messages.getHistory", params, callback, VkRequestScheduler.PRIORITY_DISPLAY)
+
+    def FetchDialogs(self, count, start_message_id, callback):
+        """Fetch a page of unread dialogs in the background, callback(dialogs) is called with False if they couldn't be"""
+
+        if not self._authed_vk:
+            return False
+
+        def on_result(dialogs, error):
+            if error:
+                self.Log(u"unable to get dialogs: {0}".format(unicode(error)))
+                callback(False)
+            else:
+                callback(dialogs["items"])
+
+        params = {
+            "offset": 0,
+            "count": count,
+            "preview_length": 0,
+            "unread": 1,
+        }
+        ## Pages are designated by the message of the dialog they start from, which remains valid while dialogs are read
+        if start_message_id:
+            params["start_message_id"] = start_message_id
+
+        return self._call("messages.getDialogs", params, on_result, VkRequestScheduler.PRIORITY_DISPLAY)
+
+    def MarkMessagesAsRead(self, ids):
+        vk_api = self._get_vk_api()
+        if not vk_api:
+            return False
+
+        try:
+            vk_api.messages.markAsRead(message_ids=",".join(str(id_) for id_ in ids))
+        except vkontakte.VKError as e:
+            self.Log("VKError: unable to mark messages as read")
+            return False
+        except Exception as e:
+            self.Log("Unknown Exception: unable to mark messages as read")
+            return False
+
+        return True
+
+    def MarkMessagesAsReadAsync(self, ids, callback):
+        return self._call("messages.markAsRead", {
+                            "message_ids": ",".join(str(id_) for id_ in ids),
+                        }, callback, VkRequestScheduler.PRIORITY_READ)
+
+    def SendMessagePeerAsync(self, peer_id, message, random_id, callback):
+        params = VkPeer.GetParams(peer_id)
+        ## The random id prevents the message from being sent twice when the request is retried
+        params.update({
+            "message": message,
+            "random_id": random_id,
+        })
+
+        return self._call("messages.send", params, callback, VkRequestScheduler.PRIORITY_SEND, batch=False)
+
+    def GetAsyncApi(self):
+        return self._async_api
+
+    def GetBatcher(self):
+        return self._batcher
+
+    def GetScheduler(self):
+        return self._scheduler
+
+    def GetUnreadMessages(self):
+        ## XXX: don't use this function
+        vk_api = self._get_vk_api()
+        if not vk_api:
+            return False
+
+        try:
+            ## XXX: the filters variable doesn't seem to be returning unread messages only
+            messages = vk_api.messages.get(count=5, time_offset=0, filters=1, preview_length=0, out=0)
+            messages = [ message for message in messages["items"] if not message["read_state"] ]
+        except vkontakte.VKError as e:
+            self.Log("VKError: unable to get unread messages")
+            return False
+        except Exception as e:
+            self.Log("Unknown Exception: unable to get unread messages")
+            return False
+
+        return messages
+
+    def GetLongPollServerInfo(self, callback):
+        """Request the longpoll server info in the background, callback(info) is called with False if it couldn't be"""
+
+        def on_result(info, error):
+            if error:
+                self.Log(u"unable to get longpoll server info: {0}".format(unicode(error)))
+                callback(False)
+            else:
+                callback(info)
+
+        return self._call("messages.getLongPollServer", {
+                            "use_ssl": 0,
+                            "need_pts": 1,
+                        }, on_result, VkRequestScheduler.PRIORITY_LONGPOLL)
+
+    def FetchLongPollHistory(self, ts, pts, callback):
+        """Fetch the events that happened since the given pts, callback(history) is called with False if they couldn't be"""
+
+        def on_result(history, error):
+            if error:
+                self.Log(u"unable to get the missed events: {0}".format(unicode(error)))
+                callback(False)
+            else:
+                callback(history)
+
+        return self._call("messages.getLongPollHistory", {
+                            "ts": ts,
+                            "pts": pts,
+                            "preview_length": 0,
+                            "events_limit": 1000,
+                            "msgs_limit": 200,
+                        }, on_result, VkRequestScheduler.PRIORITY_LONGPOLL)
+
+class Plugin(object):
+    DEFAULT_OPTIONS = [
+        ("vk-token", ""),
+        ("accounts", ""),
+        ("max-friends-suggestions", "10"),
+        ("longpoll-mode", "fd"),
+        ("history-lines", "50"),
+        ("max-search-results", "20"),
+        ("max-requests-per-second", "3"),
+        ("max-lines-per-tick", "0"),
+        ("trace", "off"),
+        ("trace-size", "1000"),
+        ("record", "off"),
+    ]
+
+    ## Characters allowed in the names of the accounts, which are part of the names of options, files and buffers
+    REGEX_ACCOUNT_NAME = re.compile(r"^[\w-]+$", re.U)
+
+    def __init__(self):
+        super(Plugin, self).__init__()
+
+        self._timers = {}
+        ## Accounts by name, in the order they're configured in
+        self._accounts = collections.OrderedDict()
+        ## Account the commands typed outside of a conversation buffer apply to
+        self._current_account = None
+
+    def _get_account_names(self):
+        names = []
+        for name in (Util.GetConfigOption("accounts") or "").decode("utf-8").split(u","):
+            name = name.strip()
+            if not name or name in names:
+                continue
+            elif not self.REGEX_ACCOUNT_NAME.match(name):
+                Util.Log(u"invalid account name: {0}".format(name))
+                continue
+            names.append(name)
+
+        ## The account of the vk-token option is only left out when other accounts are configured
+        if Util.GetConfigOption("vk-token") or not names:
+            names.insert(0, u"")
+
+        return names
+
+    def UpdateAccounts(self):
+        """Create the accounts that were added to the configuration, and stop the ones that were removed"""
+
+        names = self._get_account_names()
+
+        for name in set(self._accounts).difference(names):
+            Util.Log(u"account removed: {0}".format(name or u"vk-token"))
+            self._accounts.pop(name).Stop()
+
+        added = False
+        for name in names:
+            if not name in self._accounts:
+                account = Account(name)
+                account.Open()
+                added = True
+                self._accounts[name] = account
+
+        self._accounts = collections.OrderedDict((name, self._accounts[name]) for name in names)
+        if not self._current_account in self._accounts:
+            self._current_account = names[0]
+
+        ## The new accounts are authenticated right away, without waiting for the timer
+        if added:
+            weechat.hook_timer(1, 0, 1, "CallbackVkAuth", "")
+
+    def GetAccount(self, name):
+        return self._accounts.get(name)
+
+    def GetAccounts(self):
+        return self._accounts.values()
+
+    def ParseHookData(self, data):
+        """Return the account that created a hook, None if it was removed since, and the argument of the hook"""
+
+        name, _, arg = data.decode("utf-8").partition(u":")
+
+        return self._accounts.get(name), arg
+
+    def GetBufferAccount(self, buffer_):
+        """Return the account of a conversation buffer, None for any other buffer"""
+
+        if not weechat.buffer_get_string(buffer_, "localvar_peer_id"):
+            return None
+
+        return self._accounts.get(weechat.buffer_get_string(buffer_, "localvar_vkchat_account").decode("utf-8"))
+
+    def GetCommandAccount(self, buffer_):
+        """Return the account a command typed in a buffer applies to: the one of the conversation, or the current account"""
+
+        return self.GetBufferAccount(buffer_) or self._accounts.get(self._current_account)
+
+    def SetCurrentAccount(self, name):
+        if not name in self._accounts:
+            return False
+
+        self._current_account = name
+
+        return True
+
+    def GetCurrentAccount(self):
+        return self._accounts.get(self._current_account)
+
+    def GetStatus(self):
+        return u" ".join(u"{0}: {1}".format(account.name or u"vk", account.startup.GetStatus()) for account in self._accounts.itervalues())
+
+    def SetDefaultOptions(self):
+        for k, v in self.DEFAULT_OPTIONS:
+            option_value = Util.GetConfigOption(k)
+            if not option_value:
+                Util.SetConfigOption(k, v)
+            else:
+                continue
+
+    def SetCommands(self):
+        weechat.hook_command("vkchat", "Chat with a friend on VK",
+                                "[<first_name> [<last_name>]] | <uid> | history | search <text> | stats [reset] | account [<name>] | trace [clear]",
+                                "first_name, last_name: patterns matched against the names of your friends\n"
+                                "              uid: id of the VK user to chat with\n"
+                                "          history: fetch older messages of the current conversation\n"
+                                "           search: search the messages saved locally\n"
+                                "            stats: display the counters and latencies measured, or reset them\n"
+                                "          account: list the accounts, or select the one the commands typed outside of a conversation apply to\n"
+                                "            trace: display the events recorded while tracing is enabled, or forget them",
+                                "%(vkchat_friends_first_name) %(vkchat_friends_last_name) || history || search || stats reset || account || trace clear",
+                                "CallbackVkChat", "")
+
+    def SetInfolists(self):
+        weechat.hook_infolist("vkchat_stats", "counters and latencies (in microseconds) measured by vk-chat", "", "", "CallbackInfolistStats", "")
+
+    def SetSignals(self):
+        weechat.hook_signal("window_scrolled", "CallbackWindowScrolled", "")
+
+    def SetConfigHooks(self):
+        weechat.hook_config("weechat.color.*", "CallbackConfigColors", "")
+        ## The tokens of all the accounts are watched
+        weechat.hook_config("plugins.var.python.{0}.vk-token*".format(Script.NAME), "CallbackConfigToken", "")
+        weechat.hook_config("plugins.var.python.{0}.accounts".format(Script.NAME), "CallbackConfigAccounts", "")
+        weechat.hook_config("plugins.var.python.{0}.trace*".format(Script.NAME), "CallbackConfigTrace", "")
+        weechat.hook_config("plugins.var.python.{0}.record".format(Script.NAME), "CallbackConfigRecord", "")
+
+    def ConfigureTracer(self):
+        tracer.Configure(Util.GetConfigOption("trace"), Util.GetConfigOption("trace-size", int))
+
+    def ConfigureRecorder(self):
+        recorder.Configure(Util.GetConfigOption("record"))
+
+    def SetBarItems(self):
+        weechat.bar_item_new(Startup.BAR_ITEM, "CallbackBarItemStatus", "")
+
+    def SetCompletions(self):
+        weechat.hook_completion("vkchat_friends_first_name", "first names of the VK friends", "CallbackCompletionFriendsFirstName", "")
+        weechat.hook_completion("vkchat_friends_last_name", "last names of the VK friends", "CallbackCompletionFriendsLastName", "")
+
+    def RegisterTimer(self, name, interval_ms, align_s, max_calls, callback_name, arg):
+        self._timers[name] = weechat.hook_timer(interval_ms, align_s, max_calls, callback_name, arg)
+
+    def UnregisterTimer(self, name):
+        if name in self._timers:
+            weechat.unhook(self._timers[name])
+            del self._timers[name]
+        else:
+            pass
+
+plugin = Plugin()
+
+class HttpResponse(object):
+    def __init__(self, version, status, headers):
+        super(HttpResponse, self).__init__()
+
+        self.version = version
+        self.status = status
+        self.headers = headers
+        self.body = bytearray()
+
+    def IsKeepAlive(self):
+        connection = self.headers.get("connection", "").lower()
+
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+
+        return connection != "close"
+
+class HttpResponseParser(object):
+    """Incremental HTTP/1.1 response parser, responses are framed by their Content-Length or chunked encoding"""
+
+    STATE_HEADERS = 0
+    STATE_BODY = 1
+    STATE_CHUNK_SIZE = 2
+    STATE_CHUNK_DATA = 3
+    STATE_CHUNK_TRAILER = 4
+    STATE_UNTIL_CLOSE = 5
+
+    def __init__(self):
+        super(HttpResponseParser, self).__init__()
+
+        self._buffer = bytearray()
+        self.Reset()
+
+    def Reset(self):
+        del self._buffer[:]
+        self._state = self.STATE_HEADERS
+        self._response = None
+        self._remaining = 0
+
+    def _parse_headers(self):
+        end = self._buffer.find(b"\r\n\r\n")
+        if end < 0:
+            return False
+
+        lines = bytes(self._buffer[:end]).split("\r\n")
+        del self._buffer[:end + 4]
+
+        status_line = lines[0].split(" ", 2)
+        if len(status_line) < 2 or not status_line[1].isdigit():
+            raise ValueError("invalid status line: {0}".format(lines[0]))
+
+        headers = {}
+        for line in lines[1:]:
+            k, _, v = line.partition(":")
+            headers[k.strip().lower()] = v.strip()
+
+        self._response = HttpResponse(status_line[0], int(status_line[1]), headers)
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            self._state = self.STATE_CHUNK_SIZE
+        elif "content-length" in headers:
+            self._remaining = int(headers["content-length"])
+            self._state = self.STATE_BODY
+        elif self._response.status in (204, 304) or 100 <= self._response.status < 200:
+            self._remaining = 0
+            self._state = self.STATE_BODY
+        else:
+            self._state = self.STATE_UNTIL_CLOSE
+
+        return True
+
+    def _consume(self):
+        n = min(self._remaining, len(self._buffer))
+
+        self._response.body += self._buffer[:n]
+        del self._buffer[:n]
+        self._remaining -= n
+
+        return self._remaining == 0
+
+    def _complete(self):
+        response = self._response
+
+        self._state = self.STATE_HEADERS
+        self._response = None
+        self._remaining = 0
+
+        return response
+
+    def Feed(self, data):
+        """Append data received from the server, and return the list of responses it completed"""
+
+        responses = []
+
+        self._buffer += data
+
+        while True:
+            if self._state == self.STATE_HEADERS:
+                if not self._parse_headers():
+                    break
+            elif self._state == self.STATE_BODY:
+                if not self._consume():
+                    break
+                responses.append(self._complete())
+            elif self._state == self.STATE_CHUNK_SIZE:
+                end = self._buffer.find(b"\r\n")
+                if end < 0:
+                    break
+
+                chunk_size = int(bytes(self._buffer[:end]).split(";", 1)[0].strip(), 16)
+                del self._buffer[:end + 2]
+
+                if chunk_size:
+                    self._remaining = chunk_size
+                    self._state = self.STATE_CHUNK_DATA
+                else:
+                    self._state = self.STATE_CHUNK_TRAILER
+            elif self._state == self.STATE_CHUNK_DATA:
+                ## The chunk data is followed by a CRLF sequence
+                if self._remaining:
+                    if not self._consume():
+                        break
+                if len(self._buffer) < 2:
+                    break
+                del self._buffer[:2]
+                self._state = self.STATE_CHUNK_SIZE
+            elif self._state == self.STATE_CHUNK_TRAILER:
+                end = self._buffer.find(b"\r\n")
+                if end < 0:
+                    break
+
+                del self._buffer[:end + 2]
+                ## An empty line ends the trailer
+                if not end:
+                    responses.append(self._complete())
+            elif self._state == self.STATE_UNTIL_CLOSE:
+                self._response.body += self._buffer
+                del self._buffer[:]
+                break
+
+        return responses
+
+    def Finish(self):
+        """Return the response whose body was delimited by the closing of the connection, if any"""
+
+        response = None
+        if self._state == self.STATE_UNTIL_CLOSE:
+            response = self._complete()
+
+        self.Reset()
+
+        return response
+
+class UpdatesPoller(object):
+    MODE_TIMER = "timer"
+    MODE_FD = "fd"
+
+    ## Amount of seconds the long polling server is asked to hold a request
+    LONGPOLL_WAIT = 25
+    ## Have the server return the attachments of the messages (2), and the pts of the events (32)
+    LONGPOLL_MODE = 2 | 32
+    ## Delay before reconnecting after consecutive failures, doubled with every one of them, in seconds
+    BACKOFF_BASE = 1
+    BACKOFF_MAX = 5 * 60
+
+    def __init__(self, account):
+        super(UpdatesPoller, self).__init__()
+
+        self._account = account
+        self._sock = None
+        self._new_ts = None
+        self._hook_fd = None
+        self._connected = False
+        self._request_pending = False
+        self._last_activity = 0
+        self._out = ""
+        self._parser = HttpResponseParser()
+        self._recv_buffer = bytearray(16384)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._event_driven = False
+        self._fetching_server_info = False
+        self._connect_hook = None
+        self._request_sent = 0
+        self._failures = 0
+        self._retry_at = 0
+        self._retry_timer = None
+        ## Events are numbered by their pts, which lets the ones missed while disconnected be fetched
+        ## It's saved periodically and when disconnected rather than with every response
+        self._pts = None
+        self._pts_saved = None
+        self._recovering = False
+        self.longpollserver_info = {}
+
+    def _unhook_fd(self):
+        if self._hook_fd:
+            weechat.unhook(self._hook_fd)
+            self._hook_fd = None
+
+    def _hook(self, flag_read, flag_write):
+        self._unhook_fd()
+
+        if self._sock:
+            self._hook_fd = weechat.hook_fd(self._sock.fileno(), flag_read, flag_write, 0, "CallbackVkLongPollFd", self._account.GetHookData())
+
+    def _close(self):
+        self._unhook_fd()
+
+        if self._connect_hook:
+            weechat.unhook(self._connect_hook)
+            self._connect_hook = None
+
+        if self._sock:
+            try:
+                self._sock.close()
+            except socket.error as e:
+                pass
+
+        self._sock = None
+        self._connected = False
+        self._request_pending = False
+        self._parser.Reset()
+        self._out = ""
+        self._account.startup.Refresh()
+        self.SavePts()
+
+        ## The key remains valid after the connection was closed, only the timestamp has to be updated
+        if self._new_ts:
+            self.longpollserver_info["ts"] = self._new_ts
+            self._new_ts = None
+
+    def _drop_server(self):
+        self._close()
+        self.longpollserver_info = {}
+
+    def _on_failure(self):
+        """Delay the next connection if the previous ones failed as well"""
+
+        self._failures += 1
+        metrics.Increment("longpoll.failures")
+
+        ## A single failure, e.g. an expired key, is recovered from right away
+        ## Otherwise the delay is randomized for the clients that were disconnected together not to reconnect together
+        delay = 0
+        if self._failures > 1:
+            delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (self._failures - 2))
+            delay = random.uniform(delay / 2.0, delay)
+
+        if tracer.enabled:
+            tracer.Event("longpoll.failure", account=self._account.name, failures=self._failures, retry_s=delay)
+
+        self._retry_at = time.time() + delay
+
+        if self._event_driven and not self._retry_timer:
+            self._retry_timer = weechat.hook_timer(max(1, int(delay * 1000)), 0, 1, "CallbackVkLongPollRetry", self._account.GetHookData())
+
+    def _set_pts(self, pts):
+        if pts:
+            self._pts = pts
+
+    def SavePts(self):
+        if self._pts and self._pts != self._pts_saved:
+            self._account.storage.SetState("pts", self._pts)
+            self._pts_saved = self._pts
+
+    def _on_server_info(self, info):
+        self._fetching_server_info = False
+        if not info:
+            self._on_failure()
+            return
+
+        self.longpollserver_info = info
+        self.longpollserver_info["hostname"], self.longpollserver_info["path"] = self.longpollserver_info["server"].split("/", 1)
+
+        ## The pts of the previous session is used to fetch the events that happened since
+        if self._pts is None:
+            self._pts = self._pts_saved = int(self._account.storage.GetState("pts", 0)) or None
+
+        if self._pts and info.get("pts") and info["pts"] != self._pts:
+            self._recover(info["ts"], self._pts)
+        else:
+            self._set_pts(info.get("pts"))
+
+            if self._event_driven:
+                self.Start()
+
+    @staticmethod
+    def _history_updates(history):
+        """Convert the result of messages.getLongPollHistory into long polling updates"""
+
+        messages = dict((message["id"], message) for message in history.get("messages", {}).get("items", []))
+        updates = []
+
+        for update in history.get("history", []):
+            if not update or update[0] != VkEventCode.MESSAGE_NEW:
+                updates.append(update)
+                continue
+
+            ## New messages are only designated by their id, their content is listed separately
+            message = messages.get(update[1])
+            if not message:
+                continue
+
+            if len(update) > 3:
+                flags, peer_id = update[2], update[3]
+            elif "chat_id" in message:
+                flags, peer_id = VkMessageFlag.CHAT, VkPeer.CHAT_BASE + message["chat_id"]
+            else:
+                flags, peer_id = 0, message["user_id"]
+
+            if not len(update) > 3:
+                flags |= (VkMessageFlag.OUTBOX if message.get("out") else 0) | (0 if message.get("read_state") else VkMessageFlag.UNREAD)
+
+            ## The sender of the messages of group chats is given along with the attachments
+            updates.append([VkEventCode.MESSAGE_NEW, message["id"], flags, peer_id, message["date"], message.get("title", u" ... "),
+                            message["body"], {"from": unicode(message["user_id"])} if "chat_id" in message else {}])
+
+        return updates
+
+    def _recover(self, ts, pts):
+        """Fetch the events missed since the given pts, the long polling resumes once they've been handled"""
+
+        self._recovering = True
+        metrics.Increment("longpoll.recoveries")
+        if tracer.enabled:
+            tracer.Event("longpoll.recover", account=self._account.name, ts=ts, pts=pts)
+
+        if not self._account.FetchLongPollHistory(ts, pts, lambda history: self._on_history(ts, history)):
+            self._on_history(ts, False)
+
+    def _on_history(self, ts, history):
+        if history:
+            self._account.longpoll_events.Handle(self._history_updates(history))
+            self._set_pts(history.get("new_pts"))
+
+            ## The amount of events returned at once is limited
+            if history.get("more"):
+                self._recover(ts, self._pts)
+                return
+        else:
+            ## The events couldn't be recovered, e.g. the pts is too old
+            self._set_pts(self.longpollserver_info.get("pts"))
+
+        self._recovering = False
+
+        if self._event_driven:
+            self.Start()
+
+    def _connect_longpoll(self):
+        if self._sock:
+            return True
+
+        if self._recovering or time.time() < self._retry_at:
+            return False
+
+        ## The connection is attempted again once the server info has been received
+        if not self.longpollserver_info:
+            self.FetchServerInfo()
+            return False
+
+        ## WeeChat resolves the host and connects in the background, the request is sent once the connection is established
+        if not self._connect_hook:
+            host, _, port = self.longpollserver_info["hostname"].partition(":")
+            self._connect_hook = weechat.hook_connect("", host.encode("utf-8"), int(port) if port else 80, 1, 0, "",
+                                                        "CallbackVkLongPollConnected", self._account.GetHookData())
+            if not self._connect_hook:
+                self._drop_server()
+                self._on_failure()
+
+        return False
+
+    def OnConnected(self, status, fd, error, ip_address):
+        self._connect_hook = None
+
+        if status != weechat.WEECHAT_HOOK_CONNECT_OK:
+            if tracer.enabled:
+                tracer.Event("longpoll.error", account=self._account.name, error=u"connection failed ({0}) {1}".format(status,
+                                error.decode("utf-8", "ignore")))
+            self._drop_server()
+            self._on_failure()
+            return
+
+        ## The socket object holds a copy of the descriptor WeeChat handed over
+        try:
+            self._sock = socket.fromfd(fd, socket.AF_INET6 if ":" in ip_address else socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setblocking(0)
+        except socket.error as e:
+            self._sock = None
+            self._drop_server()
+            self._on_failure()
+            return
+        finally:
+            os.close(fd)
+
+        self._connected = True
+        self._last_activity = time.time()
+        metrics.Increment("longpoll.connections")
+        self._account.startup.Refresh()
+
+        if self._event_driven:
+            self._hook(0, 1)
+
+    def _queue_request(self):
+        if self._new_ts:
+            self.longpollserver_info["ts"] = self._new_ts
+            self._new_ts = None
+
+        self._out = "GET /{path}?act=a_check&key={key}&ts={ts}&wait={wait}&mode={mode} HTTP/1.1{crlf}Host: {hostname}{crlf}{crlf}".format(
+                        path=self.longpollserver_info["path"], key=self.longpollserver_info["key"], ts=self.longpollserver_info["ts"],
+                        wait=self.LONGPOLL_WAIT, mode=self.LONGPOLL_MODE, hostname=self.longpollserver_info["hostname"], crlf="\r\n")
+        self._request_pending = True
+
+    def _flush_request(self):
+        if not self._out:
+            self._queue_request()
+
+        try:
+            sent = self._sock.send(self._out)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            if tracer.enabled:
+                tracer.Event("longpoll.error", account=self._account.name, error=os.strerror(e.args[0]))
+            self._close()
+            self._on_failure()
+            return False
+
+        self._out = self._out[sent:]
+        self._last_activity = time.time()
+        if not self._out:
+            self._request_sent = self._last_activity
+
+        return True
+
+    def _handle_response(self, response):
+        """Return the list of updates held by a complete response"""
+
+        self._request_pending = False
+        elapsed_ms = (time.time() - self._request_sent) * 1000
+        metrics.Increment("longpoll.cycles")
+        metrics.Observe("longpoll.cycle", elapsed_ms)
+
+        updates = {}
+        if response.status == 200:
+            try:
+                updates = json.loads(bytes(response.body).decode("utf-8", "ignore"))
+            except ValueError as e:
+                pass
+
+        if recorder.enabled:
+            recorder.Record(self._account.name, Recorder.KIND_LONGPOLL, updates)
+
+        ## If the answer from the server is { failed: 2 }, we need to request another key
+        ## After a while, the connection is reset by the server, so we have to make another request
+        ## The events that happen in the meantime are fetched once the new key was received
+        if not isinstance(updates, dict) or "failed" in updates or not "ts" in updates or not "updates" in updates:
+            self._drop_server()
+            self._on_failure()
+            return []
+
+        self._failures = 0
+        self._new_ts = updates["ts"]
+        self._set_pts(updates.get("pts"))
+
+        if tracer.enabled:
+            tracer.Event("longpoll.cycle", account=self._account.name, ms=elapsed_ms, updates=len(updates["updates"]), ts=updates["ts"],
+                            pts=updates.get("pts"))
+
+        metrics.Increment("longpoll.updates", len(updates["updates"]))
+        if not updates["updates"]:
+            metrics.Increment("longpoll.empty_cycles")
+
+        ## The connection is kept alive to send the next request, unless the server won't have it
+        if not response.IsKeepAlive():
+            self._close()
+
+        return updates["updates"]
+
+    def _read_response(self):
+        """Read whatever data is available on the socket without blocking, return None if no response was completed"""
+
+        responses = []
+
+        while True:
+            try:
+                n = self._sock.recv_into(self._recv_buffer)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self._close()
+                self._on_failure()
+                return []
+
+            if not n:
+                ## The server closed the connection, the last response might have been delimited by it
+                response = self._parser.Finish()
+                if response:
+                    responses.append(response)
+
+                ## Closing the connection before answering the request is a failure, the reconnection is delayed
+                failed = not responses and self._request_pending
+                self._close()
+                if failed:
+                    if tracer.enabled:
+                        tracer.Event("longpoll.error", account=self._account.name, error=u"connection closed")
+                    self._on_failure()
+                break
+
+            metrics.Increment("longpoll.bytes_received", n)
+            try:
+                responses.extend(self._parser.Feed(self._recv_view[:n]))
+            except ValueError as e:
+                if tracer.enabled:
+                    tracer.Event("longpoll.error", account=self._account.name, error=unicode(e))
+                self._close()
+                self._on_failure()
+                return []
+
+            self._last_activity = time.time()
+
+        if not responses:
+            return None if self._sock else []
+
+        updates = []
+        for response in responses:
+            updates.extend(self._handle_response(response))
+
+        return updates
+
+    def FetchServerInfo(self):
+        """Request the server info unless it's known already, ahead of the connection"""
+
+        if not self.longpollserver_info and not self._fetching_server_info:
+            self._fetching_server_info = self._account.GetLongPollServerInfo(self._on_server_info)
+
+        return self._fetching_server_info
+
+    def IsConnected(self):
+        return self._connected
+
+    def IsStalled(self):
+        return self._sock is not None and time.time() - self._last_activity > self.LONGPOLL_WAIT + 10
+
+    def Stop(self):
+        if self._retry_timer:
+            weechat.unhook(self._retry_timer)
+            self._retry_timer = None
+
+        self._event_driven = False
+        self._drop_server()
+
+    def OnRetry(self):
+        ## The timer might fire a little ahead of the time it was set for
+        self._retry_timer = None
+        self._retry_at = 0
+
+        if self._event_driven:
+            self.Start()
+
+    def _is_writing(self):
+        return bool(self._out) or not self._request_pending
+
+    @staticmethod
+    def PollAll(pollers):
+        """Poll the sockets of several accounts without blocking, used when the long polling is driven by a timer
+
+        All the sockets are checked by a single select call per direction, the (account, updates) pairs of the ones that
+        received updates are returned"""
+
+        pollers = [ poller for poller in pollers if poller._connect_longpoll() ]
+
+        writers = dict((poller._sock, poller) for poller in pollers if poller._is_writing())
+        if writers:
+            _, writable, _ = select.select([], writers.keys(), [], 0)
+            for sock in writable:
+                writers[sock]._flush_request()
+
+        ## The requests that were just sent might already have been answered
+        readers = dict((poller._sock, poller) for poller in pollers if poller._sock and not poller._is_writing())
+        if not readers:
+            return []
+
+        readable, _, _ = select.select(readers.keys(), [], [], 0)
+        results = []
+        for sock in readable:
+            updates = readers[sock]._read_response()
+            if updates:
+                results.append((readers[sock]._account, updates))
+
+        return results
+
+    def Start(self):
+        """Connect to the long polling server, and have WeeChat tell us when the socket is ready"""
+
+        self._event_driven = True
+
+        if self._hook_fd:
+            return True
+
+        if not self._connect_longpoll():
+            return False
+
+        self._hook(0, 1)
+
+        return True
+
+    def OnFdReady(self):
+        """Handle a readiness notification of the long polling socket, and return the updates received if any"""
+
+        if not self._sock:
+            return []
+
+        if self._out or not self._request_pending:
+            if not self._flush_request():
+                return []
+
+            if not self._out:
+                self._hook(1, 0)
+
+            return []
+
+        updates = self._read_response()
+        if updates is None:
+            return []
+
+        ## Send the next request right away, reconnecting first if the server closed the connection
+        if self._sock and self._flush_request():
+            if self._out:
+                self._hook(0, 1)
+            else:
+                self._hook(1, 0)
+
+        ## After consecutive failures, the retry timer reconnects once the delay is over
+        if not self._sock and time.time() >= self._retry_at:
+            self.Start()
+
+        return updates
+
+class BufferManager(object):
+    FMT_BUFFER_NAME = u"{first_name} {last_name} ({nickname})"
+    FMT_CHAT_BUFFER_NAME = u"{title} (chat {chat_id})"
+    ## The buffers of the other accounts are prefixed with their name
+    FMT_BUFFER_NAME_ACCOUNT = u"{account}.{name}"
+    MAX_LINE_FORMATS = 10000
+
+    def __init__(self, account):
+        super(BufferManager, self).__init__()
+
+        self._account = account
+        ## Open conversation buffers by peer id, and the other way around
+        self._chat_buffers = {}
+        self._chat_uids = {}
+        self._line_formats = {}
+        ## Lines waiting to be displayed, with their buffer, and the amount of lines that can still be displayed this tick
+        self._backlog = collections.deque()
+        self._backlog_timer = None
+        self._tick_budget = None
+
+    def GetBuffer(self, buffer_id):
+        return weechat.buffer_search("python", buffer_id.encode("utf-8"))
+
+    def CreateBuffer(self, buffer_id, buffer_title, callback_name_oninput, callback_name_onclose, localvars):
+        buffer_ = self.GetBuffer(buffer_id)
+        if buffer_:
+            return buffer_
+
+        buffer_ = weechat.buffer_new(buffer_id.encode("utf-8"), callback_name_oninput, self._account.GetHookData(), callback_name_onclose,
+                                        self._account.GetHookData())
+
+        weechat.buffer_set(buffer_, "title", buffer_title.encode("utf-8"))
+
+        for k, v in localvars.iteritems():
+            weechat.buffer_set(buffer_, "localvar_set_{0}".format(k), v.encode("utf-8"))
+
+        return buffer_
+
+    def GetChatBufferId(self, uid, first_name, last_name, nickname):
+        name = self.FMT_BUFFER_NAME.format(first_name=first_name, last_name=last_name, nickname=nickname if nickname else uid)
+
+        return self.FMT_BUFFER_NAME_ACCOUNT.format(account=self._account.name, name=name) if self._account.name else name
+
+    def GetChatBufferTitle(self, uid, first_name, last_name):
+        status = self._account.presence.GetStatus(int(uid))
+
+        return u"{0} {1}, on Vkontakte{2}{3}".format(first_name, last_name, u" as {0}".format(self._account.name) if self._account.name else u"",
+                                                    u" ({0})".format(status) if status else u"")
+
+    def GetChatBuffer(self, peer_id):
+        """Return the buffer of the conversation with a user or of a group chat, if it's open"""
+
+        return self._chat_buffers.get(int(peer_id), "")
+
+    def GetGroupChatBufferId(self, chat_id, title):
+        name = self.FMT_CHAT_BUFFER_NAME.format(title=title, chat_id=chat_id)
+
+        return self.FMT_BUFFER_NAME_ACCOUNT.format(account=self._account.name, name=name) if self._account.name else name
+
+    def GetGroupChatBufferTitle(self, chat_id, title):
+        status = self._account.presence.GetStatus(VkPeer.CHAT_BASE + chat_id)
+
+        return u"{0}, group chat on Vkontakte{1}{2}".format(title, u" as {0}".format(self._account.name) if self._account.name else u"",
+                                                            u" ({0})".format(status) if status else u"")
+
+    def RenameChatBuffer(self, uid, first_name, last_name, nickname):
+        """Update the name and title of the conversation buffer of a user whose name changed"""
+
+        buffer_ = self.GetChatBuffer(uid)
+        if not buffer_:
+            return False
+
+        weechat.buffer_set(buffer_, "name", self.GetChatBufferId(unicode(uid), first_name, last_name, nickname).encode("utf-8"))
+        weechat.buffer_set(buffer_, "title", self.GetChatBufferTitle(uid, first_name, last_name).encode("utf-8"))
+        weechat.buffer_set(buffer_, "localvar_set_first_name", first_name.encode("utf-8"))
+        weechat.buffer_set(buffer_, "localvar_set_last_name", last_name.encode("utf-8"))
+
+        return True
+
+    def RenameGroupChatBuffer(self, chat_id, title):
+        buffer_ = self.GetChatBuffer(VkPeer.CHAT_BASE + chat_id)
+        if not buffer_:
+            return False
+
+        weechat.buffer_set(buffer_, "name", self.GetGroupChatBufferId(chat_id, title).encode("utf-8"))
+        weechat.buffer_set(buffer_, "title", self.GetGroupChatBufferTitle(chat_id, title).encode("utf-8"))
+        weechat.buffer_set(buffer_, "localvar_set_title", title.encode("utf-8"))
+
+        return True
+
+    def OnBufferClosed(self, buffer_):
+        uid = self._chat_uids.pop(buffer_, None)
+        if uid is not None:
+            del self._chat_buffers[uid]
+
+        self._drop_backlog(buffer_)
+
+    def ClearBuffer(self, buffer_):
+        self._drop_backlog(buffer_)
+        weechat.buffer_clear(buffer_)
+
+    def Stop(self):
+        if self._backlog_timer:
+            weechat.unhook(self._backlog_timer)
+            self._backlog_timer = None
+
+        self._backlog.clear()
+        self._tick_budget = None
+
+    @staticmethod
+    def GetMessageTag(message_id):
+        return u"vkchat_message_{0}".format(message_id)
+
+    def CreateChatBuffer(self, uid, first_name, last_name, nickname, render_history=True):
+        buffer_ = self.GetChatBuffer(uid)
+        if buffer_:
+            return buffer_
+
+        buffer_title = self.GetChatBufferTitle(uid, first_name, last_name)
+        buffer_id = self.GetChatBufferId(uid, first_name, last_name, nickname)
+
+        created = not self.GetBuffer(buffer_id)
+        buffer_ = self.CreateBuffer(buffer_id, buffer_title, "CallbackBufferInput", "CallbackBufferClose", {
+                                        "first_name": first_name,
+                                        "last_name": last_name,
+                                        "uid": uid,
+                                        "peer_id": uid,
+                                        "vkchat_account": self._account.name,
+                                    })
+        if not buffer_:
+            return buffer_
+
+        self._chat_buffers[int(uid)] = buffer_
+        self._chat_uids[buffer_] = int(uid)
+
+        ## The last messages of the conversation are displayed right away from the local history
+        if created and render_history:
+            self._account.message_history.Render(buffer_, int(uid))
+
+        return buffer_
+
+    def CreateGroupChatBuffer(self, chat_id, title, render_history=True):
+        peer_id = VkPeer.CHAT_BASE + chat_id
+        buffer_ = self.GetChatBuffer(peer_id)
+        if buffer_:
+            return buffer_
+
+        buffer_id = self.GetGroupChatBufferId(chat_id, title)
+
+        created = not self.GetBuffer(buffer_id)
+        buffer_ = self.CreateBuffer(buffer_id, self.GetGroupChatBufferTitle(chat_id, title), "CallbackBufferInput", "CallbackBufferClose", {
+                                        "title": title,
+                                        "chat_id": unicode(chat_id),
+                                        "peer_id": unicode(peer_id),
+                                        "vkchat_account": self._account.name,
+                                    })
+        if not buffer_:
+            return buffer_
+
+        self._chat_buffers[peer_id] = buffer_
+        self._chat_uids[buffer_] = peer_id
+
+        ## The members are listed once the roster of the chat was fetched
+        weechat.buffer_set(buffer_, "nicklist", "1")
+        self._account.chat_rosters.UpdateNicklist(chat_id)
+
+        if created and render_history:
+            self._account.message_history.Render(buffer_, peer_id)
+
+        return buffer_
+
+    def _get_line_format(self, nick, outward, notify, private):
+        """Return the encoded tags and prefix of the lines of a nick, which are computed once until the colors change"""
+
+        key = (nick, outward, notify, private)
+        line_format = self._line_formats.get(key)
+        if line_format:
+            return line_format
+
+        if len(self._line_formats) >= self.MAX_LINE_FORMATS:
+            self._line_formats.clear()
+
+        color = weechat.color("chat_nick_self" if outward else "chat_nick_other")
+        ## Messages displayed from the history were already logged
+        ## Only the messages of private conversations notify like a query would
+        if notify:
+            notify_tags = "notify_private,log1" if private else "notify_message,log1"
+        else:
+            notify_tags = "notify_none,no_highlight,no_log"
+        message_tags = u"{0},nick_{1},prefix_nick_{2}".format(notify_tags, nick, color)
+        line_format = self._line_formats[key] = (message_tags.encode("utf-8"), u"{0}{1}\t".format(color, nick).encode("utf-8"))
+
+        return line_format
+
+    def _print_lines(self, buffer_, lines):
+        prnt_date_tags = weechat.prnt_date_tags
+        get_line_format = self._get_line_format
+        private = not VkPeer.IsChat(self._chat_uids.get(buffer_, 0))
+
+        for date, nick, message, outward, extra_tags, notify in lines:
+            message_tags, prefix = get_line_format(nick, outward, notify, private)
+            if extra_tags:
+                message_tags = ",".join((message_tags,) + tuple(tag.encode("utf-8") for tag in extra_tags))
+
+            prnt_date_tags(buffer_, date, message_tags, prefix + message.encode("utf-8"))
+
+        metrics.Increment("render.lines", len(lines))
+        if tracer.enabled:
+            tracer.Event("render.batch", account=self._account.name, peer=self._chat_uids.get(buffer_), lines=len(lines))
+
+    def _drop_backlog(self, buffer_):
+        if self._backlog:
+            self._backlog = collections.deque(entry for entry in self._backlog if entry[0] != buffer_)
+
+    def ResetColors(self):
+        self._line_formats.clear()
+
+    def _schedule_tick(self):
+        if not self._backlog_timer:
+            self._backlog_timer = weechat.hook_timer(1, 0, 1, "CallbackVkRenderBacklog", self._account.GetHookData())
+
+    def DisplayLines(self, buffer_, lines):
+        """Display a batch of (date, nick, message, outward, extra_tags, notify) lines in a buffer
+
+        At most max-lines-per-tick lines are displayed per iteration of the event loop, whatever the amount of calls, the
+        others are displayed over the next iterations"""
+
+        max_lines = Util.GetConfigOption("max-lines-per-tick", int)
+        if not max_lines:
+            self._print_lines(buffer_, lines)
+            return
+
+        if self._tick_budget is None:
+            self._tick_budget = max_lines
+
+        ## The lines come after the ones that are still waiting to be displayed
+        if not self._backlog and self._tick_budget > 0:
+            printed, lines = lines[:self._tick_budget], lines[self._tick_budget:]
+            self._print_lines(buffer_, printed)
+            self._tick_budget -= len(printed)
+
+        self._backlog.extend((buffer_, line) for line in lines)
+
+        ## The timer marks the end of the tick, the budget is reset when it fires
+        self._schedule_tick()
+
+    def OnBacklogTimer(self):
+        self._backlog_timer = None
+
+        count = Util.GetConfigOption("max-lines-per-tick", int) or len(self._backlog)
+        batch_buffer, batch = None, []
+
+        ## Consecutive lines of the same buffer are printed together
+        while self._backlog and count > 0:
+            buffer_, line = self._backlog.popleft()
+            if buffer_ != batch_buffer and batch:
+                self._print_lines(batch_buffer, batch)
+                batch = []
+            batch_buffer = buffer_
+            batch.append(line)
+            count -= 1
+
+        if batch:
+            self._print_lines(batch_buffer, batch)
+
+        ## The lines displayed by the timer count towards the budget of its tick
+        self._tick_budget = count
+        if self._backlog:
+            self._schedule_tick()
+
+    def DisplayMessageBuffer(self, buffer_, date, nick, message, outward, extra_tags=(), notify=True):
+        """Display a single line right away"""
+
+        self._print_lines(buffer_, ((date, nick, message, outward, extra_tags, notify),))
+
+    def IsScrolledToTop(self, window):
+        """Check whether the first line of the buffer displayed in a window is visible"""
+
+        hdata_window = weechat.hdata_get("window")
+        hdata_buffer = weechat.hdata_get("buffer")
+
+        buffer_ = weechat.hdata_pointer(hdata_window, window, "buffer")
+        scroll = weechat.hdata_pointer(hdata_window, window, "scroll")
+        start_line = weechat.hdata_pointer(weechat.hdata_get("window_scroll"), scroll, "start_line")
+        own_lines = weechat.hdata_pointer(hdata_buffer, buffer_, "own_lines")
+
+        return bool(start_line) and start_line == weechat.hdata_pointer(weechat.hdata_get("lines"), own_lines, "first_line")
+
+    def FindLineData(self, buffer_, tag, max_lines=1000):
+        """Return a pointer to the data of the most recent line of the buffer that holds the given tag"""
+
+        hdata_buffer = weechat.hdata_get("buffer")
+        hdata_line = weechat.hdata_get("line")
+        hdata_line_data = weechat.hdata_get("line_data")
+
+        ## The buffer might have been closed in the meantime
+        if not weechat.hdata_check_pointer(hdata_buffer, weechat.hdata_get_list(hdata_buffer, "gui_buffers"), buffer_):
+            return None
+
+        own_lines = weechat.hdata_pointer(hdata_buffer, buffer_, "own_lines")
+        line = weechat.hdata_pointer(weechat.hdata_get("lines"), own_lines, "last_line") if own_lines else ""
+
+        while line and max_lines > 0:
+            line_data = weechat.hdata_pointer(hdata_line, line, "data")
+
+            for i in xrange(weechat.hdata_integer(hdata_line_data, line_data, "tags_count")):
+                if weechat.hdata_string(hdata_line_data, line_data, "{0}|tags_array".format(i)) == tag:
+                    return line_data
+
+            line = weechat.hdata_move(hdata_line, line, -1)
+            max_lines -= 1
+
+        return None
+
+    def UpdateLineMessage(self, buffer_, tag, message):
+        """Replace the message of the line that holds the given tag, if it's still displayed or waiting to be"""
+
+        ## The most recent lines are the likeliest to be updated
+        for i in xrange(len(self._backlog) - 1, -1, -1):
+            line_buffer, (date, nick, _, outward, extra_tags, notify) = self._backlog[i]
+            if line_buffer == buffer_ and tag in extra_tags:
+                self._backlog[i] = (buffer_, (date, nick, message, outward, extra_tags, notify))
+                return True
+
+        line_data = self.FindLineData(buffer_, tag)
+        if not line_data:
+            return False
+
+        weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {
+                                "message": message.encode("utf-8"),
+                            })
+
+        return True
+
+    def DisplayUserMessages(self, user, messages):
+        uid, first_name, last_name, nickname = unicode(user["id"]), user["first_name"], user["last_name"], user.get("nickname")
+
+        new_ids = self._account.message_history.Save(user["id"], messages)
+
+        ## A new buffer renders the history, which holds the new messages, with enough lines to display them all
+        if self._account.storage.IsOpen() and not self.GetChatBuffer(user["id"]):
+            buffer_ = self.CreateChatBuffer(uid, first_name, last_name, nickname, render_history=False)
+            self._account.message_history.Render(buffer_, user["id"], max(Util.GetConfigOption("history-lines", int), len(messages)), new_ids)
+        else:
+            buffer_ = self.CreateChatBuffer(uid, first_name, last_name, nickname)
+            self.DisplayLines(buffer_, [ (message["date"], first_name, message["body"], False, (self.GetMessageTag(message["id"]),), True)
+                                            for message in messages if message["id"] in new_ids ])
+
+        self._account.read_receipts.Add(user["id"], (message["id"] for message in messages))
+
+    def DisplayGroupChatMessages(self, chat_id, messages):
+        peer_id = VkPeer.CHAT_BASE + chat_id
+        chat_rosters = self._account.chat_rosters
+
+        ## The title of the chat is given along with its messages
+        title_changed = chat_rosters.SetTitle(chat_id, messages[-1].get("title"))
+        title = chat_rosters.GetTitle(chat_id)
+
+        new_ids = self._account.message_history.Save(peer_id, messages)
+
+        if self._account.storage.IsOpen() and not self.GetChatBuffer(peer_id):
+            buffer_ = self.CreateGroupChatBuffer(chat_id, title, render_history=False)
+            self._account.message_history.Render(buffer_, peer_id, max(Util.GetConfigOption("history-lines", int), len(messages)), new_ids)
+        else:
+            if title_changed:
+                self.RenameGroupChatBuffer(chat_id, title)
+
+            buffer_ = self.CreateGroupChatBuffer(chat_id, title)
+            self.DisplayLines(buffer_, [ (message["date"], chat_rosters.GetNick(chat_id, message["user_id"]), message["body"], False,
+                                            (self.GetMessageTag(message["id"]),), True)
+                                            for message in messages if message["id"] in new_ids ])
+
+        self._account.read_receipts.Add(peer_id, (message["id"] for message in messages))
+
+    @metrics.Timed("render.messages")
+    def DisplayMessagesSortedUid(self, messages_by_uid):
+        unknown_uids = []
+        chat_ids = []
+
+        for uid, messages in messages_by_uid.iteritems():
+            if VkPeer.IsChat(uid):
+                chat_ids.append(VkPeer.GetChatId(uid))
+                continue
+
+            user = self._account.LookupUser(uid)
+            if user:
+                self.DisplayUserMessages(user, messages)
+            else:
+                unknown_uids.append(uid)
+
+        ## The messages of the users who aren't known yet are displayed once they've all been resolved
+        if unknown_uids:
+            self._account.user_resolver.Resolve(unknown_uids, lambda users: self._display_resolved_messages(users, unknown_uids, messages_by_uid))
+
+        ## The messages of a group chat are displayed once its roster was fetched, the first time only
+        if chat_ids:
+            self._account.chat_rosters.Load(chat_ids, lambda: self._display_chats_messages(chat_ids, messages_by_uid))
+
+    def _display_chats_messages(self, chat_ids, messages_by_uid):
+        for chat_id in chat_ids:
+            self.DisplayGroupChatMessages(chat_id, messages_by_uid[VkPeer.CHAT_BASE + chat_id])
+
+    def _display_resolved_messages(self, users, uids, messages_by_uid):
+        for uid in uids:
+            user = users.get(uid) or {
+                "id": uid,
+                "first_name": unicode(uid),
+                "last_name": u"",
+                "nickname": None,
+            }
+
+            self.DisplayUserMessages(user, messages_by_uid[uid])
+
+class OutgoingMessage(object):
+    STATUS_PENDING = 0
+    STATUS_SENT = 1
+    STATUS_FAILED = 2
+
+    def __init__(self, local_id, buffer_, peer_id, message):
+        super(OutgoingMessage, self).__init__()
+
+        self.local_id = local_id
+        self.buffer = buffer_
+        self.peer_id = peer_id
+        self.message = message
+        self.date = int(time.time())
+        self.random_id = random.randint(1, 2 ** 31 - 1)
+        self.retries = 0
+        self.status = self.STATUS_PENDING
+
+    def GetTag(self):
+        return u"vkchat_out_{0}".format(self.local_id)
+
+class SendQueue(object):
+    """Sends the messages typed in the chat buffers in the background, one at a time per conversation"""
+
+    MAX_RETRIES = 5
+    RETRY_DELAY_MS = 1000
+
+    def __init__(self, account):
+        super(SendQueue, self).__init__()
+
+        self._account = account
+        self._next_local_id = 0
+        self._queues = {}
+        self._busy = set()
+        self._timers = {}
+
+    def _format_message(self, outgoing_message):
+        if outgoing_message.status == OutgoingMessage.STATUS_PENDING:
+            return u"{0}{1} (sending)".format(outgoing_message.message, weechat.color("darkgray"))
+        elif outgoing_message.status == OutgoingMessage.STATUS_FAILED:
+            return u"{0}{1} (not sent)".format(outgoing_message.message, weechat.color("red"))
+
+        return outgoing_message.message
+
+    def _process(self, peer_id):
+        queue = self._queues.get(peer_id)
+        if not queue:
+            self._queues.pop(peer_id, None)
+            return
+
+        ## The next message of the conversation is sent once the previous one was
+        if peer_id in self._busy or peer_id in self._timers:
+            return
+
+        outgoing_message = queue[0]
+        self._busy.add(peer_id)
+
+        self._account.SendMessagePeerAsync(peer_id, outgoing_message.message, outgoing_message.random_id,
+                                    lambda response, error: self._on_result(outgoing_message, response, error))
+
+    def _on_result(self, outgoing_message, response, error):
+        peer_id = outgoing_message.peer_id
+        self._busy.discard(peer_id)
+
+        ## The queue was dropped in the meantime, only the outcome of the message that was being sent is shown
+        queue = self._queues.get(peer_id)
+        stopped = not queue or queue[0] is not outgoing_message
+
+        if error and error.IsTransient() and outgoing_message.retries < self.MAX_RETRIES and not stopped:
+            delay = self.RETRY_DELAY_MS * 2 ** outgoing_message.retries
+            outgoing_message.retries += 1
+
+            if tracer.enabled:
+                tracer.Event("send.retry", account=self._account.name, peer_id=peer_id, delay_ms=delay, error=unicode(error))
+            self._timers[peer_id] = weechat.hook_timer(delay, 0, 1, "CallbackVkSendRetry", self._account.GetHookData(peer_id))
+            return
+
+        if error:
+            self._account.Log(u"unable to send message to {0}: {1}".format(peer_id, unicode(error)))
+            outgoing_message.status = OutgoingMessage.STATUS_FAILED
+        else:
+            outgoing_message.status = OutgoingMessage.STATUS_SENT
+            ## The API returns the id of the message
+            self._account.message_history.Save(peer_id, [ {
+                                                            "id": response,
+                                                            "out": 1,
+                                                            "date": outgoing_message.date,
+                                                            "body": outgoing_message.message,
+                                                        } ])
+
+        self._account.buffer_manager.UpdateLineMessage(outgoing_message.buffer, outgoing_message.GetTag(), self._format_message(outgoing_message))
+
+        if not stopped:
+            queue.popleft()
+            self._process(peer_id)
+
+    def Push(self, buffer_, peer_id, message):
+        """Queue a message to a peer, given by its int id"""
+
+        outgoing_message = OutgoingMessage(self._next_local_id, buffer_, peer_id, message)
+        self._next_local_id += 1
+
+        self._account.buffer_manager.DisplayMessageBuffer(buffer_, outgoing_message.date, u"me", self._format_message(outgoing_message), True,
+                                                            extra_tags=(outgoing_message.GetTag(),))
+
+        self._queues.setdefault(peer_id, collections.deque()).append(outgoing_message)
+        self._process(peer_id)
+
+    def Retry(self, peer_id):
+        self._timers.pop(peer_id, None)
+        self._process(peer_id)
+
+    def Stop(self):
+        """Give up on the messages that weren't sent yet, they're shown as not sent"""
+
+        for timer in self._timers.itervalues():
+            weechat.unhook(timer)
+
+        self._timers.clear()
+
+        for peer_id, queue in self._queues.iteritems():
+            self._account.Log(u"{0} message(s) to {1} not sent".format(len(queue), peer_id))
+
+            for outgoing_message in queue:
+                outgoing_message.status = OutgoingMessage.STATUS_FAILED
+                self._account.buffer_manager.UpdateLineMessage(outgoing_message.buffer, outgoing_message.GetTag(),
+                                                                self._format_message(outgoing_message))
+
+        self._queues.clear()
+
+class ReadReceipts(object):
+    """Accumulates the ids of the messages to mark as read, and sends them together in a single request"""
+
+    DEBOUNCE_MS = 1000
+    MAX_PENDING_IDS = 100
+
+    def __init__(self, account):
+        super(ReadReceipts, self).__init__()
+
+        self._account = account
+        ## Ids of the messages to mark as read, and of the peers they were received from
+        self._ids = {}
+        self._timer = None
+
+    def _on_result(self, ids, error):
+        if not error:
+            return
+
+        if error.IsTransient():
+            for id_, peer_id in ids:
+                self.Add(peer_id, (id_,))
+        else:
+            self._account.Log(u"unable to mark messages as read: {0}".format(unicode(error)))
+
+    def Add(self, peer_id, ids):
+        self._ids.update((int(id_), peer_id) for id_ in ids)
+
+        if len(self._ids) >= self.MAX_PENDING_IDS:
+            self.Flush()
+        elif self._ids and not self._timer:
+            self._timer = weechat.hook_timer(self.DEBOUNCE_MS, 0, 1, "CallbackVkFlushReadReceipts", self._account.GetHookData())
+
+    def Discard(self, ids):
+        """Forget about messages that were read in the meantime"""
+
+        for id_ in ids:
+            self._ids.pop(id_, None)
+
+    def DiscardPeer(self, peer_id, last_id):
+        """Forget about the messages of a conversation that were read up to a given one"""
+
+        self.Discard([ id_ for id_, id_peer_id in self._ids.iteritems() if id_peer_id == peer_id and id_ <= last_id ])
+
+    def Flush(self, synchronous=False):
+        if self._timer:
+            weechat.unhook(self._timer)
+            self._timer = None
+
+        if not self._ids or not self._account.IsAuthedVkontakte():
+            return
+
+        ids = sorted(self._ids.iteritems())
+        self._ids.clear()
+
+        if synchronous:
+            self._account.MarkMessagesAsRead([ id_ for id_, _ in ids ])
+        else:
+            self._account.MarkMessagesAsReadAsync([ id_ for id_, _ in ids ], lambda response, error: self._on_result(ids, error))
+
+    def OnTimer(self):
+        self._timer = None
+        self.Flush()
+
+class MessageHistory(object):
+    """Conversations are rendered from the local database, older pages are fetched from the API on demand"""
+
+    PAGE_SIZE = 50
+
+    def __init__(self, account):
+        super(MessageHistory, self).__init__()
+
+        self._account = account
+        self._displayed = {}
+        self._backfilling = set()
+        self._complete = set()
+
+    def Save(self, peer_id, messages):
+        """Save messages exchanged with a peer, and return the ids of the ones that weren't already"""
+
+        return self._account.storage.SaveMessages([ {
+                                                        "id": message["id"],
+                                                        "peer_id": peer_id,
+                                                        "out": message.get("out", 0),
+                                                        "date": message["date"],
+                                                        "body": message["body"],
+                                                        ## The sender of the messages of a group chat
+                                                        "from_id": message.get("user_id"),
+                                                    } for message in messages ])
+
+    @metrics.Timed("render.history")
+    def Render(self, buffer_, peer_id, count=None, notify_ids=()):
+        """Display the last messages of a conversation, only the ones whose ids are given trigger a notification"""
+
+        if not count:
+            count = Util.GetConfigOption("history-lines", int)
+
+        if VkPeer.IsChat(peer_id):
+            chat_id, chat_rosters = VkPeer.GetChatId(peer_id), self._account.chat_rosters
+            get_nick = lambda message: chat_rosters.GetNick(chat_id, message["from_id"])
+        else:
+            user = self._account.LookupUser(peer_id)
+            nick = user["first_name"] if user else unicode(peer_id)
+            get_nick = lambda message: nick
+
+        messages = self._account.storage.LoadLastMessages(peer_id, count)
+        self._account.buffer_manager.DisplayLines(buffer_, [ (message["date"], u"me" if message["out"] else get_nick(message), message["body"],
+                                                                bool(message["out"]), (BufferManager.GetMessageTag(message["id"]),),
+                                                                message["id"] in notify_ids)
+                                                                for message in messages ])
+
+        self._displayed[buffer_] = len(messages)
+
+        return len(messages)
+
+    def Backfill(self, buffer_, peer_id):
+        """Fetch the page of messages that precedes the oldest one stored, and display it"""
+
+        if peer_id in self._backfilling or peer_id in self._complete or not self._account.storage.IsOpen():
+            return False
+
+        self._backfilling.add(peer_id)
+
+        return self._account.FetchHistory(peer_id, self._account.storage.GetOldestMessageId(peer_id), self.PAGE_SIZE,
+                                    lambda history, error: self._on_backfill(buffer_, peer_id, history, error))
+
+    def _on_backfill(self, buffer_, peer_id, history, error):
+        self._backfilling.discard(peer_id)
+
+        if error:
+            self._account.Log(u"unable to get the history of the conversation: {0}".format(unicode(error)))
+            return
+
+        if len(history["items"]) < self.PAGE_SIZE:
+            self._complete.add(peer_id)
+
+        for message in history["items"]:
+            message["body"] = AttachmentResolver.FormatBody(message)
+
+        new_ids = self.Save(peer_id, history["items"])
+
+        ## Messages can't be inserted before the others, the buffer is rendered again
+        if new_ids and buffer_ in self._displayed:
+            self._account.buffer_manager.ClearBuffer(buffer_)
+            self.Render(buffer_, peer_id, self._displayed[buffer_] + len(new_ids))
+
+    def Forget(self, buffer_):
+        self._displayed.pop(buffer_, None)
+
+class AttachmentResolver(object):
+    """Describes the attachments of the messages, the ones received by long polling are resolved a whole batch at once
+
+    Messages are displayed with placeholders right away, and updated in place once the details of their attachments
+    arrived. The descriptions are kept in a LRU cache."""
+
+    MAX_ENTRIES = 1000
+    ## Maximum amount of ids passed to a single call
+    MAX_IDS = 100
+    ## Largest first
+    PHOTO_SIZES = ("photo_2560", "photo_1280", "photo_807", "photo_604", "photo_130", "photo_75")
+    ## Attachments whose placeholder is all there is to display
+    STATIC_TYPES = frozenset(("fwd", "geo", "sticker", "wall"))
+
+    def __init__(self, account):
+        super(AttachmentResolver, self).__init__()
+
+        self._account = account
+        ## Descriptions by attachment, designated as "<type><owner_id>_<id>"
+        self._cache = collections.OrderedDict()
+        ## Ids requested at the next flush, the other types of attachments are fetched along with the message holding them
+        self._queued = {
+            "photo": set(),
+            "doc": set(),
+        }
+        self._queued_messages = set()
+        ## Attachments and messages ("message<id>") requested but not answered yet
+        self._requested = set()
+        ## Messages waiting for their attachments, by id: (message, text, refs, waiting)
+        self._pending = {}
+
+    @staticmethod
+    def ParseLongPoll(attachments):
+        """Return the (type, id) pairs of the attachments of a message sent by the long polling server, in order"""
+
+        if not attachments:
+            return []
+
+        refs = []
+        i = 1
+        while "attach{0}_type".format(i) in attachments:
+            refs.append((attachments["attach{0}_type".format(i)], attachments.get("attach{0}".format(i), u"")))
+            i += 1
+
+        for type_ in ("fwd", "geo"):
+            if type_ in attachments:
+                refs.append((type_, attachments[type_]))
+
+        return refs
+
+    @staticmethod
+    def _format_size(size):
+        for unit in (u"B", u"KB", u"MB"):
+            if size < 1024:
+                return u"{0} {1}".format(size, unit)
+            size //= 1024
+
+        return u"{0} GB".format(size)
+
+    @staticmethod
+    def _placeholder(type_, id_):
+        if type_ == "fwd":
+            return u"[forwarded messages]"
+        elif type_ == "geo":
+            return u"[location]"
+        elif type_ in ("photo", "video", "doc", "wall") and id_:
+            return u"[{0} https://vk.com/{0}{1}]".format(type_, id_)
+
+        return u"[{0}]".format(type_)
+
+    @staticmethod
+    def _join(text, descriptions):
+        return u" ".join(([ text ] if text else []) + descriptions)
+
+    @classmethod
+    def Describe(cls, type_, item):
+        """Return the description of an attachment from the object the API returned for it"""
+
+        if type_ == "photo":
+            url = next((item[size] for size in cls.PHOTO_SIZES if item.get(size)), None)
+            if url:
+                return u"[photo {0}]".format(url)
+        elif type_ == "doc":
+            return u"[doc {0} ({1}) {2}]".format(item.get("title", u""), cls._format_size(item.get("size", 0)), item.get("url", u""))
+        elif type_ == "video":
+            return u"[video {0} https://vk.com/video{1}_{2}]".format(item.get("title", u""), item.get("owner_id"), item.get("id"))
+        elif type_ == "audio":
+            return u"[audio {0} - {1}]".format(item.get("artist", u""), item.get("title", u""))
+        elif type_ == "link":
+            return u"[link {0}]".format(item.get("url", u""))
+
+        if "owner_id" in item and "id" in item:
+            return cls._placeholder(type_, u"{0}_{1}".format(item["owner_id"], item["id"]))
+
+        return cls._placeholder(type_, None)
+
+    @classmethod
+    def FormatBody(cls, message):
+        """Return the body of a message returned by the API, followed by the descriptions of its attachments"""
+
+        descriptions = [ cls.Describe(attachment["type"], attachment.get(attachment["type"], {})) for attachment in message.get("attachments", ()) ]
+        if message.get("fwd_messages"):
+            descriptions.append(cls._placeholder("fwd", None))
+        if message.get("geo"):
+            descriptions.append(cls._placeholder("geo", None))
+
+        return cls._join(message["body"], descriptions)
+
+    def _get(self, key):
+        description = self._cache.get(key)
+        if description is not None:
+            del self._cache[key]
+            self._cache[key] = description
+
+        return description
+
+    def _store(self, type_, item):
+        if not "owner_id" in item or not "id" in item:
+            return
+
+        key = u"{0}{1}_{2}".format(type_, item["owner_id"], item["id"])
+        self._cache.pop(key, None)
+        self._cache[key] = self.Describe(type_, item)
+
+        while len(self._cache) > self.MAX_ENTRIES:
+            self._cache.popitem(last=False)
+
+    def _format(self, text, refs):
+        return self._join(text, [ self._get(type_ + id_) or self._placeholder(type_, id_) for type_, id_ in refs ])
+
+    def _queue_message(self, message_id, waiting):
+        key = u"message{0}".format(message_id)
+        waiting.add(key)
+
+        if not key in self._requested:
+            self._requested.add(key)
+            self._queued_messages.add(message_id)
+
+    def Add(self, message, attachments):
+        """Describe the attachments of a message received by long polling in its body, until the next flush resolves them"""
+
+        refs = self.ParseLongPoll(attachments)
+        if not refs:
+            return
+
+        text = message["body"]
+        waiting = set()
+        for type_, id_ in refs:
+            key = type_ + id_
+            if type_ in self.STATIC_TYPES:
+                continue
+            elif self._get(key):
+                metrics.Increment("attachments.cached")
+                continue
+
+            if not type_ in self._queued:
+                self._queue_message(message["id"], waiting)
+                continue
+
+            waiting.add(key)
+            if not key in self._requested:
+                self._requested.add(key)
+                self._queued[type_].add(id_)
+
+        if waiting:
+            self._pending[message["id"]] = (message, text, refs, waiting)
+
+        message["body"] = self._format(text, refs)
+
+    def Forget(self, message_id):
+        """Stop updating a message, e.g. because it was deleted"""
+
+        self._pending.pop(message_id, None)
+
+    def _chunks(self, ids):
+        ids = sorted(ids)
+        return [ ids[i:i + self.MAX_IDS] for i in xrange(0, len(ids), self.MAX_IDS) ]
+
+    def Flush(self):
+        """Request the attachments queued since the last flush, the batcher sends all the calls in a single request"""
+
+        counts = {}
+        for type_, fetch in (("photo", self._account.FetchPhotos), ("doc", self._account.FetchDocs)):
+            ids, self._queued[type_] = self._queued[type_], set()
+            counts[type_] = len(ids)
+            for chunk in self._chunks(ids):
+                fetch(chunk, lambda items, error, type_=type_, chunk=chunk: self._on_items(type_, chunk, items, error))
+
+        message_ids, self._queued_messages = self._queued_messages, set()
+        counts["message"] = len(message_ids)
+        for chunk in self._chunks(message_ids):
+            self._account.FetchMessages(chunk, lambda messages, error, chunk=chunk: self._on_messages(chunk, messages, error))
+
+        if any(counts.itervalues()):
+            metrics.Increment("attachments.requested", sum(counts.itervalues()))
+            if tracer.enabled:
+                tracer.Event("attachments.flush", account=self._account.name, photos=counts["photo"], docs=counts["doc"],
+                                messages=counts["message"])
+
+    def _on_items(self, type_, ids, items, error):
+        keys = set(type_ + id_ for id_ in ids)
+        self._requested.difference_update(keys)
+
+        if error:
+            self._account.Log(u"unable to resolve attachments: {0}".format(unicode(error)))
+        else:
+            for item in items if isinstance(items, list) else items.get("items", ()):
+                self._store(type_, item)
+
+        ## The attachments that couldn't be resolved are looked up in the messages holding them
+        for message_id, (_, _, _, waiting) in self._pending.iteritems():
+            answered = waiting.intersection(keys)
+            waiting.difference_update(answered)
+            if any(not key in self._cache for key in answered):
+                self._queue_message(message_id, waiting)
+
+        self._update_ready()
+        self.Flush()
+
+    def _on_messages(self, message_ids, messages, error):
+        keys = set(u"message{0}".format(message_id) for message_id in message_ids)
+        self._requested.difference_update(keys)
+
+        if error:
+            self._account.Log(u"unable to resolve attachments: {0}".format(unicode(error)))
+        else:
+            for message in messages["items"]:
+                for attachment in message.get("attachments", ()):
+                    self._store(attachment["type"], attachment.get(attachment["type"], {}))
+
+        for _, _, _, waiting in self._pending.itervalues():
+            waiting.difference_update(keys)
+
+        self._update_ready()
+
+    def _update_ready(self):
+        buffer_manager = self._account.buffer_manager
+
+        for message_id in [ message_id for message_id, entry in self._pending.iteritems() if not entry[3] ]:
+            message, text, refs, _ = self._pending.pop(message_id)
+
+            body = self._format(text, refs)
+            if body == message["body"]:
+                continue
+
+            ## Messages whose sender is still being resolved aren't displayed yet, they will be with the new body
+            message["body"] = body
+            self._account.storage.UpdateMessageBody(message_id, body)
+
+            buffer_ = buffer_manager.GetChatBuffer(VkPeer.GetMessagePeerId(message))
+            if buffer_:
+                buffer_manager.UpdateLineMessage(buffer_, buffer_manager.GetMessageTag(message_id), body)
+
+class DialogsPager(object):
+    """Walks the unread dialogs page by page, from the most recent one, handing every page over as soon as it arrives"""
+
+    ## The first page is kept short for the most recent conversations to be displayed quickly
+    FIRST_PAGE_SIZE = 20
+    PAGE_SIZE = 200
+    RETRY_DELAY_MS = 30 * 1000
+
+    def __init__(self, account, on_page):
+        super(DialogsPager, self).__init__()
+
+        self._account = account
+        self._on_page = on_page
+        self._on_done = None
+        self._running = False
+        self._timer = None
+        ## Id of the message of the last dialog handed over, from which the walk is resumed
+        self.cursor = None
+
+    def _fetch(self):
+        page_size = self.PAGE_SIZE if self.cursor else self.FIRST_PAGE_SIZE
+
+        if not self._account.FetchDialogs(page_size, self.cursor, lambda dialogs: self._on_result(page_size, dialogs)):
+            self._running = False
+            self._done()
+
+    def _done(self):
+        on_done, self._on_done = self._on_done, None
+        if on_done:
+            on_done()
+
+    def _on_result(self, page_size, dialogs):
+        if dialogs is False:
+            ## Resume from the same dialog later on, without holding back whoever waits for the walk to end
+            self._timer = weechat.hook_timer(self.RETRY_DELAY_MS, 0, 1, "CallbackVkDialogsRetry", self._account.GetHookData())
+            self._done()
+            return
+
+        ## Depending on the API, the dialog the page started from might be returned again
+        page = [ dialog for dialog in dialogs if dialog["message"]["id"] != self.cursor ]
+        if page:
+            self.cursor = page[-1]["message"]["id"]
+            self._on_page(page)
+
+        if not page or len(dialogs) < page_size:
+            self._running = False
+            self.cursor = None
+            self._done()
+        else:
+            self._fetch()
+
+    def Start(self, cursor=None, on_done=None):
+        """Walk the unread dialogs, after the given cursor if any, on_done() is called once they were all handed over, or the walk
+        was interrupted by an error"""
+
+        if self._running:
+            return False
+
+        self._running = True
+        self._on_done = on_done
+        self.cursor = cursor
+        self._fetch()
+
+        return True
+
+    def Resume(self):
+        self._timer = None
+        self._fetch()
+
+    def Stop(self):
+        if self._timer:
+            weechat.unhook(self._timer)
+            self._timer = None
+
+        self._running = False
+        self._on_done = None
+
+class Presence(object):
+    """Online state and typing notifications of the peers, displayed in the title of their buffers"""
 
-    def GetFriends(self):
-        return self._friends
+    ## Typing notifications are repeated every 5 seconds while the peer is typing
+    TYPING_MS = 6 * 1000
 
-    def FetchFriends(self):
-        if not self._authed_vk:
-            return False
+    def __init__(self, account):
+        super(Presence, self).__init__()
 
-        try:
-            self._friends = self._vk_api.friends.get(order="hints", count=0, offset=0, fields="first_name,last_name,nickname", name_case="nom")
-            self._friends = self._friends["items"]
-        except vkontakte.VKError as e:
-            Util.Log("VKError: unable to get a list of friends")
-            return False
-        except Exception as e:
-            Util.Log("Unknown Exception: unable to get a list of friends")
-            return False
+        self._account = account
+        self._online = set()
+        self._typing = {}
 
-        return True
+    def _refresh(self, uid):
+        buffer_manager = self._account.buffer_manager
+        buffer_ = buffer_manager.GetChatBuffer(uid)
 
-    def FetchDialogs(self):
-        dialogs = []
+        if buffer_ and VkPeer.IsChat(uid):
+            chat_id = VkPeer.GetChatId(uid)
+            title = self._account.chat_rosters.GetTitle(chat_id)
+            weechat.buffer_set(buffer_, "title", buffer_manager.GetGroupChatBufferTitle(chat_id, title).encode("utf-8"))
+            return
 
-        if not self._authed_vk:
-            return False
+        user = self._account.LookupUser(uid) if buffer_ else None
+        if user:
+            weechat.buffer_set(buffer_, "title", buffer_manager.GetChatBufferTitle(uid, user["first_name"], user["last_name"]).encode("utf-8"))
 
-        try:
-            dialogs = self._vk_api.messages.getDialogs(offset=0, count=200, preview_length=0, unread=1)
-            dialogs = dialogs["items"]
-        except vkontakte.VKError as e:
-            Util.Log("VKError: unable to get dialogs")
-            return False
-        except Exception as e:
-            Util.Log("Unknown Exception: unable to get dialogs")
-            return False
+    def GetStatus(self, uid):
+        if uid in self._typing:
+            return u"typing..."
+        elif uid in self._online:
+            return u"online"
 
-        return dialogs
+        return u""
 
-    def MarkMessagesAsRead(self, ids):
-        try:
-            self._vk_api.messages.markAsRead(message_ids=",".join(ids))
-        except vkontakte.VKError as e:
-            Util.Log("VKError: unable to mark messages as read")
-            return False
-        except Exception as e:
-            Util.Log("Unknown Exception: unable to mark messages as read")
-            return False
+    def SetOnline(self, uid, online):
+        if online == (uid in self._online):
+            return
 
-        return True
+        if online:
+            self._online.add(uid)
+        else:
+            self._online.discard(uid)
 
-    def SendMessageUid(self, uid, message):
-        try:
-            self._vk_api.messages.send(user_ids=uid.encode("utf-8"), message=message.encode("utf-8"))
-        except vkontakte.VKError as e:
-            Util.Log("VKError: unable to send messages")
-            return False
-        except Exception as e:
-            Util.Log("Unknown Exception: unable to send messages")
-            return False
+        self._refresh(uid)
 
-        return True
+    def SetTyping(self, uid):
+        if uid in self._typing:
+            weechat.unhook(self._typing[uid])
 
-    def GetUnreadMessages(self):
-        ## XXX: don't use this function
+        self._typing[uid] = weechat.hook_timer(self.TYPING_MS, 0, 1, "CallbackVkTypingTimeout", self._account.GetHookData(uid))
+        self._refresh(uid)
 
-        try:
-            ## XXX: the filters variable doesn't seem to be returning unread messages only
-            messages = self._vk_api.messages.get(count=5, time_offset=0, filters=1, preview_length=0, out=0)
-            messages = [ message for message in messages["items"] if not message["read_state"] ]
-        except vkontakte.VKError as e:
-            Util.Log("VKError: unable to get unread messages")
-            return False
-        except Exception as e:
-            Util.Log("Unknown Exception: unable to get unread messages")
-            return False
+    def StopTyping(self, uid):
+        if uid in self._typing:
+            weechat.unhook(self._typing.pop(uid))
+            self._refresh(uid)
 
-        return messages
+    def OnTypingTimeout(self, uid):
+        if self._typing.pop(uid, None):
+            self._refresh(uid)
 
-    def GetLongPollServerInfo(self):
-        try:
-            info = self._vk_api.messages.getLongPollServer(use_ssl=0, need_pts=0)
-        except vkontakte.VKError as e:
-            Util.Log("VKError: unable to get longpoll server info")
-            return False
-        except Exception as e:
-            Util.Log("Unknown Exception: unable to get longpoll server info")
-            return False
+    def Stop(self):
+        for timer in self._typing.itervalues():
+            weechat.unhook(timer)
 
-        return info
+        self._typing.clear()
 
-    def SetDefaultOptions(self):
-        for k, v in self.DEFAULT_OPTIONS:
-            option_value = Util.GetConfigOption(k)
-            if not option_value:
-                Util.SetConfigOption(k, v)
-            else:
-                continue
+class LongPollEvents(object):
+    """Decodes the updates of the long polling server and hands them, in a single pass, to the handler registered for their code"""
 
-    def SetCommands(self):
-        weechat.hook_command("vkchat", "Chat with a friend on VK", "FIXME: document this command", "FIXME: document args", "FIXME: completion", "CallbackVkChat", "")
+    def __init__(self, account):
+        super(LongPollEvents, self).__init__()
 
-    def RegisterTimer(self, name, interval_ms, align_s, max_calls, callback_name, arg):
-        self._timers[name] = weechat.hook_timer(interval_ms, align_s, max_calls, callback_name, arg)
+        self._account = account
+        self._routes = {}
+        ## New messages are displayed together once the whole batch was handled
+        self._messages = []
+        self._messages_peers = set()
 
-    def UnregisterTimer(self, name):
-        if name in self._timers:
-            weechat.unhook(self._timers[name])
-            del self._timers[name]
-        else:
-            pass
+        self.Register((VkEventCode.MESSAGE_NEW,), MessageEvent, self._on_message)
+        self.Register((VkEventCode.FLAGS_REPLACE, VkEventCode.FLAGS_SET, VkEventCode.FLAGS_RESET), FlagsEvent, self._on_flags, ordered=True)
+        self.Register((VkEventCode.INBOX_READ, VkEventCode.OUTBOX_READ), ReadEvent, self._on_read, ordered=True)
+        self.Register((VkEventCode.FRIEND_ONLINE, VkEventCode.FRIEND_OFFLINE), PresenceEvent, self._on_presence)
+        self.Register((VkEventCode.USER_TYPING, VkEventCode.CHAT_TYPING), TypingEvent, self._on_typing)
+        self.Register((VkEventCode.CHAT_CHANGED,), ChatEvent, self._on_chat_changed)
 
-plugin = Plugin()
+    def Register(self, codes, record_class, handler, ordered=False):
+        """Have the updates of the given codes decoded into a record_class instance, which is handed to handler
 
-class UpdatesPoller(object):
-    def __init__(self):
-        super(UpdatesPoller, self).__init__()
+        Ordered events are only handled after the new messages of their conversation that precede them were displayed"""
 
-        self._sock = None
-        self._new_ts = None
-        self.longpollserver_info = {}
+        for code in codes:
+            self._routes[code] = (record_class, handler, ordered)
 
-    def _await_socket_status(self, sock, type_, timeout=.0):
-        read_list = []
-        write_list = []
+    def _flush_messages(self):
+        messages, self._messages = self._messages, []
+        self._messages_peers.clear()
 
-        if type_ == 0:
-            read_list.append(sock)
-        elif type_ == 1:
-            write_list.append(sock)
+        self._account.buffer_manager.DisplayMessagesSortedUid(_sort_messages(messages))
 
-        r_l, w_l, _ = select.select(read_list, write_list, [], timeout)
-        if (type_ == 0 and sock in r_l) or (type_ == 1 and sock in w_l):
-            return sock
+    def Handle(self, updates):
+        routes = self._routes
 
-        return None
+        for update in updates:
+            route = routes.get(update[0]) if update else None
+            if not route or len(update) < route[0].LENGTH:
+                continue
 
-    def _connect_longpoll(self):
-        if not self._sock:
-            self.longpollserver_info = plugin.GetLongPollServerInfo()
-            if not self.longpollserver_info:
-                return False
+            event = route[0](update)
+            if route[2] and self._messages and (event.peer_id is None or event.peer_id in self._messages_peers):
+                self._flush_messages()
 
-            self.longpollserver_info["hostname"], self.longpollserver_info["path"] = self.longpollserver_info["server"].split("/", 1)
+            route[1](event)
 
-            try:
-                self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_IP)
-                self._sock.connect((self.longpollserver_info["hostname"], 80))
-            except socket.error as e:
-                return False
-        elif self._new_ts:
-            self.longpollserver_info["ts"] = self._new_ts
-            self._new_ts = None
-        else:
-            return True
+        if self._messages:
+            self._flush_messages()
 
-        sock = self._await_socket_status(self._sock, 1)
-        if sock:
-            http_request = "GET /{path}?act=a_check&key={key}&ts={ts}&wait=25&mode=2 HTTP/1.1{crlf}Host: {hostname}{crlf}{crlf}".format(
-                            path=self.longpollserver_info["path"], key=self.longpollserver_info["key"], ts=self.longpollserver_info["ts"],
-                            hostname=self.longpollserver_info["hostname"], crlf="\r\n")
-            try:
-                sock = self._await_socket_status(sock, 1)
-                if sock:
-                    sock.send(http_request)
-                else:
-                    return False
-            except socket.error as e:
-                return False
+        self._account.attachments.Flush()
+
+    def _on_message(self, event):
+        if not (event.flags & VkMessageFlag.UNREAD) or (event.flags & VkMessageFlag.OUTBOX):
+            return
+
+        self._account.presence.StopTyping(event.peer_id)
+        self._messages_peers.add(event.peer_id)
+
+        ## Like the messages returned by the API, the ones of group chats are designated by the chat id and sent by user_id
+        message = {
+            "id": event.id,
+            "user_id": event.from_id,
+            "date": event.date,
+            "body": event.text,
+        }
+        if VkPeer.IsChat(event.peer_id):
+            message["chat_id"] = VkPeer.GetChatId(event.peer_id)
+            message["title"] = event.title
+        ## e.g. {"attach1_type":"photo","attach1":"185656651_374829480"}, resolved once the whole batch was handled
+        self._account.attachments.Add(message, event.attachments)
+        self._messages.append(message)
+
+    def _on_flags(self, event):
+        ## The flags of the message are either replaced, set or reset
+        if event.code == VkEventCode.FLAGS_RESET:
+            deleted, read = False, event.flags & VkMessageFlag.UNREAD
+        elif event.code == VkEventCode.FLAGS_SET:
+            deleted, read = event.flags & VkMessageFlag.DELETED, False
         else:
-            return False
+            deleted, read = event.flags & VkMessageFlag.DELETED, not event.flags & VkMessageFlag.UNREAD
 
-        return True
+        if read or deleted:
+            self._account.read_receipts.Discard((event.id,))
 
-    def GetUpdates(self):
-        updates = []
+        if deleted:
+            self._account.attachments.Forget(event.id)
+            self._account.storage.DeleteMessages((event.id,))
 
-        if not self._connect_longpoll():
-            return updates
-
-        data = ""
-        sock = self._await_socket_status(self._sock, 0, .1)
-        if sock:
-            while True:
-                sock = self._await_socket_status(sock, 0, .5)
-                if not sock:
-                    break
+            buffer_manager = self._account.buffer_manager
+            buffer_ = buffer_manager.GetChatBuffer(event.peer_id) if event.peer_id else ""
+            if buffer_:
+                buffer_manager.UpdateLineMessage(buffer_, buffer_manager.GetMessageTag(event.id), u"{0}(deleted)".format(weechat.color("darkgray")))
 
-                new_data = sock.recv(4096)
-                if not new_data:
-                    break
-                data += new_data
+    def _on_read(self, event):
+        if event.code == VkEventCode.INBOX_READ:
+            ## The messages were read from another client
+            self._account.read_receipts.DiscardPeer(event.peer_id, event.id)
+            return
 
-            if not data:
-                return updates
-        else:
-            return updates
+        ## The peer read the messages up to the given one, which other scripts can find in a local variable of the buffer
+        buffer_ = self._account.buffer_manager.GetChatBuffer(event.peer_id)
+        if buffer_:
+            weechat.buffer_set(buffer_, "localvar_set_vkchat_read_out", str(event.id))
 
-        header, body = data.split("\r\n\r\n", 1)
-        sheader =  header.split("\r\n")
-        status_line = sheader[0].split()
-        headers = dict(map(lambda x: tuple(x.split(": ", 1)), [ x for x in sheader[1:] if x ]))
+    def _on_presence(self, event):
+        self._account.presence.SetOnline(event.uid, event.code == VkEventCode.FRIEND_ONLINE)
 
-        if len(status_line) < 3 or status_line[1] != "200":
-            return updates
+    def _on_typing(self, event):
+        self._account.presence.SetTyping(event.peer_id)
 
-        body = body.decode("utf-8", "ignore")
+    def _on_chat_changed(self, event):
+        self._account.chat_rosters.Refresh(event.chat_id)
 
-        try:
-            updates = json.loads(body)
+class Startup(object):
+    """Authenticates, then loads the friends and the unread dialogs before starting the long polling
 
-            if not "ts" in updates or not "updates" in updates:
-                return []
+    The friends, the first page of dialogs and the long polling server are requested together, in a single execute request.
+    The steps run in the background, their progress is shown in the vkchat_status bar item"""
 
-            self._new_ts = updates["ts"]
-            updates = updates["updates"]
+    BAR_ITEM = "vkchat_status"
 
-        except ValueError as e:
-            return []
+    STAGE_NO_TOKEN = u"no token"
+    STAGE_AUTH = u"authenticating"
+    STAGE_AUTH_FAILED = u"authentication failed"
+    STAGE_OFFLINE = u"offline"
+    STAGE_FRIENDS = u"loading friends"
+    STAGE_DIALOGS = u"loading unread messages"
+    STAGE_POLLING = u"polling"
 
-        ## If the answer from the server is { failed: 2 }, we need to request another key
-        ## After a while, the connection is reset by the server, so we have to make another request
-        if "failed" in updates or headers["Connection"] == "close":
-            self._sock.close()
-            self._sock = None
-            self._new_ts = None
+    def __init__(self, account):
+        super(Startup, self).__init__()
 
-            return []
+        self._account = account
+        self.stage = None
+        self._status = None
+        ## The results of the steps of a previous run are ignored
+        self._run = 0
 
-        return updates
+    def _set_stage(self, stage):
+        self.stage = stage
+        self.Refresh()
 
-updates_poller = UpdatesPoller()
+    def _on_auth(self, run, error):
+        if run != self._run:
+            return
 
-class BufferManager(object):
-    FMT_BUFFER_NAME = u"{first_name} {last_name} ({nickname})"
+        if error:
+            ## The authentication is attempted again later on if VK couldn't be reached
+            self._set_stage(self.STAGE_OFFLINE if error.code is None or error.IsTransient() else self.STAGE_AUTH_FAILED)
+            return
 
-    def __init__(self):
-        super(BufferManager, self).__init__()
+        ## The friends cached during the previous session are enough to display the unread messages, which don't wait for them
+        ## to be refreshed. Otherwise the friends come first in the batch, their names are known once the dialogs arrive
+        if len(self._account.GetFriends()):
+            self._set_stage(self.STAGE_DIALOGS)
+            self._account.FetchFriends()
+        else:
+            self._set_stage(self.STAGE_FRIENDS)
+            self._account.FetchFriends(lambda success: self._on_friends(run), priority=VkRequestScheduler.PRIORITY_DISPLAY)
 
-    def GetBuffer(self, buffer_id):
-        return weechat.buffer_search("python", buffer_id.encode("utf-8"))
+        ## The walk always starts from the most recent dialog: the unread messages received since a previous session stopped its
+        ## walk are more recent than where it stopped, and the pts they could be recovered from might be missing or too old
+        if not self._account.dialogs_pager.Start(on_done=lambda: self._on_dialogs(run)):
+            self._on_dialogs(run)
 
-    def CreateBuffer(self, buffer_id, buffer_title, callback_name_oninput, callback_name_onclose, localvars):
-        buffer_ = self.GetBuffer(buffer_id)
-        if buffer_:
-            return buffer_
+        self._account.updates_poller.FetchServerInfo()
 
-        buffer_ = weechat.buffer_new(buffer_id.encode("utf-8"), callback_name_oninput, "", callback_name_onclose, "")
+    def _on_friends(self, run):
+        if run == self._run and self.stage == self.STAGE_FRIENDS:
+            self._set_stage(self.STAGE_DIALOGS)
 
-        weechat.buffer_set(buffer_, "title", buffer_title.encode("utf-8"))
+    def _on_dialogs(self, run):
+        if run != self._run:
+            return
 
-        for k, v in localvars.iteritems():
-            weechat.buffer_set(buffer_, "localvar_set_{0}".format(k), v.encode("utf-8"))
+        self._set_stage(self.STAGE_POLLING)
+        if Util.GetConfigOption("longpoll-mode") == UpdatesPoller.MODE_FD:
+            self._account.updates_poller.Start()
 
-        return buffer_
+    def GetStatus(self):
+        if self.stage == self.STAGE_POLLING:
+            return u"connected" if self._account.updates_poller.IsConnected() else u"connecting"
 
-    def CreateChatBuffer(self, uid, first_name, last_name, nickname):
-        buffer_title = u"{0} {1}, on Vkontakte".format(first_name, last_name)
-        buffer_id = self.FMT_BUFFER_NAME.format(first_name=first_name, last_name=last_name, nickname=nickname if nickname else uid)
+        return self.stage or u""
 
-        return buffer_manager.CreateBuffer(buffer_id, buffer_title, "CallbackBufferInput", "CallbackBufferClose", {
-                                                "first_name": first_name,
-                                                "last_name": last_name,
-                                                "uid": uid,
-                                            })
+    def Refresh(self):
+        """Update the bar item if the status changed"""
 
-    def DisplayMessageBuffer(self, buffer_, date, nick, message, outward):
-        color = weechat.color("chat_nick_self" if outward else "chat_nick_other")
-        message_body = u"{0}{1}\t{2}".format(color, nick, message)
-        message_tags = u"notify_private,log1,nick_{0},prefix_nick_{1}".format(nick, color)
+        status = self.GetStatus()
+        if status != self._status:
+            self._status = status
+            weechat.bar_item_update(self.BAR_ITEM)
 
-        weechat.prnt_date_tags(buffer_, date, message_tags.encode("utf-8"), message_body.encode("utf-8"))
+    def IsPolling(self):
+        return self.stage == self.STAGE_POLLING
 
-    def DisplayMessagesSortedUid(self, friends, messages_by_uid):
-        for uid, messages in messages_by_uid.iteritems():
-            ## FIXME: this loop will not display messages received from non-friends
-            for friend in friends:
-                if friend["id"] != uid:
-                    continue
+    def Run(self):
+        token = self._account.GetToken()
+        if not token:
+            self._account.Log("no token has been set to authenticate with")
+            self._set_stage(self.STAGE_NO_TOKEN)
+            return False
 
-                buffer_ = self.CreateChatBuffer(unicode(friend["id"]), friend["first_name"], friend["last_name"], friend["nickname"])
-                for message in messages:
-                    self.DisplayMessageBuffer(buffer_, message["date"], friend["first_name"], message["body"], False)
+        self._run += 1
+        run = self._run
 
-                plugin.MarkMessagesAsRead([ message["id"] for message in messages ])
+        self._set_stage(self.STAGE_AUTH)
+        self._account.AuthVkontakte(token, lambda error: self._on_auth(run, error))
 
-                break
+        return True
+
+    def Restart(self):
+        """Start over with the token currently set"""
 
-buffer_manager = BufferManager()
+        self._account.updates_poller.Stop()
+        self._account.dialogs_pager.Stop()
+        self._account.Logout()
+
+        return self.Run()
 
 ## Private functions
-def _complete_friends_suggestions(friends, first_name, last_name):
+_REGEX_METACHARACTERS = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+def _complete_friends_suggestions(friends, friends_index, first_name, last_name):
+    ## Plain names are looked up in the index, patterns are matched against every friend
+    if not _REGEX_METACHARACTERS.search(first_name) and not _REGEX_METACHARACTERS.search(last_name):
+        return friends_index.Match(first_name, last_name)
+
+    re_first_name = re.compile(first_name or u".+", re.I | re.U)
+    re_last_name = re.compile(last_name or u".+", re.I | re.U)
+
     suggestions = []
     for friend in friends:
-        f_first_name, f_last_name = friend["first_name"], friend["last_name"]
-        match_fname = re.match(first_name, f_first_name, re.I) != None
-        match_lname = re.match(last_name, f_last_name, re.I) != None
+        match_fname = re_first_name.match(friend["first_name"]) != None
+        match_lname = re_last_name.match(friend["last_name"]) != None
 
         if match_fname and match_lname:
             suggestions.append(friend)
@@ -432,15 +3770,64 @@ def _print_friends_suggestions(suggestions):
 
         n += 1
 
+def _print_search_results(account, text):
+    if not text:
+        Util.Log("usage: /vkchat search <text>")
+        return False
+    elif not account.storage.HasFullTextSearch():
+        Util.Log("searching the messages is not supported")
+        return False
+
+    try:
+        messages = account.storage.SearchMessages(text, Util.GetConfigOption("max-search-results", int))
+    except sqlite3.Error as e:
+        Util.Log(u"invalid search query: {0}".format(e))
+        return False
+
+    account.Log(u"{0} message(s) matching \"{1}\":".format(len(messages), text))
+
+    for message in messages:
+        if VkPeer.IsChat(message["peer_id"]):
+            chat_id = VkPeer.GetChatId(message["peer_id"])
+            name = account.chat_rosters.GetTitle(chat_id)
+            if not message["out"] and message["from_id"]:
+                name = u"{0} in {1}".format(account.chat_rosters.GetNick(chat_id, message["from_id"]), name)
+        else:
+            user = account.LookupUser(message["peer_id"])
+            name = u"{0} {1}".format(user["first_name"], user["last_name"]) if user else unicode(message["peer_id"])
+        date = time.strftime("%Y-%m-%d %H:%M", time.localtime(message["date"]))
+
+        Util.Log(u"[{0}] {1}: {2}".format(date, u"me -> {0}".format(name) if message["out"] else name, message["body"]))
+
+    return True
+
+def _print_stats():
+    Util.Log(u"statistics of the last {0:.0f}s:".format(metrics.GetUptime()))
+
+    for name, value in metrics.GetCounters():
+        Util.Log(u"  {0}: {1}".format(name, value))
+
+    Util.Log(u"  {0:<32} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8}".format(u"latencies (ms)", u"count", u"avg", u"p50", u"p95", u"p99", u"max"))
+    for name, count, average, p50, p95, p99, max_latency in metrics.GetHistograms():
+        Util.Log(u"  {0:<32} {1:>8} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f}".format(name, count, average, p50, p95, p99, max_latency))
+
+def _print_trace():
+    events = tracer.GetEvents()
+    Util.Log(u"{0} event(s) recorded{1}:".format(len(events), u"" if tracer.enabled else u" (tracing is disabled)"))
+
+    for event in events:
+        Util.Log(u"  {0}".format(Tracer.Format(event)))
+
 def _sort_messages(messages):
     messages_by_uid = {}
 
-    ## Separate the dialogs per user id
+    ## Separate the dialogs per peer id, i.e. user id or group chat
     for message in messages:
-        if not message["user_id"] in messages_by_uid:
-            messages_by_uid[message["user_id"]] = []
+        peer_id = VkPeer.GetMessagePeerId(message)
+        if not peer_id in messages_by_uid:
+            messages_by_uid[peer_id] = []
 
-        messages_by_uid[message["user_id"]].append(message)
+        messages_by_uid[peer_id].append(message)
 
     ## Sort the messages for every user by date
     for uid, messages in messages_by_uid.iteritems():
@@ -448,60 +3835,221 @@ def _sort_messages(messages):
 
     return messages_by_uid
 
-def _print_unread_dialogs(friends):
-    dialogs = plugin.FetchDialogs()
+def _print_accounts():
+    Util.Log("accounts (* for the current one):")
+
+    current_account = plugin.GetCurrentAccount()
+    for account in plugin.GetAccounts():
+        Util.Log(u"{0} {1}: {2}".format(u"*" if account is current_account else u" ", account.name or u"(vk-token)", account.startup.GetStatus()))
+
+def _display_unread_dialogs(account, dialogs):
     if not dialogs:
         return False
 
-    dialogs_by_uid = _sort_messages([ dialog["message"] for dialog in dialogs ])
+    messages = [ dialog["message"] for dialog in dialogs ]
+    for message in messages:
+        message["body"] = AttachmentResolver.FormatBody(message)
 
-    if not friends:
-        ## FIXME: if no friends were added, it's possible to resolve the contact name by uid with an API call
-        return
+    dialogs_by_uid = _sort_messages(messages)
 
-    buffer_manager.DisplayMessagesSortedUid(friends, dialogs_by_uid)
+    account.buffer_manager.DisplayMessagesSortedUid(dialogs_by_uid)
 
     return True
 
 ## Callbacks
-def CallbackBufferInput(_, buffer_, message):
+def CallbackBufferInput(data, buffer_, message):
     Util.Log(u"input: {0} ({1})".format(message.decode("utf-8"), type(message).__name__))
 
     ## TODO: replace smileys with the appropriate emoticons, if enabled in the config
 
-    uid = weechat.buffer_get_string(buffer_, "localvar_uid")
-    if uid:
-        message = message.decode("utf-8")
-        ## TODO: make asynchronous
-        if plugin.SendMessageUid(unicode(uid), message):
-            buffer_manager.DisplayMessageBuffer(buffer_, int(time.time()), u"me", message, True)
+    account, _ = plugin.ParseHookData(data)
+    peer_id = weechat.buffer_get_string(buffer_, "localvar_peer_id")
+    if account and peer_id:
+        account.send_queue.Push(buffer_, int(peer_id), message.decode("utf-8"))
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkApiResponse(data, _, return_code, out, err):
+    account, request_id = plugin.ParseHookData(data)
+    if account:
+        account.GetAsyncApi().OnOutput(request_id, return_code, out, err)
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkSendRetry(data, _):
+    account, peer_id = plugin.ParseHookData(data)
+    if account:
+        account.send_queue.Retry(int(peer_id))
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkSchedulerTimer(data, _):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.GetScheduler().OnTimer()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkApiBatch(data, _):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.GetBatcher().OnTimer()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkResolverTimeout(data, _):
+    account, waiter_id = plugin.ParseHookData(data)
+    if account:
+        account.user_resolver.OnTimeout(int(waiter_id))
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkDialogsRetry(data, _):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.dialogs_pager.Resume()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkTypingTimeout(data, _):
+    account, uid = plugin.ParseHookData(data)
+    if account:
+        account.presence.OnTypingTimeout(int(uid))
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkRenderBacklog(data, _):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.buffer_manager.OnBacklogTimer()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackConfigToken(_, option, __):
+    ## Setting the token of the vk-token option can add its account
+    plugin.UpdateAccounts()
+
+    name = option.decode("utf-8").rpartition(u"vk-token")[2].lstrip(u".")
+    account = plugin.GetAccount(name)
+    if account:
+        account.startup.Restart()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackConfigAccounts(_, __, ___):
+    plugin.UpdateAccounts()
+    weechat.bar_item_update(Startup.BAR_ITEM)
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackConfigTrace(_, __, ___):
+    plugin.ConfigureTracer()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackConfigRecord(_, __, ___):
+    plugin.ConfigureRecorder()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackTraceBufferClose(_, __):
+    tracer.OnBufferClosed()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackBarItemStatus(_, __, ___):
+    return plugin.GetStatus().encode("utf-8")
+
+def CallbackConfigColors(_, __, ___):
+    for account in plugin.GetAccounts():
+        account.buffer_manager.ResetColors()
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkFlushReadReceipts(data, _):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.read_receipts.OnTimer()
 
     return weechat.WEECHAT_RC_OK
 
-def CallbackBufferClose(_, buffer_):
-    ## XXX: is there anything to do here ?
+def CallbackWindowScrolled(_, __, window):
+    buffer_ = weechat.window_get_pointer(window, "buffer")
+    account = plugin.GetBufferAccount(buffer_)
+
+    ## Older messages are fetched when the top of a conversation is reached
+    if account and account.IsAuthedVkontakte() and account.buffer_manager.IsScrolledToTop(window):
+        account.message_history.Backfill(buffer_, int(weechat.buffer_get_string(buffer_, "localvar_peer_id")))
+
+    return weechat.WEECHAT_RC_OK
+
+def CallbackBufferClose(data, buffer_):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.read_receipts.Flush()
+        account.message_history.Forget(buffer_)
+        account.buffer_manager.OnBufferClosed(buffer_)
+
     return weechat.WEECHAT_RC_OK
 
-def CallbackVkChat(_, __, args):
-    args = re.split("\s+", args)
+def CallbackVkChat(_, buffer_, args):
+    args = re.split("\s+", args.decode("utf-8").strip())
+
+    if args[0] == u"stats":
+        if args[1:] == [u"reset"]:
+            metrics.Reset()
+        else:
+            _print_stats()
+        return weechat.WEECHAT_RC_OK
+    elif args[0] == u"trace":
+        if args[1:] == [u"clear"]:
+            tracer.Clear()
+        else:
+            _print_trace()
+        return weechat.WEECHAT_RC_OK
+    elif args[0] == u"account":
+        if len(args) < 2:
+            _print_accounts()
+        elif not plugin.SetCurrentAccount(args[1]):
+            Util.Log(u"no such account: {0}".format(args[1]))
+        return weechat.WEECHAT_RC_OK
+
+    account = plugin.GetCommandAccount(buffer_)
 
-    if not plugin.IsAuthedVkontakte():
-        Util.Log("not authenticated yet")
+    if args[0] == u"search":
+        _print_search_results(account, u" ".join(args[1:]))
         return weechat.WEECHAT_RC_OK
 
-    friends = plugin.GetFriends()
+    if not account.IsAuthedVkontakte():
+        account.Log("not authenticated yet")
+        return weechat.WEECHAT_RC_OK
+
+    friends = account.GetFriends()
     ## FIXME: can't talk to someone not already added as friend
     if not friends:
-        Util.Log("add more friends to your VK profile to have someone to chat with")
+        account.Log("add more friends to your VK profile to have someone to chat with")
         return weechat.WEECHAT_RC_OK
     ## TODO: add all the contacts that we have already talked to to the friends list
 
     ## TODO: add a "help" command ?
 
-    first_name = args[0] if len(args) > 0 else ".+"
-    last_name = args[1] if len(args) > 1 else ".+"
+    if args[0] == u"history":
+        peer_id = weechat.buffer_get_string(buffer_, "localvar_peer_id")
+        if not peer_id:
+            Util.Log("the history can only be fetched in a conversation buffer")
+        elif not account.message_history.Backfill(buffer_, int(peer_id)):
+            Util.Log("no more history to fetch")
+
+        return weechat.WEECHAT_RC_OK
+
+    first_name = args[0] if len(args) > 0 else u""
+    last_name = args[1] if len(args) > 1 else u""
 
-    friends_match = _complete_friends_suggestions(friends, first_name, last_name)
+    ## A friend can also be designated by their uid
+    if len(args) == 1 and first_name.isdigit() and int(first_name) in friends:
+        friends_match = [ friends.Get(int(first_name)) ]
+    else:
+        friends_match = _complete_friends_suggestions(friends, account.GetFriendsIndex(), first_name, last_name)
 
     if len(friends_match) != 1:
         if not friends_match:
@@ -512,7 +4060,7 @@ def CallbackVkChat(_, __, args):
         return weechat.WEECHAT_RC_OK
 
     friend = friends_match[0]
-    buffer_ = buffer_manager.CreateChatBuffer(unicode(friend["id"]), friend["first_name"], friend["last_name"], friend["nickname"])
+    buffer_ = account.buffer_manager.CreateChatBuffer(unicode(friend["id"]), friend["first_name"], friend["last_name"], friend["nickname"])
     if buffer_:
         pass
         ## TODO: display newly open buffer
@@ -520,78 +4068,116 @@ def CallbackVkChat(_, __, args):
 
     return weechat.WEECHAT_RC_OK
 
-def CallbackVkAuth(_, __):
-    if plugin.IsAuthedVkontakte():
-        ## XXX: return WEECHAT_RC_OK_EAT ?
-        return weechat.WEECHAT_RC_OK
+def CallbackCompletionFriendsFirstName(_, __, buffer_, completion):
+    prefix = weechat.hook_completion_get_string(completion, "base_word").decode("utf-8")
+    account = plugin.GetCommandAccount(buffer_)
 
-    config_token = Util.GetConfigOption("vk-token")
-    if not config_token:
-        Util.Log("no token has been set to authenticate with")
-        ## TODO: add a hook that will auth when the vk-token option has changed
-        return weechat.WEECHAT_RC_OK
+    for first_name in account.GetFriendsIndex().CompleteFirstNames(prefix):
+        weechat.hook_completion_list_add(completion, first_name.encode("utf-8"), 0, weechat.WEECHAT_LIST_POS_SORT)
 
-    if plugin.AuthVkontakte(config_token):
-        ## Printing the unread messages relies on the friends list
-        if plugin.FetchFriends():
-            _print_unread_dialogs(plugin.GetFriends())
+    return weechat.WEECHAT_RC_OK
+
+def CallbackCompletionFriendsLastName(_, __, buffer_, completion):
+    prefix = weechat.hook_completion_get_string(completion, "base_word").decode("utf-8")
+    args = weechat.hook_completion_get_string(completion, "args").decode("utf-8").split()
+    account = plugin.GetCommandAccount(buffer_)
+
+    ## Only suggest the last names of the friends matching the first name already typed
+    first_name = args[0] if args else u""
+    for last_name in account.GetFriendsIndex().CompleteLastNames(prefix, first_name):
+        weechat.hook_completion_list_add(completion, last_name.encode("utf-8"), 0, weechat.WEECHAT_LIST_POS_SORT)
 
     return weechat.WEECHAT_RC_OK
 
-def CallbackVkFetchFriends(_, __):
-    if not plugin.IsAuthedVkontakte():
-        return weechat.WEECHAT_RC_OK
+def CallbackInfolistStats(_, __, ___, ____):
+    infolist = weechat.infolist_new()
+
+    ## The integers of an infolist are C ints: the counters, such as the bytes received, would overflow during long sessions
+    for name, value in metrics.GetCounters():
+        item = weechat.infolist_new_item(infolist)
+        weechat.infolist_new_var_string(item, "name", name.encode("utf-8"))
+        weechat.infolist_new_var_string(item, "type", "counter")
+        weechat.infolist_new_var_string(item, "value", str(value))
+
+    for name, count, average, p50, p95, p99, max_latency in metrics.GetHistograms():
+        item = weechat.infolist_new_item(infolist)
+        weechat.infolist_new_var_string(item, "name", name.encode("utf-8"))
+        weechat.infolist_new_var_string(item, "type", "histogram")
+        weechat.infolist_new_var_string(item, "count", str(count))
+        for k, v in (("avg", average), ("p50", p50), ("p95", p95), ("p99", p99), ("max", max_latency)):
+            weechat.infolist_new_var_integer(item, k, min(int(v * 1000), 2 ** 31 - 1))
+
+    return infolist
+
+def CallbackVkAuth(_, __):
+    ## The authentication is attempted again until VK can be reached
+    for account in plugin.GetAccounts():
+        if account.startup.stage in (None, Startup.STAGE_OFFLINE):
+            account.startup.Run()
+
+    return weechat.WEECHAT_RC_OK
 
-    plugin.FetchFriends()
+def CallbackVkFetchFriends(_, __):
+    for account in plugin.GetAccounts():
+        if account.IsAuthedVkontakte():
+            account.FetchFriends()
     ## TODO: add all the contacts that we have already talked to to the friends list
 
     return weechat.WEECHAT_RC_OK
 
 def CallbackVkFetchUpdates(_, __):
-    if not plugin.IsAuthedVkontakte():
-        return weechat.WEECHAT_RC_OK
+    pollers = [ account.updates_poller for account in plugin.GetAccounts() if account.IsAuthedVkontakte() and account.startup.IsPolling() ]
+
+    for account, updates in UpdatesPoller.PollAll(pollers):
+        account.longpoll_events.Handle(updates)
+
+    return weechat.WEECHAT_RC_OK
 
-    updates = updates_poller.GetUpdates()
-    if not updates:
+def CallbackVkLongPollFd(data, _):
+    account, _ = plugin.ParseHookData(data)
+    if not account:
         return weechat.WEECHAT_RC_OK
 
-    messages = []
-    for update in updates:
-        if not update or update[0] != 4:
-            continue
+    updates = account.updates_poller.OnFdReady()
+    if updates:
+        account.longpoll_events.Handle(updates)
 
-        if len(update) < 8:
-            continue
+    return weechat.WEECHAT_RC_OK
 
-        if not (update[2] & VkMessageFlag.UNREAD) or not (update[2] & VkMessageFlag.FRIENDS) or (update[2] & VkMessageFlag.OUTBOX):
-            continue
+def CallbackVkLongPollConnected(data, status, gnutls_rc, sock, error, ip_address):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.updates_poller.OnConnected(status, sock, error, ip_address)
+    elif status == weechat.WEECHAT_HOOK_CONNECT_OK:
+        os.close(sock)
 
-        message = {
-            "id": update[1],
-            "user_id": update[3],
-            "date": update[4],
-            "body": update[6],
-        }
+    return weechat.WEECHAT_RC_OK
 
-        ## TODO: handle attachments and append as another message
-        # {"ts":1817952486,"updates":[[4,45316,563,11034418,1440257293," ... ","",{"attach1_type":"doc","attach1":"2000005557_413934409"}],[6,11034418,45315]]}
-        # {"ts":1817952488,"updates":[[4,45317,563,11034418,1440257358," ... ","",{"attach1_type":"photo","attach1":"185656651_374829480"}]
-        # {"ts":1817952538,"updates":[[4,45328,51,11034418,1440258883," ... ","😨",{"emoji":"1"}],[6,11034418,45327]]}
-        if update[7]:
-            pass
+def CallbackVkLongPollRetry(data, _):
+    account, _ = plugin.ParseHookData(data)
+    if account:
+        account.updates_poller.OnRetry()
 
-        messages.append(message)
+    return weechat.WEECHAT_RC_OK
 
-    if not messages:
-        return weechat.WEECHAT_RC_OK
+def CallbackVkSavePts(_, __):
+    for account in plugin.GetAccounts():
+        account.updates_poller.SavePts()
 
-    friends = plugin.GetFriends()
-    if not friends:
-        ## FIXME: if no friends were added, it's possible to resolve the contact name by uid with an API call
-        return weechat.WEECHAT_RC_OK
+    return weechat.WEECHAT_RC_OK
+
+def CallbackVkLongPollWatchdog(_, __):
+    for account in plugin.GetAccounts():
+        if not account.IsAuthedVkontakte() or not account.startup.IsPolling():
+            continue
 
-    buffer_manager.DisplayMessagesSortedUid(friends, _sort_messages(messages))
-    plugin.MarkMessagesAsRead([ message["id"] for message in messages ])
+        ## Reconnect if the long polling server couldn't be reached, or stopped answering
+        if account.updates_poller.IsStalled():
+            if tracer.enabled:
+                tracer.Event("longpoll.stalled", account=account.name)
+            account.updates_poller.Stop()
+
+        account.updates_poller.Start()
 
     return weechat.WEECHAT_RC_OK
 
@@ -599,8 +4185,14 @@ def CallbackPluginUnloaded():
     Util.Log("plugin unloaded")
 
     plugin.UnregisterTimer("vk-auth")
-    ## plugin.UnregisterTimer("vk-fetch-friends")
+    plugin.UnregisterTimer("vk-fetch-friends")
+    plugin.UnregisterTimer("vk-save-pts")
     plugin.UnregisterTimer("vk-fetch-updates")
+    plugin.UnregisterTimer("vk-longpoll-watchdog")
+    for account in plugin.GetAccounts():
+        account.Stop()
+    tracer.Stop()
+    recorder.Stop()
 
     return weechat.WEECHAT_RC_OK
 
@@ -608,16 +4200,27 @@ def CallbackPluginUnloaded():
 def main():
     if weechat.register(Script.NAME, Script.AUTHOR, Script.VERSION, Script.LICENSE, Script.DESCRIPTION, "CallbackPluginUnloaded", ""):
         plugin.SetDefaultOptions()
+        plugin.ConfigureTracer()
+        plugin.ConfigureRecorder()
         plugin.SetCommands()
+        plugin.SetCompletions()
+        plugin.SetSignals()
+        plugin.SetConfigHooks()
+        plugin.SetBarItems()
+        plugin.SetInfolists()
 
-        plugin.RegisterTimer("vk-auth", 60 * 1000, 60, 0, "CallbackVkAuth", "")
-        ## TODO: look into how to make this callback co-exist with vk-fetch-updates
-        ## plugin.RegisterTimer("vk-fetch-friends", 10 * 60 * 1000, 30, 0, "CallbackVkFetchFriends", "")
-        plugin.RegisterTimer("vk-fetch-updates", 5 * 1000, 10, 0, "CallbackVkFetchUpdates", "")
+        ## The accounts are authenticated once the script is loaded, without waiting for the timer to be triggered in 60s
+        plugin.UpdateAccounts()
 
-        ## Do not wait for the timers to be triggered in 60s
-        CallbackVkAuth(None, -1)
-        CallbackVkFetchFriends(None, -1)
+        ## The timers are shared by all the accounts
+        plugin.RegisterTimer("vk-auth", 60 * 1000, 60, 0, "CallbackVkAuth", "")
+        plugin.RegisterTimer("vk-fetch-friends", 10 * 60 * 1000, 30, 0, "CallbackVkFetchFriends", "")
+        plugin.RegisterTimer("vk-save-pts", 60 * 1000, 60, 0, "CallbackVkSavePts", "")
+        if Util.GetConfigOption("longpoll-mode") == UpdatesPoller.MODE_FD:
+            ## The sockets are watched by WeeChat, the timer only restarts the polling if a connection was lost
+            plugin.RegisterTimer("vk-longpoll-watchdog", 10 * 1000, 10, 0, "CallbackVkLongPollWatchdog", "")
+        else:
+            plugin.RegisterTimer("vk-fetch-updates", 5 * 1000, 10, 0, "CallbackVkFetchUpdates", "")
 
 if __name__ == "__main__":
     main()